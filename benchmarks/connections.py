@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Compare a fresh connection per ``NokiaApi`` instance with the connection pool
+shared by instances created with :py:func:`nokiaapp.utils.create_nokia`.
+
+Usage::
+
+    python benchmarks/connections.py [number of users]
+
+Each simulated user gets its own API instance, which makes one ``get_user``
+call to a local stub server. The number of TCP connections the server
+accepted, each of which would be a TLS handshake against Nokia, and the wall
+time are reported.
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_settings')
+# The stub server doesn't use TLS
+os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # Python 2.x
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+import django
+django.setup()
+
+from nokia import NokiaApi
+
+from nokiaapp.utils import create_nokia, get_creds
+
+
+BODY = b'{"status": 0, "body": {"id": 1111111}}'
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Avoid delayed ACK stalls between the headers and the body
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    connections = 0
+
+    def get_request(self):
+        self.connections += 1
+        return HTTPServer.get_request(self)
+
+
+def user_data(i):
+    return {'access_token': 'token{}'.format(i), 'token_type': 'Bearer',
+            'refresh_token': 'refresh{}'.format(i), 'user_id': i,
+            'token_expiry': int(time.time()) + 3600}
+
+
+def fresh(i):
+    """ An API instance with its own session and connections """
+    return NokiaApi(get_creds(**user_data(i)))
+
+
+def pooled(i):
+    return create_nokia(**user_data(i))
+
+
+def run(name, create, count, url):
+    server.connections = 0
+    start = time.time()
+    for i in range(count):
+        api = create(i)
+        api.URL = url
+        api.get_user()
+    elapsed = time.time() - start
+    print('{:<8} {:>6} connections {:>8.2f}s'.format(
+        name, server.connections, elapsed))
+
+
+server = Server(('127.0.0.1', 0), Handler)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    run('fresh', fresh, count, url)
+    run('pooled', pooled, count, url)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Compare reading measurement histories as ``Measure`` objects with the
+column-oriented reads of :py:mod:`nokiaapp.export`.
+
+Usage::
+
+    python benchmarks/export.py [number of users] [groups per user]
+
+By default 100 users with 2,000 groups each are generated, about 330,000
+measures. The wall time and, on Python 3, the peak memory allocated by each
+path are reported.
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_settings')
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2.x
+    tracemalloc = None
+
+import django
+django.setup()
+
+from django.contrib.auth.models import User
+from django.db import connection
+from nokia import NokiaMeasures
+
+from nokiaapp import export
+from nokiaapp.models import Measure, MeasureGroup
+
+
+def populate(users, groups):
+    random.seed(0)
+    for i in range(users):
+        user = User.objects.create_user('user{}'.format(i))
+        measuregrps = []
+        for grpid in range(groups):
+            measures = [{'value': random.randint(50000, 120000), 'type': 1,
+                         'unit': -3}]
+            if grpid % 3 == 0:
+                measures += [{'value': random.randint(100, 400), 'type': 6,
+                              'unit': -1}]
+            measuregrps.append({'grpid': grpid, 'attrib': 0, 'category': 1,
+                                'date': 1222930968 + grpid * 3600,
+                                'measures': measures})
+        MeasureGroup.create_from_measures(user, NokiaMeasures(
+            {'updatetime': 1249409679, 'measuregrps': measuregrps}))
+    return list(User.objects.values_list('pk', flat=True))
+
+
+def orm_objects(user_ids):
+    """ The usual way: model instances, joined to their groups """
+    data = dict((name, []) for name in export.COLUMNS)
+    for measure in Measure.objects.filter(
+            user_id__in=user_ids, group__category=MeasureGroup.real
+    ).select_related('group').order_by('user_id', 'date'):
+        data['user_id'].append(measure.group.user_id)
+        data['date'].append(measure.group.date)
+        data['measure_type'].append(measure.measure_type)
+        data['value'].append(measure.value)
+        data['unit'].append(measure.unit)
+        data['real_value'].append(measure.get_value())
+    return data
+
+
+def run(name, read, user_ids):
+    if tracemalloc:
+        tracemalloc.start()
+    start = time.time()
+    data = read(user_ids)
+    elapsed = time.time() - start
+    peak = ''
+    if tracemalloc:
+        peak = '{:>10.1f}MB peak'.format(
+            tracemalloc.get_traced_memory()[1] / 1024.0 / 1024)
+        tracemalloc.stop()
+    print('{:<10} {:>8} rows {:>8.2f}s {}'.format(
+        name, len(data['date']), elapsed, peak))
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    groups = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    connection.creation.create_test_db(verbosity=0)
+    user_ids = populate(users, groups)
+    run('objects', orm_objects, user_ids)
+    run('columns', export.columns, user_ids)
+    try:
+        import numpy  # noqa
+    except ImportError:
+        return
+    run('arrays', lambda ids: export.columns(ids, arrays=True), user_ids)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+Show query plans and timings for common measurement queries, with and
+without the composite indexes on ``MeasureGroup`` and ``Measure``.
+
+Usage::
+
+    python benchmarks/indexes.py [number of users] [groups per user]
+
+By default 1,000 users with 1,000 groups each are generated, giving a million
+groups and about 1.7 million measures.
+"""
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_settings')
+
+import django
+django.setup()
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.utils import timezone
+
+from nokiaapp.models import Measure, MeasureGroup
+
+
+START = datetime.datetime(2015, 1, 1, tzinfo=timezone.utc)
+
+
+def populate(users, groups):
+    random.seed(0)
+    User.objects.bulk_create([
+        User(username='user{}'.format(i)) for i in range(users)])
+    user_ids = list(User.objects.values_list('pk', flat=True))
+    group_table = MeasureGroup._meta.db_table
+    measure_table = Measure._meta.db_table
+    group_id = 0
+    with connection.cursor() as cursor:
+        for user_id in user_ids:
+            group_rows = []
+            measure_rows = []
+            for i in range(groups):
+                group_id += 1
+                date = START + datetime.timedelta(hours=i * 12)
+                # Every third group is a blood pressure reading
+                types = [9, 10, 11] if i % 3 == 0 else [1]
+                group_rows.append((group_id, user_id, i, 0, date, date, 1))
+                for t in types:
+                    value, unit = random.randint(50, 150), 0
+                    measure_rows.append((group_id, user_id, date, value, t,
+                                         unit, value * 10 ** unit))
+            cursor.executemany(
+                'INSERT INTO {} (id, user_id, grpid, attrib, date, '
+                'updatetime, category) VALUES (%s, %s, %s, %s, %s, %s, '
+                '%s)'.format(group_table), group_rows)
+            cursor.executemany(
+                'INSERT INTO {} (group_id, user_id, date, value, '
+                'measure_type, unit, real_value) VALUES (%s, %s, %s, %s, %s, '
+                '%s, %s)'.format(measure_table), measure_rows)
+    return user_ids
+
+
+def queries(user_id):
+    end = START + datetime.timedelta(days=60)
+    return [
+        ('latest weight (join)', Measure.objects.filter(
+            group__user_id=user_id, measure_type=Measure.weight
+        ).order_by('-group__date')[:1]),
+        ('latest weight (measure only)', Measure.objects.filter(
+            user_id=user_id, measure_type=Measure.weight
+        ).order_by('-date')[:1]),
+        ('groups in range', MeasureGroup.objects.filter(
+            user_id=user_id, category=MeasureGroup.real,
+            date__range=(START, end))),
+        ('blood pressure in range (join)', Measure.objects.filter(
+            group__user_id=user_id, group__date__range=(START, end),
+            measure_type__in=[Measure.diastolic_bp, Measure.systolic_bp])),
+        ('blood pressure in range (measure only)', Measure.objects.filter(
+            user_id=user_id, date__range=(START, end),
+            measure_type__in=[Measure.diastolic_bp, Measure.systolic_bp])),
+    ]
+
+
+def explain(queryset):
+    sql, params = queryset.query.sql_with_params()
+    prefix = ('EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite'
+              else 'EXPLAIN ')
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params)
+        return [' '.join(str(c) for c in row) for row in cursor.fetchall()]
+
+
+def run(title, user_ids):
+    print('\n== {} ==\n'.format(title))
+    sample = random.sample(user_ids, min(len(user_ids), 100))
+    for name, queryset in queries(sample[0]):
+        print(name)
+        for line in explain(queryset):
+            print('    ' + line)
+        start = time.time()
+        for user_id in sample:
+            list(dict(queries(user_id))[name])
+        print('    {:.3f}ms per query\n'.format(
+            (time.time() - start) * 1000 / len(sample)))
+
+
+def set_indexes(model, index_together):
+    with connection.schema_editor() as schema_editor:
+        schema_editor.alter_index_together(
+            model, model._meta.index_together, index_together)
+    model._meta.index_together = index_together
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    groups = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    connection.creation.create_test_db(verbosity=0)
+    start = time.time()
+    user_ids = populate(users, groups)
+    print('Generated {} groups and {} measures in {:.1f}s'.format(
+        MeasureGroup.objects.count(), Measure.objects.count(),
+        time.time() - start))
+
+    indexes = dict((model, model._meta.index_together)
+                   for model in (MeasureGroup, Measure))
+    for model in indexes:
+        set_indexes(model, ())
+    if connection.vendor == 'sqlite':
+        connection.cursor().execute('ANALYZE')
+    run('Without composite indexes', user_ids)
+    for model, index_together in indexes.items():
+        set_indexes(model, index_together)
+    if connection.vendor == 'sqlite':
+        connection.cursor().execute('ANALYZE')
+    run('With composite indexes', user_ids)
+
+
+if __name__ == '__main__':
+    main()
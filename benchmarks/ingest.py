@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Compare the original one-query-per-row ingest with the bulk ingest done by
+:py:meth:`nokiaapp.models.MeasureGroup.create_from_measures`.
+
+Usage::
+
+    python benchmarks/ingest.py [number of groups]
+
+A synthetic ``NokiaMeasures`` payload (50,000 groups by default) is ingested
+into a fresh test database by each path, and the number of queries issued and
+the wall time are reported.
+"""
+import os
+import random
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_settings')
+
+import django
+django.setup()
+
+from django.contrib.auth.models import User
+from django.db import connection
+from nokia import NokiaMeasures
+
+from nokiaapp.models import Measure, MeasureGroup
+
+
+def make_measures(count):
+    random.seed(0)
+    groups = []
+    for i in range(count):
+        measures = [{'value': random.randint(50000, 120000), 'type': 1,
+                     'unit': -3}]
+        if i % 3 == 0:
+            measures += [{'value': random.randint(100, 400), 'type': 6,
+                          'unit': -1},
+                         {'value': random.randint(5000, 40000), 'type': 8,
+                          'unit': -3}]
+        groups.append({'grpid': i + 1, 'attrib': 0, 'category': 1,
+                       'date': 1222930968 + i * 3600,
+                       'measures': measures})
+    return NokiaMeasures({'updatetime': 1249409679, 'measuregrps': groups})
+
+
+def row_by_row(user, measures):
+    """ The ingest loop as it was before bulk inserts """
+    for nokia_measure in measures:
+        if MeasureGroup.objects.filter(grpid=nokia_measure.grpid,
+                                       user=user).exists():
+            continue
+        measure_grp = MeasureGroup.objects.create(
+            user=user, grpid=nokia_measure.grpid,
+            attrib=nokia_measure.attrib,
+            category=nokia_measure.category,
+            date=nokia_measure.date.datetime,
+            updatetime=measures.updatetime.datetime)
+        for measure in nokia_measure.measures:
+            Measure.objects.create(
+                group=measure_grp, value=measure['value'],
+                measure_type=measure['type'], unit=measure['unit'])
+
+
+def bulk(user, measures):
+    MeasureGroup.create_from_measures(user, measures)
+
+
+def run(name, ingest, user, measures):
+    MeasureGroup.objects.all().delete()
+    # Log every query, not just the last 9000
+    connection.queries_log = deque()
+    connection.force_debug_cursor = True
+    start = time.time()
+    ingest(user, measures)
+    elapsed = time.time() - start
+    connection.force_debug_cursor = False
+    print('{:<12} {:>10} queries {:>10.2f}s  ({} groups, {} measures)'.format(
+        name, len(connection.queries_log), elapsed,
+        MeasureGroup.objects.count(), Measure.objects.count()))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    connection.creation.create_test_db(verbosity=0)
+    user = User.objects.create_user('bench', 'bench@example.com', 'bench')
+    measures = make_measures(count)
+    run('row-by-row', row_by_row, user, measures)
+    run('bulk', bulk, user, measures)
+
+
+if __name__ == '__main__':
+    main()
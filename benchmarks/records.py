@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Compare preparing measure groups for storage as ``NokiaMeasureGroup``
+objects, as ``MeasureGroup.create_from_measures`` used to, with the
+:py:class:`nokiaapp.records.GroupRecord` objects it now uses.
+
+Usage::
+
+    python benchmarks/records.py [number of groups]
+
+The decoded groups of a synthetic response (100,000 by default) are turned
+into objects and the dates of their groups and measures into datetimes, in
+batches of :ref:`NOKIA_BATCH_SIZE` groups, without touching the database.
+The CPU time per group and, on Python 3, the memory taken by a batch of
+objects are reported.
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_settings')
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2.x
+    tracemalloc = None
+# Python 2.x has no process_time
+cpu_time = getattr(time, 'process_time', time.clock)
+
+import django
+django.setup()
+
+from nokia import NokiaMeasureGroup
+
+from nokiaapp.models import _chunks
+from nokiaapp.records import GroupRecord, to_datetimes
+from nokiaapp.utils import get_setting
+
+
+def make_groups(count):
+    random.seed(0)
+    groups = []
+    for i in range(count):
+        measures = [{'value': random.randint(50000, 120000), 'type': 1,
+                     'unit': -3}]
+        if i % 3 == 0:
+            measures += [{'value': random.randint(100, 400), 'type': 6,
+                          'unit': -1},
+                         {'value': random.randint(5000, 40000), 'type': 8,
+                          'unit': -3}]
+        groups.append({'grpid': i + 1, 'attrib': 0, 'category': 1,
+                       'date': 1222930968 + i * 3600,
+                       'measures': measures})
+    return groups
+
+
+def objects(batch):
+    """ The groups and dates as they were prepared before records """
+    groups = [NokiaMeasureGroup(data) for data in batch]
+    dates = [group.date.datetime for group in groups]
+    dates += [group.date.datetime
+              for group in groups for measure in group.measures]
+    return groups, dates
+
+
+def records(batch):
+    groups = [GroupRecord.from_data(data) for data in batch]
+    return groups, to_datetimes(group.date for group in groups)
+
+
+def run(name, prepare, groups, batch_size):
+    start = cpu_time()
+    for batch in _chunks(groups, batch_size):
+        prepare(batch)
+    elapsed = cpu_time() - start
+    size = ''
+    if tracemalloc:
+        tracemalloc.start()
+        prepared = prepare(groups[:batch_size])
+        size = '{:>10.1f}KB per batch'.format(
+            tracemalloc.get_traced_memory()[0] / 1024.0)
+        del prepared
+        tracemalloc.stop()
+    print('{:<8} {:>10.1f}us per group {}'.format(
+        name, elapsed * 1e6 / len(groups), size))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    batch_size = get_setting('NOKIA_BATCH_SIZE')
+    groups = make_groups(count)
+    print('{} groups, in batches of {}'.format(count, batch_size))
+    run('objects', objects, groups, batch_size)
+    run('records', records, groups, batch_size)
+
+
+if __name__ == '__main__':
+    main()
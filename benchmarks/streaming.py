@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Compare parsing a ``getmeas`` response in one go, as ``NokiaApi`` does, with
+the incremental parsing of :py:mod:`nokiaapp.streaming`.
+
+Usage::
+
+    python benchmarks/streaming.py [--store] [MB ...]
+
+A response of each size in megabytes (25, 100 and 300 by default) is
+written to a temporary file, then read with each parser, which only iterate
+over the groups unless ``--store`` is given, in which case the groups are
+stored with ``MeasureGroup.create_from_measures``. The wall time and, on
+Python 3, the peak memory allocated by each parser are reported. Reading
+whole responses takes about ten times their size in memory, so it is skipped
+above 100MB.
+
+The streamed parser's peak doesn't depend on the size of the response, but
+storing still keeps some bookkeeping for each group (the group IDs already
+seen), and the rollups read back the measures of the range stored.
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_settings')
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2.x
+    tracemalloc = None
+
+import django
+django.setup()
+
+from django.contrib.auth.models import User
+from django.db import connection
+from nokia import NokiaMeasures
+
+from nokiaapp.models import MeasureGroup
+from nokiaapp.streaming import CHUNK_SIZE, StreamedMeasures
+
+
+# Responses above this many megabytes aren't read in one go
+LOADED_MAX_MB = 100
+
+
+def write_response(f, megabytes):
+    """ Write a response of about ``megabytes`` to ``f`` """
+    random.seed(0)
+    f.write(b'{"status": 0, "body": {"updatetime": 1249409679, '
+            b'"timezone": "Europe/Paris", "measuregrps": [')
+    grpid = 0
+    while f.tell() < megabytes * 1024 * 1024:
+        measures = [{'value': random.randint(50000, 120000), 'type': 1,
+                     'unit': -3}]
+        if grpid % 3 == 0:
+            measures.append({'value': random.randint(100, 400), 'type': 6,
+                             'unit': -1})
+        f.write((',' if grpid else '').encode() + json.dumps({
+            'grpid': grpid, 'attrib': 0, 'date': 1222930968 + grpid * 60,
+            'category': 1, 'measures': measures}).encode())
+        grpid += 1
+    f.write(b'], "more": 0, "offset": 0}}')
+    return grpid
+
+
+def loaded(f):
+    """ The whole response read, decoded and wrapped at once """
+    response = json.loads(f.read().decode())
+    return NokiaMeasures(response['body'])
+
+
+def streamed(f):
+    return StreamedMeasures(iter(lambda: f.read(CHUNK_SIZE), b''))
+
+
+def run(name, parse, path, store):
+    if tracemalloc:
+        tracemalloc.start()
+    start = time.time()
+    with open(path, 'rb') as f:
+        measures = parse(f)
+        if store:
+            user = User.objects.create_user('user{}'.format(time.time()))
+            groups = MeasureGroup.create_from_measures(user, measures)
+        else:
+            groups = sum(1 for group in measures)
+    elapsed = time.time() - start
+    peak = ''
+    if tracemalloc:
+        peak = '{:>10.1f}MB peak'.format(
+            tracemalloc.get_traced_memory()[1] / 1024.0 / 1024)
+        tracemalloc.stop()
+    print('{:<10} {:>9} groups {:>8.2f}s {}'.format(
+        name, groups, elapsed, peak))
+
+
+def main():
+    store = '--store' in sys.argv
+    sizes = [int(arg) for arg in sys.argv[1:] if arg != '--store']
+    if store:
+        connection.creation.create_test_db(verbosity=0)
+    for megabytes in sizes or [25, 100, 300]:
+        fd, path = tempfile.mkstemp(suffix='.json')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                groups = write_response(f, megabytes)
+            print('{}MB response, {} groups'.format(megabytes, groups))
+            if megabytes <= LOADED_MAX_MB:
+                run('loaded', loaded, path, store)
+            run('streamed', streamed, path, store)
+        finally:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
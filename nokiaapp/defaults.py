@@ -22,3 +22,80 @@ NOKIA_ERROR_TEMPLATE = 'nokia/error.html'
 # called with the request as the only parameter to get the final value for the
 # message.
 NOKIA_DECORATOR_MESSAGE = 'This page requires Nokia integration.'
+
+# The number of measure groups stored per bulk insert when ingesting data
+# from Nokia.
+NOKIA_BATCH_SIZE = 500
+
+# The class used to run work, such as processing notifications, outside of
+# the request. One of 'nokiaapp.jobs.ThreadPoolBackend',
+# 'nokiaapp.jobs.DatabaseBackend' or 'nokiaapp.jobs.ImmediateBackend'.
+NOKIA_JOB_BACKEND = 'nokiaapp.jobs.ThreadPoolBackend'
+
+# The number of threads used by the thread pool job backend.
+NOKIA_JOB_WORKERS = 4
+
+# How many seconds the database job backend lets a worker run a job before
+# assuming the worker died and running the job again.
+NOKIA_JOB_LEASE = 3600
+
+# How many seconds to wait before processing a notification. Notifications
+# for the same Nokia user received in the meantime are handled by the same
+# fetch.
+NOKIA_NOTIFICATION_WINDOW = 10
+
+# The name of the Django cache used for counters and other shared state.
+NOKIA_CACHE = 'default'
+
+# The maximum number of requests per second made to the Nokia API, or None
+# for no limit. Bursts of up to NOKIA_RATE_LIMIT_BURST requests are allowed
+# (NOKIA_RATE_LIMIT by default). The limit applies to each process, unless
+# NOKIA_RATE_LIMIT_SHARED is True, in which case it is shared through the
+# NOKIA_CACHE cache.
+NOKIA_RATE_LIMIT = None
+NOKIA_RATE_LIMIT_BURST = None
+NOKIA_RATE_LIMIT_SHARED = False
+
+# How many times to retry requests to the Nokia API that failed with HTTP 429,
+# a 5xx status or one of the NOKIA_RETRY_STATUSES Nokia status codes, and the
+# base and maximum number of seconds for the exponential backoff between
+# attempts.
+NOKIA_MAX_RETRIES = 3
+NOKIA_RETRY_BACKOFF = 0.5
+NOKIA_RETRY_BACKOFF_MAX = 30
+NOKIA_RETRY_STATUSES = (601, 2555)
+
+# The maximum number of connections kept alive to each Nokia host, and how
+# many times to retry requests that fail to connect.
+NOKIA_HTTP_POOL_SIZE = 10
+NOKIA_HTTP_RETRIES = 2
+
+# How many seconds to wait for Nokia to respond to a request, or None to wait
+# indefinitely.
+NOKIA_HTTP_TIMEOUT = 30
+
+# How many seconds to cache whether a user is integrated with Nokia between
+# requests, or None to not cache it. The cache is cleared when a user's
+# NokiaUser is saved or deleted.
+NOKIA_INTEGRATION_CACHE_TIMEOUT = None
+
+# Access tokens expiring within this many seconds are refreshed by the
+# nokia_refresh_tokens command.
+NOKIA_TOKEN_REFRESH_WINDOW = 600
+
+# Nokia profiles are cached, and refreshed in the background when they were
+# cached more than this many seconds ago.
+NOKIA_PROFILE_CACHE_TIMEOUT = 3600
+
+# Subscribing a user to notifications, or unsubscribing them, gives up on the
+# calls to Nokia still running after this many seconds.
+NOKIA_SUBSCRIPTION_TIMEOUT = 60
+
+# When a user connects, their measurement history is imported in the
+# background, in windows from the newest to the oldest, back to the
+# NOKIA_IMPORT_START Unix timestamp (2009-01-01 by default). The first window
+# is NOKIA_IMPORT_WINDOW days, the following ones are sized to return about
+# NOKIA_FETCH_GROUPS measure groups each.
+NOKIA_IMPORT_WINDOW = 90
+NOKIA_IMPORT_START = 1230768000
+NOKIA_FETCH_GROUPS = 500
@@ -0,0 +1,142 @@
+"""
+Column-oriented exports of measurement histories for analysis, read
+straight from database cursors without creating model instances.
+
+NumPy arrays and pandas DataFrames are optional, and need those packages
+installed (``pip install django-nokia[export]``).
+"""
+from django.conf import settings
+from django.db.models import Q
+
+from .models import Measure, MeasureGroup, _chunks
+from .utils import get_setting
+
+
+COLUMNS = ('user_id', 'date', 'measure_type', 'value', 'unit', 'real_value')
+# The names and lookups of the fields in exported files
+EXPORT_FIELDS = (
+    ('grpid', 'group__grpid'),
+    ('date', 'date'),
+    ('attrib', 'group__attrib'),
+    ('category', 'group__category'),
+    ('measure_type', 'measure_type'),
+    ('value', 'value'),
+    ('unit', 'unit'),
+    ('real_value', 'real_value'),
+)
+
+
+def _user_ids(users):
+    for user in users:
+        yield getattr(user, 'pk', user)
+
+
+def iter_rows(users, measure_types=None, start=None, end=None,
+              category=MeasureGroup.real, batch_size=None):
+    """
+    Yield lists of measure rows, one list per ``batch_size`` users
+    (:ref:`NOKIA_BATCH_SIZE` by default), each row a tuple of the
+    :py:data:`COLUMNS` values. ``users`` are users or user IDs.
+
+    Rows are ordered by user and date, and only measures of
+    ``measure_types`` dated from ``start`` to ``end`` inclusive, in groups
+    of ``category`` (real measurements by default, None for all), are
+    included.
+    """
+    if batch_size is None:
+        batch_size = get_setting('NOKIA_BATCH_SIZE')
+    qs = Measure.objects.all()
+    if measure_types is not None:
+        qs = qs.filter(measure_type__in=measure_types)
+    if start is not None:
+        qs = qs.filter(date__gte=start)
+    if end is not None:
+        qs = qs.filter(date__lte=end)
+    if category is not None:
+        qs = qs.filter(group__category=category)
+    qs = qs.order_by('user_id', 'date').values_list(*COLUMNS)
+    for user_ids in _chunks(_user_ids(users), batch_size):
+        rows = list(qs.filter(user_id__in=user_ids).iterator())
+        if rows:
+            yield rows
+
+
+def stream(user, fields, measure_types=None, start=None, end=None,
+           category=None, batch_size=None, before=None):
+    """
+    Yield ``fields`` of the ``user``'s measures as tuples, ordered by date,
+    optionally filtered as in :py:func:`iter_rows`, and to those dated
+    before ``before``, exclusive.
+
+    Measures are read ``batch_size`` at a time (:ref:`NOKIA_BATCH_SIZE` by
+    default), each batch starting after the last date and ID of the
+    previous one, so memory use doesn't grow with the size of the history,
+    even on databases without server-side cursors.
+    """
+    if batch_size is None:
+        batch_size = get_setting('NOKIA_BATCH_SIZE')
+    qs = Measure.objects.filter(user=getattr(user, 'pk', user))
+    if measure_types is not None:
+        qs = qs.filter(measure_type__in=measure_types)
+    if start is not None:
+        qs = qs.filter(date__gte=start)
+    if end is not None:
+        qs = qs.filter(date__lte=end)
+    if before is not None:
+        qs = qs.filter(date__lt=before)
+    if category is not None:
+        qs = qs.filter(group__category=category)
+    qs = qs.order_by('date', 'pk').values_list('date', 'pk', *fields)
+    batch = qs[:batch_size]
+    while True:
+        rows = list(batch)
+        for row in rows:
+            yield row[2:]
+        if len(rows) < batch_size:
+            return
+        date, pk = rows[-1][:2]
+        batch = qs.filter(
+            Q(date__gt=date) | Q(date=date, pk__gt=pk))[:batch_size]
+
+
+def columns(users, arrays=False, **kwargs):
+    """
+    A dict of the :py:data:`COLUMNS` of the users' measures, each a list of
+    values, or a NumPy array if ``arrays`` is True. Dates are UTC
+    ``datetime64`` values in arrays. Other arguments are passed on to
+    :py:func:`iter_rows`.
+    """
+    data = dict((name, []) for name in COLUMNS)
+    for rows in iter_rows(users, **kwargs):
+        for name, values in zip(COLUMNS, zip(*rows)):
+            data[name].extend(values)
+    if not arrays:
+        return data
+
+    import numpy
+    if settings.USE_TZ:
+        # The database returns UTC datetimes, which NumPy can't take directly
+        data['date'] = [date.replace(tzinfo=None) for date in data['date']]
+    data['date'] = numpy.array(data['date'], dtype='datetime64[us]')
+    for name, dtype in (('user_id', 'int64'), ('measure_type', 'int16'),
+                        ('value', 'int64'), ('unit', 'int8'),
+                        ('real_value', 'float64')):
+        data[name] = numpy.array(data[name], dtype=dtype)
+    return data
+
+
+def dataframe(users, pivot=True, **kwargs):
+    """
+    A pandas DataFrame of the users' measures. If ``pivot`` is True, it is
+    indexed by user ID and date with a column of real values for each
+    measure type. Otherwise it has the :py:data:`COLUMNS`, one row per
+    measure. Other arguments are passed on to :py:func:`iter_rows`.
+    """
+    import pandas
+    frame = pandas.DataFrame(columns(users, arrays=True, **kwargs),
+                             columns=COLUMNS)
+    if not pivot:
+        return frame
+    return frame.pivot_table(index=['user_id', 'date'],
+                             columns='measure_type', values='real_value',
+                             aggfunc='last')
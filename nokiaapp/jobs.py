@@ -0,0 +1,225 @@
+"""
+Backends for running work, such as processing Nokia notifications, outside
+of the request/response cycle.
+
+The backend is chosen with the :ref:`NOKIA_JOB_BACKEND` setting. Jobs are
+identified by the dotted path of a function in :py:mod:`nokiaapp.tasks`
+and the keyword arguments to call it with, which must be JSON serializable.
+
+Jobs can be given a key and a delay. While a job is waiting to run, any job
+queued with the same key is merged into it (see :py:func:`merge_kwargs`)
+instead of being run separately.
+"""
+import datetime
+import json
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import utils
+from .models import NokiaJob
+
+
+logger = logging.getLogger(__name__)
+
+# Arguments that aren't kept with failed jobs, at any depth
+SECRET_KWARGS = ('access_token', 'refresh_token')
+
+
+def enqueue(task, kwargs=None, key=None, delay=0):
+    """
+    Run the ``task`` function with ``kwargs`` using the job backend, after
+    waiting ``delay`` seconds. If a job with the same ``key`` is already
+    waiting, the two are merged.
+    """
+    return get_backend().enqueue(task, kwargs or {}, key=key, delay=delay)
+
+
+def on_commit(func):
+    """
+    Call ``func`` once the current transaction is committed, or right away
+    outside of a transaction. On Django 1.8, which can't wait for the
+    commit, ``func`` is always called right away.
+    """
+    if hasattr(transaction, 'on_commit'):
+        transaction.on_commit(func)
+    else:
+        func()
+
+
+def get_backend():
+    """ Returns an instance of the :ref:`NOKIA_JOB_BACKEND` class """
+    path = utils.get_setting('NOKIA_JOB_BACKEND')
+    with _backends_lock:
+        if path not in _backends:
+            _backends[path] = import_string(path)()
+        return _backends[path]
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def run_task(task, kwargs):
+    return import_string(task)(**kwargs)
+
+
+def merge_kwargs(old, new):
+    """
+    Combine the arguments of two jobs with the same key. Values from ``new``
+    win, except that the ``startdate`` and ``enddate`` arguments are widened
+    to cover both jobs. If either job has no bound, the result has none.
+    """
+    merged = dict(old, **new)
+    for name, widest in (('startdate', min), ('enddate', max)):
+        if name in old and name in new:
+            merged[name] = widest(old[name], new[name])
+        else:
+            merged.pop(name, None)
+    return merged
+
+
+def scrub_kwargs(kwargs):
+    """
+    A copy of the arguments of a job with the values of
+    :py:data:`SECRET_KWARGS` removed, in nested dicts too
+    """
+    if isinstance(kwargs, dict):
+        return dict(
+            (name, '' if name in SECRET_KWARGS else scrub_kwargs(value))
+            for name, value in kwargs.items())
+    if isinstance(kwargs, list):
+        return [scrub_kwargs(value) for value in kwargs]
+    return kwargs
+
+
+class ImmediateBackend(object):
+    """
+    Runs jobs right away, in the calling thread, ignoring keys and delays.
+    Useful for testing.
+    """
+
+    def enqueue(self, task, kwargs, key=None, delay=0):
+        run_task(task, kwargs)
+
+
+class ThreadPoolBackend(object):
+    """
+    Runs jobs in a pool of :ref:`NOKIA_JOB_WORKERS` threads within the
+    current process. Jobs queued in a transaction are only submitted once it
+    is committed (see :py:func:`on_commit`), so that they see what it wrote,
+    and dropped if it is rolled back. Jobs that haven't run are lost if the
+    process exits.
+    """
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(
+            max_workers=utils.get_setting('NOKIA_JOB_WORKERS'))
+        self.waiting = {}
+        self.lock = threading.Lock()
+
+    def enqueue(self, task, kwargs, key=None, delay=0):
+        """
+        Returns the future of a job without a key or delay, if it was
+        submitted right away
+        """
+        futures = []
+        on_commit(lambda: futures.append(
+            self.submit(task, kwargs, key=key, delay=delay)))
+        return futures[0] if futures else None
+
+    def submit(self, task, kwargs, key=None, delay=0):
+        if key is None:
+            if not delay:
+                return self.executor.submit(self.run, task, kwargs)
+            timer = threading.Timer(
+                delay, self.executor.submit, [self.run, task, kwargs])
+        else:
+            key = (task, key)
+            with self.lock:
+                if key in self.waiting:
+                    self.waiting[key] = merge_kwargs(
+                        self.waiting[key], kwargs)
+                    return
+                self.waiting[key] = kwargs
+            timer = threading.Timer(delay, self.submit_waiting, [key])
+        timer.daemon = True
+        timer.start()
+
+    def submit_waiting(self, key):
+        with self.lock:
+            kwargs = self.waiting.pop(key)
+        self.executor.submit(self.run, key[0], kwargs)
+
+    def run(self, task, kwargs):
+        try:
+            return run_task(task, kwargs)
+        except Exception:
+            logger.exception("Error running job %s", task)
+        finally:
+            # Each worker thread has its own database connections
+            connections.close_all()
+
+
+class DatabaseBackend(object):
+    """
+    Stores jobs in the :py:class:`nokiaapp.models.NokiaJob` table, to be run
+    by the ``nokia_worker`` management command. Jobs queued in a transaction
+    are stored in it, so workers only see them once it is committed, and
+    they are dropped if it is rolled back.
+    """
+
+    def enqueue(self, task, kwargs, key=None, delay=0):
+        if key is not None:
+            for job in NokiaJob.objects.filter(
+                    task=task, key=key, started__isnull=True):
+                merged = merge_kwargs(json.loads(job.kwargs), kwargs)
+                # Only merge if no worker has claimed the job meanwhile
+                if NokiaJob.objects.filter(
+                        pk=job.pk, started__isnull=True
+                ).update(kwargs=json.dumps(merged)):
+                    return job
+        return NokiaJob.objects.create(
+            task=task, kwargs=json.dumps(kwargs), key=key or '',
+            run_after=timezone.now() + datetime.timedelta(seconds=delay))
+
+    def run_pending(self, limit=None):
+        """
+        Run queued jobs that are due in the order they were added, and return
+        how many were run. Jobs claimed more than :ref:`NOKIA_JOB_LEASE`
+        seconds ago that haven't finished are run again, as their worker is
+        assumed to have died. Failed jobs are kept with their error for
+        inspection, without the credentials in their arguments (see
+        :py:func:`scrub_kwargs`).
+        """
+        count = 0
+        now = timezone.now()
+        expired = now - datetime.timedelta(
+            seconds=utils.get_setting('NOKIA_JOB_LEASE'))
+        for job in NokiaJob.objects.filter(
+                Q(started__isnull=True, run_after__lte=now) |
+                # The worker running the job died
+                Q(started__lt=expired, error='')
+        ).order_by('created', 'pk')[:limit]:
+            # Claim the job, in case another worker got to it first
+            claimed = NokiaJob.objects.filter(
+                pk=job.pk, started=job.started
+            ).update(started=timezone.now())
+            if not claimed:
+                continue
+            kwargs = json.loads(job.kwargs)
+            try:
+                run_task(job.task, kwargs)
+            except Exception as e:
+                logger.exception("Error running job %s", job.task)
+                NokiaJob.objects.filter(pk=job.pk).update(
+                    error=repr(e), kwargs=json.dumps(scrub_kwargs(kwargs)))
+            else:
+                NokiaJob.objects.filter(pk=job.pk).delete()
+            count += 1
+        return count
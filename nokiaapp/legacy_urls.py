@@ -10,6 +10,10 @@ urlpatterns = [
     url(r'^error/$', views.error, name='withings-error'),
     url(r'^logout/$', views.logout, name='withings-logout'),
 
+    # Measurement history
+    url(r'^export/$', views.export, name='withings-export'),
+    url(r'^import/$', views.import_status, name='withings-import-status'),
+
     # Subscriber callback for notifications
     url(r'^notification/(?P<appli>[14])/$', views.notification,
         name='withings-notification')
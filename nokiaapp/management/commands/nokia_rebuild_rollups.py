@@ -0,0 +1,41 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from nokiaapp import rollups
+from nokiaapp.models import Measure
+from nokiaapp.utils import parallel_map
+
+
+class Command(BaseCommand):
+    help = 'Recompute the daily and weekly rollups of Nokia measures'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user', type=int, action='append', dest='users', default=None,
+            metavar='ID',
+            help='Only rebuild the rollups of the user with this ID. May be '
+                 'given more than once.')
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='The number of users to rebuild at the same time')
+
+    def handle(self, *args, **options):
+        user_ids = options['users']
+        if user_ids is None:
+            user_ids = list(Measure.objects.order_by().values_list(
+                'user_id', flat=True).distinct())
+        results = parallel_map(self.rebuild, user_ids, options['workers'])
+        failed = results.count(False)
+        if options['verbosity']:
+            self.stdout.write(
+                'Rebuilt rollups for {} user(s), {} failed'.format(
+                    len(results) - failed, failed))
+
+    def rebuild(self, user_id):
+        try:
+            rollups.rebuild(get_user_model().objects.get(pk=user_id))
+        except Exception as e:
+            self.stderr.write('Error rebuilding user {}: {!r}'.format(
+                user_id, e))
+            return False
+        return True
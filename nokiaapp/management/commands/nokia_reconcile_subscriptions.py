@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.core.urlresolvers import reverse
+
+from nokiaapp import subscriptions
+
+
+class Command(BaseCommand):
+    help = ("Compare the recorded notification subscriptions of Nokia users "
+            "with Nokia's, and repair the differences")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user', type=int, action='append', dest='users', default=None,
+            metavar='ID',
+            help='Only reconcile the user with this ID. May be given more '
+                 'than once.')
+        parser.add_argument(
+            '--workers', type=int, default=4,
+            help='The number of users to reconcile at the same time')
+        parser.add_argument(
+            '--base-url', default=None, metavar='URL',
+            help='Subscribe every user to the notification URLs of the site '
+                 'at this URL, e.g. https://example.com, and to no others')
+
+    def handle(self, *args, **options):
+        callback_urls = None
+        if options['base_url']:
+            callback_urls = [
+                (appli, options['base_url'].rstrip('/') + reverse(
+                    'nokia-notification', kwargs={'appli': appli}))
+                for appli in subscriptions.APPLIS
+            ]
+        totals = subscriptions.reconcile(
+            users=options['users'], callback_urls=callback_urls,
+            workers=options['workers'])
+        if options['verbosity']:
+            self.stdout.write(
+                'Checked {checked} user(s) ({failed} failed): {subscribed} '
+                'subscribed, {unsubscribed} unsubscribed, {recorded} '
+                'recorded'.format(**totals))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from nokiaapp.tasks import refresh_expiring_tokens
+
+
+class Command(BaseCommand):
+    help = 'Refresh the Nokia access tokens that are about to expire'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--window', type=int, default=None, metavar='SECONDS',
+            help='Refresh tokens expiring within this many seconds. Defaults '
+                 'to NOKIA_TOKEN_REFRESH_WINDOW.')
+        parser.add_argument(
+            '--workers', type=int, default=None,
+            help='The number of tokens to refresh at the same time. Defaults '
+                 'to NOKIA_JOB_WORKERS.')
+        parser.add_argument(
+            '--batch-size', type=int, default=None,
+            help='The number of users to load at a time. Defaults to '
+                 'NOKIA_BATCH_SIZE.')
+
+    def handle(self, *args, **options):
+        refreshed, failed = refresh_expiring_tokens(
+            window=options['window'], workers=options['workers'],
+            batch_size=options['batch_size'])
+        if options['verbosity']:
+            self.stdout.write('Refreshed {} token(s), {} failed'.format(
+                refreshed, failed))
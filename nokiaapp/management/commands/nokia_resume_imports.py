@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from nokiaapp.tasks import resume_imports
+
+
+class Command(BaseCommand):
+    help = 'Carry on with the history imports that stalled'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--failed', action='store_true', default=False,
+            help='Carry on with the imports that failed as well.')
+
+    def handle(self, *args, **options):
+        resumed = resume_imports(failed=options['failed'])
+        if options['verbosity']:
+            self.stdout.write('Resumed {} import(s)'.format(resumed))
@@ -0,0 +1,89 @@
+import os
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+
+from nokiaapp.models import NokiaUser
+from nokiaapp.ratelimit import TokenBucket
+from nokiaapp.tasks import update_history, update_measures
+from nokiaapp.utils import parallel_map
+
+
+class Command(BaseCommand):
+    help = "Retrieve and store measures for all Nokia users"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=4,
+            help='The number of users to sync at the same time')
+        parser.add_argument(
+            '--rate', type=float, default=None,
+            help='The maximum number of users to sync per second')
+        parser.add_argument(
+            '--checkpoint', default=None, metavar='FILE',
+            help='Record synced users in this file, and skip the users it '
+                 'lists. The file is removed once all users are synced.')
+        parser.add_argument(
+            '--full', action='store_true', default=False,
+            help="Retrieve each user's entire history, rather than the "
+                 "measures updated since their last update")
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        self.full = options['full']
+        self.limiter = options['rate'] and TokenBucket(options['rate'])
+        self.lock = threading.Lock()
+        self.checkpoint = options['checkpoint']
+        done = set()
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            with open(self.checkpoint) as f:
+                done = set(int(line) for line in f if line.strip())
+        pks = [pk for pk in NokiaUser.objects.order_by('pk').values_list(
+            'pk', flat=True) if pk not in done]
+        if done and self.verbosity:
+            self.stdout.write('Resuming, skipping {} synced user(s)'.format(
+                len(done)))
+
+        start = time.time()
+        results = parallel_map(self.sync, pks, options['workers'])
+        elapsed = time.time() - start
+
+        failed = results.count(None)
+        groups = sum(r for r in results if r)
+        if self.checkpoint and not failed and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+        if self.verbosity:
+            self.stdout.write(
+                'Synced {} user(s) ({} failed), {} measure group(s) in '
+                '{:.2f}s: {:.2f} users/s, {:.2f} groups/s'.format(
+                    len(results) - failed, failed, groups, elapsed,
+                    len(results) / elapsed if elapsed else 0,
+                    groups / elapsed if elapsed else 0))
+
+    def sync(self, pk):
+        """
+        Sync one user, returning the number of measure groups written or None
+        if the sync failed
+        """
+        if self.limiter:
+            self.limiter.acquire()
+        start = time.time()
+        try:
+            nokia_user = NokiaUser.objects.select_related('user').get(pk=pk)
+            lastupdate = nokia_user.sync_cursor or nokia_user.last_update
+            if lastupdate and not self.full:
+                written = update_measures(nokia_user, lastupdate=lastupdate)
+            else:
+                written = update_history(nokia_user)
+        except Exception as e:
+            self.stderr.write('Error syncing user {}: {!r}'.format(pk, e))
+            return None
+        if self.verbosity > 1:
+            self.stdout.write('User {}: {} measure group(s) in {:.2f}s'.format(
+                pk, written, time.time() - start))
+        if self.checkpoint:
+            with self.lock:
+                with open(self.checkpoint, 'a') as f:
+                    f.write('{}\n'.format(pk))
+        return written
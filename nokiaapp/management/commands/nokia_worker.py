@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from nokiaapp.jobs import DatabaseBackend
+
+
+class Command(BaseCommand):
+    help = 'Run the jobs queued by the nokiaapp.jobs.DatabaseBackend'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--poll', type=float, default=None, metavar='SECONDS',
+            help='Keep running, checking for new jobs at this interval. By '
+                 'default the command exits once the queue is empty.')
+        parser.add_argument(
+            '--limit', type=int, default=100,
+            help='The maximum number of jobs to fetch at a time')
+
+    def handle(self, *args, **options):
+        backend = DatabaseBackend()
+        while True:
+            count = backend.run_pending(limit=options['limit'])
+            if count:
+                if options['verbosity'] > 1:
+                    self.stdout.write('Ran {} job(s)'.format(count))
+                continue
+            if options['poll'] is None:
+                break
+            time.sleep(options['poll'])
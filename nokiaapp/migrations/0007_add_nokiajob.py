@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-17 22:08
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nokiaapp', '0006_remove_nokiauser_access_token_secret'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NokiaJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task', models.CharField(help_text='Dotted path of the function to call', max_length=255)),
+                ('kwargs', models.TextField(help_text='JSON encoded keyword arguments for the function')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True, help_text='The datetime the job was queued')),
+                ('started', models.DateTimeField(blank=True, db_index=True, help_text='The datetime a worker picked up the job', null=True)),
+                ('error', models.TextField(blank=True, help_text='The error raised if the job failed')),
+            ],
+        ),
+    ]
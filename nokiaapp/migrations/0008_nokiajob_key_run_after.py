@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-17 22:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nokiaapp', '0007_add_nokiajob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='nokiajob',
+            name='key',
+            field=models.CharField(blank=True, db_index=True, help_text='Jobs with the same key are merged while waiting to run', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='nokiajob',
+            name='run_after',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, help_text='The job is not run before this datetime'),
+        ),
+    ]
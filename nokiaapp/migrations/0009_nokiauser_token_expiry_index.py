@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-17 22:17
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nokiaapp', '0008_nokiajob_key_run_after'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='nokiauser',
+            name='token_expiry',
+            field=models.IntegerField(db_index=True, help_text='Token expiration timestamp'),
+        ),
+    ]
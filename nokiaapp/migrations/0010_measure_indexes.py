@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-17 22:20
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_group_fields(apps, schema_editor):
+    """ Copy each measure's user and date from its group """
+    Measure = apps.get_model('nokiaapp', 'Measure')
+    MeasureGroup = apps.get_model('nokiaapp', 'MeasureGroup')
+    quote = schema_editor.quote_name
+    schema_editor.execute(
+        'UPDATE {measure} SET {user_id} = (SELECT {user_id} FROM {group} '
+        'WHERE {group}.{id} = {measure}.{group_id}), {date} = (SELECT {date} '
+        'FROM {group} WHERE {group}.{id} = {measure}.{group_id})'.format(
+            measure=quote(Measure._meta.db_table),
+            group=quote(MeasureGroup._meta.db_table),
+            id=quote('id'), user_id=quote('user_id'),
+            group_id=quote('group_id'), date=quote('date')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('nokiaapp', '0009_nokiauser_token_expiry_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='measure',
+            name='date',
+            field=models.DateTimeField(help_text="The datetime of the measurement, the same as its group's", null=True),
+        ),
+        migrations.AddField(
+            model_name='measure',
+            name='user',
+            field=models.ForeignKey(help_text="The measurement's user, the same as its group's", null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(copy_group_fields, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='measure',
+            name='date',
+            field=models.DateTimeField(help_text="The datetime of the measurement, the same as its group's"),
+        ),
+        migrations.AlterField(
+            model_name='measure',
+            name='user',
+            field=models.ForeignKey(help_text="The measurement's user, the same as its group's", on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterIndexTogether(
+            name='measure',
+            index_together=set([('group', 'measure_type'), ('user', 'measure_type', 'date')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='measuregroup',
+            index_together=set([('user', 'date'), ('user', 'category', 'date')]),
+        ),
+    ]
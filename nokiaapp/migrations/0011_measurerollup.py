@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-17 22:24
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('nokiaapp', '0010_measure_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MeasureRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('measure_type', models.IntegerField(choices=[(1, 'Weight (kg)'), (4, 'Height (meter)'), (5, 'Fat Free Mass (kg)'), (6, 'Fat Ratio (%)'), (8, 'Fat Mass Weight (kg)'), (9, 'Diastolic Blood Pressure (mmHg)'), (10, 'Systolic Blood Pressure (mmHg)'), (11, 'Heart Pulse (bpm)'), (54, 'SP02(%)')], help_text='The type of the summarized measures')),
+                ('resolution', models.CharField(choices=[('day', 'Day'), ('week', 'Week')], help_text='The length of the bucket', max_length=8)),
+                ('start', models.DateTimeField(help_text='The start of the bucket')),
+                ('count', models.IntegerField(help_text='The number of measures')),
+                ('total', models.FloatField(help_text='The sum of the real values')),
+                ('minimum', models.FloatField(help_text='The smallest real value')),
+                ('maximum', models.FloatField(help_text='The largest real value')),
+                ('first', models.FloatField(help_text='The earliest real value')),
+                ('last', models.FloatField(help_text='The latest real value')),
+                ('user', models.ForeignKey(help_text="The rollup's user", on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='measurerollup',
+            unique_together=set([('user', 'measure_type', 'resolution', 'start')]),
+        ),
+    ]
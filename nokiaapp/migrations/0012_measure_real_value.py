@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+BATCH_SIZE = 10000
+
+
+def set_real_values(apps, schema_editor):
+    """ Compute the real value of existing measures, a range of IDs at a time """
+    Measure = apps.get_model('nokiaapp', 'Measure')
+    measures = Measure.objects.using(schema_editor.connection.alias)
+    bounds = measures.aggregate(low=models.Min('pk'), high=models.Max('pk'))
+    if bounds['low'] is None:
+        return
+    units = list(measures.order_by().values_list(
+        'unit', flat=True).distinct())
+    for low in range(bounds['low'], bounds['high'] + 1, BATCH_SIZE):
+        batch = measures.filter(pk__gte=low, pk__lt=low + BATCH_SIZE)
+        for unit in units:
+            batch.filter(unit=unit).update(
+                real_value=models.ExpressionWrapper(
+                    models.F('value') * models.Value(pow(10.0, unit)),
+                    output_field=models.FloatField()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nokiaapp', '0011_measurerollup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='measure',
+            name='real_value',
+            field=models.FloatField(help_text='The real value, "value" multiplied by 10 to the power of "unit", set when the measure is saved', null=True),
+        ),
+        migrations.RunPython(set_real_values, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='measure',
+            name='real_value',
+            field=models.FloatField(help_text='The real value, "value" multiplied by 10 to the power of "unit", set when the measure is saved'),
+        ),
+        migrations.AlterIndexTogether(
+            name='measure',
+            index_together=set([('group', 'measure_type'), ('user', 'measure_type', 'date'), ('measure_type', 'real_value')]),
+        ),
+    ]
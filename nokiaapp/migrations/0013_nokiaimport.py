@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-17 22:42
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('nokiaapp', '0012_measure_real_value'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NokiaImport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', help_text='The state of the import', max_length=16)),
+                ('start', models.DateTimeField(help_text='The oldest datetime to import')),
+                ('end', models.DateTimeField(help_text='The newest datetime to import')),
+                ('cursor', models.DateTimeField(help_text='Measures from this datetime to the end have been imported')),
+                ('groups', models.IntegerField(default=0, help_text='The number of measure groups imported so far')),
+                ('error', models.TextField(blank=True, help_text='The error that stopped the import')),
+                ('created', models.DateTimeField(auto_now_add=True, help_text='The datetime the import was started')),
+                ('updated', models.DateTimeField(auto_now=True, help_text='The datetime of the last progress')),
+                ('user', models.ForeignKey(help_text="The import's user", on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
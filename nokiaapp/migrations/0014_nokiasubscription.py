@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-17 22:48
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('nokiaapp', '0013_nokiaimport'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NokiaSubscription',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('appli', models.IntegerField(choices=[(1, 'Weight'), (4, 'Heart rate and blood pressure')], help_text='The category of measures notified')),
+                ('callback_url', models.CharField(help_text='The URL notifications are sent to', max_length=255)),
+                ('created', models.DateTimeField(auto_now_add=True, help_text='The datetime the subscription was recorded')),
+                ('user', models.ForeignKey(help_text="The subscription's user", on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='nokiasubscription',
+            unique_together=set([('user', 'appli', 'callback_url')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-17 22:53
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nokiaapp', '0014_nokiasubscription'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='nokiauser',
+            name='sync_cursor',
+            field=models.DateTimeField(blank=True, help_text="Nokia's update time of the last sync of all the user's updated measures, the next sync starts from it", null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-17 22:55
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nokiaapp', '0015_nokiauser_sync_cursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='nokiaimport',
+            name='window',
+            field=models.IntegerField(blank=True, help_text='The number of seconds of the next window to import', null=True),
+        ),
+    ]
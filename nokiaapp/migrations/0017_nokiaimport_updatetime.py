@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-17 23:45
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nokiaapp', '0016_nokiaimport_window'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='nokiaimport',
+            name='updatetime',
+            field=models.DateTimeField(blank=True, help_text="Nokia's updatetime when the first window was imported", null=True),
+        ),
+    ]
@@ -1,22 +1,105 @@
 import arrow
+import calendar
+import collections
 import datetime
 
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
+from itertools import islice
 from math import pow
 
+from .records import records, to_datetimes
+
 
 UserModel = getattr(settings, 'AUTH_USER_MODEL', 'auth.User')
 
 
+def _real_value(value, unit):
+    return float(value) * pow(10, unit)
+
+
+def _chunks(iterable, size):
+    """ Yield lists of at most ``size`` items from ``iterable`` """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class IngestError(Exception):
+    """
+    Storing measures failed part way through. ``written`` groups were
+    stored in the ``batches`` committed before the ``error``, and the
+    groups of the failed batch, whose IDs are ``grpids``, were not.
+    """
+
+    def __init__(self, error, written, batches, grpids):
+        super(IngestError, self).__init__(
+            '{0} group(s) stored in {1} batch(es) before {2!r}{3}'.format(
+                written, batches, error,
+                ' storing groups {0} to {1}'.format(grpids[0], grpids[-1])
+                if grpids else ''))
+        self.error = error
+        self.written = written
+        self.batches = batches
+        self.grpids = grpids
+
+
+class MeasureGroupQuerySet(models.QuerySet):
+    def between(self, user, start=None, end=None, category=1):
+        """
+        The ``user``'s groups in ``category`` (real measurements by default)
+        dated from ``start`` to ``end`` inclusive, oldest first. Either bound
+        may be None to leave that end of the range open.
+        """
+        qs = self.filter(user=user, category=category)
+        if start is not None:
+            qs = qs.filter(date__gte=start)
+        if end is not None:
+            qs = qs.filter(date__lte=end)
+        return qs.order_by('date')
+
+
+class MeasureQuerySet(models.QuerySet):
+    def series(self, user, measure_type, start=None, end=None, category=1):
+        """
+        ``(date, real value)`` pairs of the ``user``'s measures of
+        ``measure_type`` dated from ``start`` to ``end`` inclusive, oldest
+        first. Either bound may be None to leave that end of the range open.
+        Only real measurements are included, unless another group
+        ``category`` is given, or None for all of them.
+
+        No model instances are created, and long histories can be streamed
+        with ``iterator()``::
+
+            for date, weight in Measure.objects.series(
+                    user, Measure.weight).iterator():
+                ...
+        """
+        qs = self.filter(user=user, measure_type=measure_type)
+        if start is not None:
+            qs = qs.filter(date__gte=start)
+        if end is not None:
+            qs = qs.filter(date__lte=end)
+        if category is not None:
+            qs = qs.filter(group__category=category)
+        return qs.order_by('date').values_list('date', 'real_value')
+
+
 @python_2_unicode_compatible
 class NokiaUser(models.Model):
     """ A user's Nokia credentials, allowing API access """
     user = models.OneToOneField(UserModel, help_text='The user')
     nokia_user_id = models.IntegerField(help_text='The nokia user ID')
     access_token = models.TextField(help_text='OAuth2 access token')
-    token_expiry = models.IntegerField(help_text='Token expiration timestamp')
+    token_expiry = models.IntegerField(
+        db_index=True, help_text='Token expiration timestamp')
     token_type = models.CharField(
         max_length=32, help_text='Type of OAuth2 token')
     refresh_token = models.TextField(help_text='OAuth2 refresh token')
@@ -24,6 +107,14 @@ class NokiaUser(models.Model):
         null=True,
         blank=True,
         help_text="The datetime the user's nokia data was last updated")
+    sync_cursor = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="Nokia's update time of the last sync of all the user's "
+                  "updated measures, the next sync starts from it")
+
+    TOKEN_FIELDS = ('access_token', 'token_expiry', 'token_type',
+                    'refresh_token')
 
     def __str__(self):
         if hasattr(self.user, 'get_username'):
@@ -42,13 +133,108 @@ class NokiaUser(models.Model):
         }
 
     def refresh_cb(self, token):
-        self.access_token = token['access_token']
-        self.token_expiry = int((
+        """
+        Store a token refreshed by the API. Only the token fields are
+        written, and only if the stored ``token_expiry`` is still the one we
+        loaded. Otherwise another worker refreshed the token first, and we
+        use its token instead.
+        """
+        fields = {
+            'access_token': token['access_token'],
+            'token_expiry': int((
+                datetime.datetime.utcnow() - datetime.datetime(1970, 1, 1)
+            ).total_seconds()) + int(token['expires_in']),
+            'token_type': token['token_type'],
+            'refresh_token': token['refresh_token'],
+        }
+        if NokiaUser.objects.filter(
+                pk=self.pk, token_expiry=self.token_expiry).update(**fields):
+            for name, value in fields.items():
+                setattr(self, name, value)
+        else:
+            self.refresh_from_db(fields=self.TOKEN_FIELDS)
+
+    def advance_sync_cursor(self, updatetime):
+        """
+        Move the ``sync_cursor`` forward to ``updatetime``, unless another
+        sync already moved it further
+        """
+        if NokiaUser.objects.filter(pk=self.pk).filter(
+                models.Q(sync_cursor__isnull=True) |
+                models.Q(sync_cursor__lt=updatetime)
+        ).update(sync_cursor=updatetime):
+            self.sync_cursor = updatetime
+        else:
+            self.refresh_from_db(fields=['sync_cursor'])
+
+    def token_expires_within(self, seconds=0):
+        """ Returns True if the access token expires within ``seconds`` """
+        return int(self.token_expiry) <= int((
             datetime.datetime.utcnow() - datetime.datetime(1970, 1, 1)
-        ).total_seconds()) + int(token['expires_in'])
-        self.token_type = token['token_type']
-        self.refresh_token = token['refresh_token']
-        self.save()
+        ).total_seconds()) + seconds
+
+    def refresh_access_token(self, seconds=0):
+        """
+        Refresh the access token if it expires within ``seconds``, and
+        return True if we refreshed it.
+
+        The row is locked while refreshing, so when several workers try to
+        refresh the same user's token at once, only the first one does and
+        the others use the token it got.
+        """
+        from .utils import create_nokia
+        with transaction.atomic():
+            locked = NokiaUser.objects.select_for_update().only(
+                *self.TOKEN_FIELDS).get(pk=self.pk)
+            for name in self.TOKEN_FIELDS:
+                setattr(self, name, getattr(locked, name))
+            if not self.token_expires_within(seconds):
+                return False
+            client = create_nokia(**self.get_user_data()).client
+            self.refresh_cb(client.refresh_token(
+                client.auto_refresh_url, **client.auto_refresh_kwargs))
+            return True
+
+
+@receiver(post_init, sender=NokiaUser)
+def remember_user(sender, instance, **kwargs):
+    """ Remember whose credentials these were loaded as """
+    # Not loading a deferred user_id
+    instance._loaded_user_id = instance.__dict__.get('user_id')
+
+
+@receiver(post_save, sender=NokiaUser)
+def forget_saved_integration(sender, instance, created, update_fields=None,
+                             **kwargs):
+    """
+    Invalidate the cached integration status of the user when the
+    credentials are created or moved to another user, and of the user they
+    were moved from
+    """
+    from .utils import forget_integration
+    loaded = instance._loaded_user_id
+    instance._loaded_user_id = instance.user_id
+    if update_fields is not None and not (
+            set(update_fields) & set(['user', 'user_id'])):
+        return
+    if created or loaded != instance.user_id:
+        forget_integration(instance)
+    if not created and loaded is not None and loaded != instance.user_id:
+        forget_integration(instance, user_id=loaded)
+
+
+@receiver(post_delete, sender=NokiaUser)
+def forget_integration(sender, instance, **kwargs):
+    """ Invalidate the cached integration status of the user """
+    from .utils import forget_integration
+    forget_integration(instance)
+
+
+@receiver(post_delete, sender=NokiaUser)
+def forget_profile(sender, instance, **kwargs):
+    """ Remove the cached Nokia profile of a disconnected user """
+    from .utils import forget_profile
+    forget_profile(instance.nokia_user_id)
 
 
 @python_2_unicode_compatible
@@ -90,29 +276,145 @@ class MeasureGroup(models.Model):
             ', '.join(['{} ({})'.format(ci, cs) for ci, cs in CATEGORY_TYPES])
         ))
 
+    objects = MeasureGroupQuerySet.as_manager()
+
     class Meta:
         unique_together = ('user', 'grpid',)
+        index_together = (('user', 'date'), ('user', 'category', 'date'))
 
     def __str__(self):
         return '%s: %s' % (self.date.date().isoformat() if self.date else None,
                            self.get_category_display())
 
     @classmethod
-    def create_from_measures(cls, user, measures):
-        for nokia_measure in measures:
-            if MeasureGroup.objects.filter(grpid=nokia_measure.grpid,
-                                           user=user).exists():
+    def create_from_measures(cls, user, measures, update=False,
+                             batch_size=None):
+        """
+        Store the groups in ``measures`` (a ``NokiaMeasures`` instance) for
+        ``user`` and return how many groups were written.
+
+        The groups are read as :py:class:`nokiaapp.records.GroupRecord`
+        objects, and the dates of each batch converted at once.
+
+        The user's existing groups are fetched in one query, then groups and
+        their measures are inserted with ``bulk_create``, ``batch_size``
+        groups at a time (:ref:`NOKIA_BATCH_SIZE` by default). Each batch is
+        committed on its own, or is a savepoint when called in a transaction,
+        so a group is never stored without all of its measures.
+
+        Groups we already have are skipped, unless ``update`` is True. In that
+        case a stored group is rewritten, along with its measures, when its
+        date, ``attrib``, ``category`` or measures differ from the stored
+        ones, and a group reported without any measures is deleted. Groups
+        that haven't changed are left alone, whatever the response's
+        ``updatetime``.
+
+        The user's :py:class:`MeasureRollup` rows covering the changed groups
+        are recomputed in the same transaction as each batch.
+
+        If reading or storing a batch fails, that batch is rolled back and
+        :py:class:`IngestError` is raised, reporting the batches already
+        committed. Storing the same measures again, even from a newer
+        response, then carries on from the failed batch, as the groups
+        already stored are unchanged and skipped.
+        """
+        from . import rollups
+        from .utils import get_setting
+        if batch_size is None:
+            batch_size = get_setting('NOKIA_BATCH_SIZE')
+        updatetime = measures.updatetime.datetime
+        existing = dict(
+            (grpid, (pk, attrib, category, date))
+            for grpid, pk, attrib, category, date in
+            cls.objects.filter(user=user).values_list(
+                'grpid', 'pk', 'attrib', 'category', 'date')
+        )
+        seen = set()
+        written = batches = 0
+        chunk = []
+        try:
+            for chunk in _chunks(records(measures), batch_size):
+                with transaction.atomic():
+                    stored, changed = cls._store_batch(
+                        user, chunk, existing, seen, update, updatetime)
+                    rollups.update(user, changed)
+                written += stored
+                batches += 1
+                chunk = []
+        except Exception as e:
+            raise IngestError(e, written, batches,
+                              [record.grpid for record in chunk])
+        return written
+
+    @classmethod
+    def _store_batch(cls, user, chunk, existing, seen, update, updatetime):
+        """
+        Store the groups of ``chunk`` for :py:meth:`create_from_measures`.
+        Returns the number of groups written and the dates of the measures
+        added or removed.
+        """
+        new_groups = []
+        stale_ids = []
+        changed = []
+        # The groups we already have that may have changed
+        stored = []
+        for record in chunk:
+            if record.grpid in seen:
+                continue
+            seen.add(record.grpid)
+            if record.grpid in existing:
+                if update:
+                    stored.append(record)
+            elif record.measures or not update:
+                new_groups.append(record)
+        stored_measures = collections.defaultdict(list)
+        if stored:
+            rows = Measure.objects.filter(group__in=[
+                existing[record.grpid][0] for record in stored
+            ]).values_list('group_id', 'value', 'measure_type', 'unit')
+            for group_id, value, measure_type, unit in rows:
+                stored_measures[group_id].append((value, measure_type, unit))
+        for record in stored:
+            pk, attrib, category, date = existing[record.grpid]
+            if (record.measures and attrib == record.attrib and
+                    category == record.category and
+                    calendar.timegm(date.utctimetuple()) == record.date and
+                    sorted(stored_measures[pk]) == sorted(record.measures)):
                 continue
-            measure_grp = MeasureGroup.objects.create(
-                user=user, grpid=nokia_measure.grpid,
-                attrib=nokia_measure.attrib,
-                category=nokia_measure.category,
-                date=nokia_measure.date.datetime,
-                updatetime=measures.updatetime.datetime)
-            for measure in nokia_measure.measures:
-                Measure.objects.create(
-                    group=measure_grp, value=measure['value'],
-                    measure_type=measure['type'], unit=measure['unit'])
+            stale_ids.append(pk)
+            changed.append(date)
+            if record.measures:
+                new_groups.append(record)
+        if stale_ids:
+            # Measures are removed along with their group
+            cls.objects.filter(pk__in=stale_ids).delete()
+        if not new_groups:
+            return 0, changed
+        dates = to_datetimes(record.date for record in new_groups)
+        groups = cls.objects.bulk_create([
+            cls(user=user, grpid=record.grpid, attrib=record.attrib,
+                category=record.category, date=dates[record.date],
+                updatetime=updatetime)
+            for record in new_groups
+        ])
+        if all(group.pk for group in groups):
+            group_ids = dict((g.grpid, g.pk) for g in groups)
+        else:
+            # The backend can't return IDs from a bulk insert
+            group_ids = dict(cls.objects.filter(
+                user=user,
+                grpid__in=[g.grpid for g in new_groups]
+            ).values_list('grpid', 'pk'))
+        Measure.objects.bulk_create([
+            Measure(group_id=group_ids[record.grpid], user=user,
+                    date=dates[record.date], value=value,
+                    measure_type=measure_type, unit=unit,
+                    real_value=_real_value(value, unit))
+            for record in new_groups
+            for value, measure_type, unit in record.measures
+        ])
+        changed += dates.values()
+        return len(new_groups), changed
 
 
 @python_2_unicode_compatible
@@ -146,6 +448,11 @@ class Measure(models.Model):
         MeasureGroup,
         related_name='measures',
         help_text="The measurement's group")
+    user = models.ForeignKey(
+        UserModel,
+        help_text="The measurement's user, the same as its group's")
+    date = models.DateTimeField(
+        help_text="The datetime of the measurement, the same as its group's")
     value = models.IntegerField(
         help_text=(
             'Value for the measure in S.I units (kilogram, meters, etc.). '
@@ -163,9 +470,187 @@ class Measure(models.Model):
             'get the real value. Eg : value = 20 and unit=-1 means the value '
             'really is 2.0'
         ))
+    real_value = models.FloatField(
+        help_text='The real value, "value" multiplied by 10 to the power of '
+                  '"unit", set when the measure is saved')
+
+    objects = MeasureQuerySet.as_manager()
+
+    class Meta:
+        index_together = (('group', 'measure_type'),
+                          ('user', 'measure_type', 'date'),
+                          ('measure_type', 'real_value'))
+
+    def save(self, *args, **kwargs):
+        if self.user_id is None:
+            self.user_id = self.group.user_id
+        if self.date is None:
+            self.date = self.group.date
+        self.real_value = self.get_value()
+        super(Measure, self).save(*args, **kwargs)
 
     def get_value(self):
-        return float(self.value) * pow(10, self.unit)
+        return _real_value(self.value, self.unit)
 
     def __str__(self):
         return '%s: %s' % (self.get_measure_type_display(), self.get_value())
+
+
+@python_2_unicode_compatible
+class MeasureRollup(models.Model):
+    """
+    A summary of a user's measures of one type over a day or a week,
+    maintained by :py:mod:`nokiaapp.rollups`
+    """
+    DAY = 'day'
+    WEEK = 'week'
+    RESOLUTIONS = (
+        (DAY, 'Day'),
+        (WEEK, 'Week'),
+    )
+
+    user = models.ForeignKey(UserModel, help_text="The rollup's user")
+    measure_type = models.IntegerField(
+        choices=Measure.MEASURE_TYPES,
+        help_text='The type of the summarized measures')
+    resolution = models.CharField(
+        max_length=8, choices=RESOLUTIONS,
+        help_text='The length of the bucket')
+    start = models.DateTimeField(help_text='The start of the bucket')
+    count = models.IntegerField(help_text='The number of measures')
+    total = models.FloatField(help_text='The sum of the real values')
+    minimum = models.FloatField(help_text='The smallest real value')
+    maximum = models.FloatField(help_text='The largest real value')
+    first = models.FloatField(help_text='The earliest real value')
+    last = models.FloatField(help_text='The latest real value')
+
+    class Meta:
+        unique_together = ('user', 'measure_type', 'resolution', 'start')
+
+    @property
+    def average(self):
+        return self.total / self.count
+
+    def __str__(self):
+        return '%s %s: %s' % (
+            self.start.date().isoformat() if self.start else None,
+            self.get_measure_type_display(), self.average)
+
+
+@python_2_unicode_compatible
+class NokiaImport(models.Model):
+    """
+    The progress of importing a user's measurement history, a date window at
+    a time from the newest to the oldest, by
+    :py:func:`nokiaapp.tasks.import_history`
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    user = models.ForeignKey(UserModel, help_text="The import's user")
+    status = models.CharField(
+        max_length=16, choices=STATUSES, default=PENDING,
+        help_text='The state of the import')
+    start = models.DateTimeField(help_text='The oldest datetime to import')
+    end = models.DateTimeField(help_text='The newest datetime to import')
+    cursor = models.DateTimeField(
+        help_text='Measures from this datetime to the end have been imported')
+    groups = models.IntegerField(
+        default=0, help_text='The number of measure groups imported so far')
+    window = models.IntegerField(
+        null=True, blank=True,
+        help_text='The number of seconds of the next window to import')
+    updatetime = models.DateTimeField(
+        null=True, blank=True,
+        help_text="Nokia's updatetime when the first window was imported")
+    error = models.TextField(
+        blank=True, help_text='The error that stopped the import')
+    created = models.DateTimeField(
+        auto_now_add=True, help_text='The datetime the import was started')
+    updated = models.DateTimeField(
+        auto_now=True, help_text='The datetime of the last progress')
+
+    def save(self, *args, **kwargs):
+        if self.cursor is None:
+            self.cursor = self.end
+        super(NokiaImport, self).save(*args, **kwargs)
+
+    @property
+    def progress(self):
+        """ The fraction of the date range imported so far, from 0 to 1 """
+        if self.status == self.DONE:
+            return 1.0
+        total = (self.end - self.start).total_seconds()
+        if total <= 0:
+            return 0.0
+        return (self.end - self.cursor).total_seconds() / total
+
+    def __str__(self):
+        return '%s: %s (%d%%)' % (self.user_id, self.get_status_display(),
+                                  self.progress * 100)
+
+
+@python_2_unicode_compatible
+class NokiaSubscription(models.Model):
+    """
+    A subscription of a user to notifications from Nokia, recorded when it
+    is made and removed when it is revoked, and kept in line with Nokia by
+    :py:func:`nokiaapp.subscriptions.reconcile`
+    """
+    APPLIS = (
+        (1, 'Weight'),
+        (4, 'Heart rate and blood pressure'),
+    )
+
+    user = models.ForeignKey(
+        UserModel, help_text="The subscription's user")
+    appli = models.IntegerField(
+        choices=APPLIS, help_text='The category of measures notified')
+    callback_url = models.CharField(
+        max_length=255, help_text='The URL notifications are sent to')
+    created = models.DateTimeField(
+        auto_now_add=True,
+        help_text='The datetime the subscription was recorded')
+
+    class Meta:
+        unique_together = ('user', 'appli', 'callback_url')
+
+    def __str__(self):
+        return '%s: %s' % (self.user_id, self.callback_url)
+
+
+@python_2_unicode_compatible
+class NokiaJob(models.Model):
+    """
+    A queued call of a :py:mod:`nokiaapp.tasks` function, used by the
+    :py:class:`nokiaapp.jobs.DatabaseBackend`
+    """
+    task = models.CharField(
+        max_length=255, help_text='Dotted path of the function to call')
+    kwargs = models.TextField(
+        help_text='JSON encoded keyword arguments for the function')
+    key = models.CharField(
+        max_length=255, blank=True, db_index=True,
+        help_text='Jobs with the same key are merged while waiting to run')
+    created = models.DateTimeField(
+        auto_now_add=True, db_index=True,
+        help_text='The datetime the job was queued')
+    run_after = models.DateTimeField(
+        default=timezone.now, db_index=True,
+        help_text='The job is not run before this datetime')
+    started = models.DateTimeField(
+        null=True, blank=True, db_index=True,
+        help_text='The datetime a worker picked up the job')
+    error = models.TextField(
+        blank=True, help_text='The error raised if the job failed')
+
+    def __str__(self):
+        return '%s(%s)' % (self.task, self.kwargs)
@@ -0,0 +1,98 @@
+"""
+Rate limiting for requests to the Nokia API.
+
+When :ref:`NOKIA_RATE_LIMIT` is set, :py:func:`get_limiter` returns the
+limiter every request to Nokia waits on.
+"""
+import threading
+import time
+
+from . import utils
+
+
+def get_limiter():
+    """
+    Returns the limiter configured by :ref:`NOKIA_RATE_LIMIT`,
+    :ref:`NOKIA_RATE_LIMIT_BURST` and :ref:`NOKIA_RATE_LIMIT_SHARED`, or None
+    if requests aren't limited.
+    """
+    rate = utils.get_setting('NOKIA_RATE_LIMIT')
+    if not rate:
+        return None
+    config = (rate, utils.get_setting('NOKIA_RATE_LIMIT_BURST'),
+              utils.get_setting('NOKIA_RATE_LIMIT_SHARED'))
+    with _limiters_lock:
+        if config not in _limiters:
+            cls = CacheTokenBucket if config[2] else TokenBucket
+            _limiters[config] = cls(config[0], config[1])
+        return _limiters[config]
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """
+    A token bucket, shared by all threads of the current process, allowing
+    ``rate`` requests per second on average and bursts of up to ``capacity``
+    requests (``rate`` by default).
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """
+        Take a token if one is available and return 0, otherwise return the
+        number of seconds to wait until one is.
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(
+                self.capacity,
+                self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """ Wait until a token is available, and take it """
+        wait = self.take()
+        while wait:
+            time.sleep(wait)
+            wait = self.take()
+
+
+class CacheTokenBucket(TokenBucket):
+    """
+    A token bucket stored in the :ref:`NOKIA_CACHE` cache, so it is shared by
+    every process using that cache. Since caches only provide atomic
+    increments, the bucket is approximated by windows of ``capacity / rate``
+    seconds, each allowing ``capacity`` requests.
+    """
+
+    def __init__(self, rate, capacity=None):
+        super(CacheTokenBucket, self).__init__(rate, capacity)
+        self.period = self.capacity / self.rate
+
+    def take(self):
+        cache = utils.get_cache()
+        now = time.time()
+        window = int(now // self.period)
+        key = 'nokiaapp:ratelimit:{0}'.format(window)
+        cache.add(key, 0, int(self.period) + 1)
+        try:
+            count = cache.incr(key)
+        except ValueError:
+            # The window expired in the meantime
+            return 0
+        if count <= self.capacity:
+            return 0
+        return (window + 1) * self.period - now
@@ -0,0 +1,62 @@
+"""
+Compact records of measure groups, used when storing them.
+
+``NokiaMeasureGroup`` objects parse every date with arrow and keep an
+attribute for each measure type, which makes them costly to create and to
+keep around. :py:class:`GroupRecord` holds only what is stored, with the
+date as epoch seconds, and :py:func:`to_datetimes` converts the dates of a
+whole batch of records at once.
+"""
+import calendar
+import datetime
+from collections import namedtuple
+
+from django.utils import timezone
+
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+class GroupRecord(namedtuple('GroupRecord', [
+        'grpid', 'attrib', 'category', 'date', 'measures'])):
+    """
+    A measure group, with its ``date`` in epoch seconds and its
+    ``measures`` as a tuple of ``(value, type, unit)`` tuples
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_data(cls, data):
+        """ The record of a group decoded from a ``getmeas`` response """
+        return cls(data['grpid'], data.get('attrib'), data.get('category'),
+                   int(data['date']),
+                   tuple((m['value'], m['type'], m['unit'])
+                         for m in data.get('measures') or ()))
+
+    @classmethod
+    def from_group(cls, group):
+        """ The record of a ``NokiaMeasureGroup`` """
+        return cls(group.grpid, group.attrib, group.category,
+                   calendar.timegm(group.date.datetime.utctimetuple()),
+                   tuple((m['value'], m['type'], m['unit'])
+                         for m in group.measures or ()))
+
+
+def records(measures):
+    """
+    The :py:class:`GroupRecord` of each group of ``measures``, a
+    ``NokiaMeasures`` or :py:class:`nokiaapp.streaming.StreamedMeasures`
+    instance
+    """
+    if hasattr(measures, 'records'):
+        return measures.records()
+    return (GroupRecord.from_group(group) for group in measures)
+
+
+def to_datetimes(epochs):
+    """
+    A dict of the UTC datetime of each of the ``epochs``, converting each
+    distinct value once
+    """
+    return dict((epoch, _EPOCH + datetime.timedelta(seconds=epoch))
+                for epoch in set(epochs))
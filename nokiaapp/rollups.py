@@ -0,0 +1,207 @@
+"""
+Daily and weekly summaries of each user's measures, kept in the
+:py:class:`nokiaapp.models.MeasureRollup` table.
+
+Buckets start at midnight, on Mondays for weeks and on the first of the
+month for months, in the default time zone. Only real measurements are
+summarized, not objectives.
+"""
+import datetime
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Measure, MeasureGroup, MeasureRollup, _chunks
+from .utils import get_setting
+
+
+DAY = MeasureRollup.DAY
+WEEK = MeasureRollup.WEEK
+MONTH = 'month'
+# The resolutions kept in the rollup table
+STORED = (DAY, WEEK)
+
+
+def _localize(date):
+    if timezone.is_aware(date):
+        return timezone.localtime(date, timezone.get_default_timezone())
+    return date
+
+
+def _delocalize(local, aware):
+    """ Turn local wall time back into an aware datetime if needed """
+    if aware:
+        tz = timezone.get_default_timezone()
+        # Where DST starts at midnight, midnight doesn't exist: take it in
+        # standard time, which is the first instant of the day
+        return tz.normalize(tz.localize(local, is_dst=False))
+    return local
+
+
+def bucket_start(date, resolution):
+    """ The start of the ``resolution`` bucket ``date`` falls in """
+    local = _localize(date).replace(
+        hour=0, minute=0, second=0, microsecond=0)
+    if resolution == WEEK:
+        local -= datetime.timedelta(days=local.weekday())
+    elif resolution == MONTH:
+        local = local.replace(day=1)
+    return _delocalize(local.replace(tzinfo=None), timezone.is_aware(date))
+
+
+def bucket_end(start, resolution):
+    """ The start of the bucket after the one starting at ``start`` """
+    # Buckets start at 1am on days without a midnight
+    local = _localize(start).replace(
+        tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+    if resolution == DAY:
+        local += datetime.timedelta(days=1)
+    elif resolution == WEEK:
+        local += datetime.timedelta(days=7)
+    elif local.month == 12:
+        local = local.replace(year=local.year + 1, month=1)
+    else:
+        local = local.replace(month=local.month + 1)
+    return _delocalize(local, timezone.is_aware(start))
+
+
+def _is_aligned(date, resolution):
+    return date is None or bucket_start(date, resolution) == date
+
+
+def summarize_rows(user, rows, resolutions):
+    """
+    Yield unsaved rollups of ``(measure_type, date, real value)`` rows,
+    which must be ordered by date, for each of ``resolutions``
+    """
+    open_buckets = dict((resolution, {}) for resolution in resolutions)
+    for measure_type, date, value in rows:
+        for resolution, buckets in open_buckets.items():
+            start = bucket_start(date, resolution)
+            if buckets and next(iter(buckets.values())).start != start:
+                # Rows are ordered, so the open buckets are complete
+                for rollup in buckets.values():
+                    yield rollup
+                buckets.clear()
+            rollup = buckets.get(measure_type)
+            if rollup is None:
+                buckets[measure_type] = MeasureRollup(
+                    user=user, measure_type=measure_type,
+                    resolution=resolution, start=start, count=1,
+                    total=value, minimum=value, maximum=value, first=value,
+                    last=value)
+            else:
+                rollup.count += 1
+                rollup.total += value
+                rollup.minimum = min(rollup.minimum, value)
+                rollup.maximum = max(rollup.maximum, value)
+                rollup.last = value
+    for buckets in open_buckets.values():
+        for rollup in buckets.values():
+            yield rollup
+
+
+def merge(rollups, resolution):
+    """
+    Combine consecutive ``rollups`` of one measure type, ordered by start,
+    into coarser ``resolution`` buckets
+    """
+    merged = None
+    for rollup in rollups:
+        start = bucket_start(rollup.start, resolution)
+        if merged is not None and merged.start == start:
+            merged.count += rollup.count
+            merged.total += rollup.total
+            merged.minimum = min(merged.minimum, rollup.minimum)
+            merged.maximum = max(merged.maximum, rollup.maximum)
+            merged.last = rollup.last
+            continue
+        if merged is not None:
+            yield merged
+        merged = MeasureRollup(
+            user_id=rollup.user_id, measure_type=rollup.measure_type,
+            resolution=resolution, start=start, count=rollup.count,
+            total=rollup.total, minimum=rollup.minimum,
+            maximum=rollup.maximum, first=rollup.first, last=rollup.last)
+    if merged is not None:
+        yield merged
+
+
+def _rows(user, start=None, end=None, measure_type=None):
+    qs = Measure.objects.filter(
+        user=user, group__category=MeasureGroup.real)
+    if measure_type is not None:
+        qs = qs.filter(measure_type=measure_type)
+    if start is not None:
+        qs = qs.filter(date__gte=start)
+    if end is not None:
+        qs = qs.filter(date__lt=end)
+    return qs.order_by('date').values_list(
+        'measure_type', 'date', 'real_value').iterator()
+
+
+def _store(user, start=None, end=None, batch_size=None):
+    """ Replace the user's stored rollups for buckets in [start, end) """
+    if batch_size is None:
+        batch_size = get_setting('NOKIA_BATCH_SIZE')
+    with transaction.atomic(savepoint=False):
+        stored = MeasureRollup.objects.filter(user=user)
+        if start is not None:
+            stored = stored.filter(start__gte=start, start__lt=end)
+        stored.delete()
+        rollups = summarize_rows(user, _rows(user, start, end), STORED)
+        for chunk in _chunks(rollups, batch_size):
+            MeasureRollup.objects.bulk_create(chunk)
+
+
+def update(user, dates):
+    """
+    Recompute the user's rollups for the buckets containing ``dates``, after
+    measures on those dates were added or removed.
+
+    Only the weeks containing ``dates`` are recomputed, with one query per
+    run of consecutive weeks, so a few scattered changes don't recompute
+    every week between them.
+    """
+    weeks = sorted(set(bucket_start(date, WEEK) for date in dates))
+    if not weeks:
+        return
+    start = end = weeks[0]
+    for week in weeks:
+        if week != end:
+            _store(user, start, end)
+            start = week
+        end = bucket_end(week, WEEK)
+    _store(user, start, end)
+
+
+def rebuild(user, batch_size=None):
+    """ Recompute all of the user's rollups from their measures """
+    _store(user, batch_size=batch_size)
+
+
+def summarize(user, measure_type, resolution, start=None, end=None):
+    """
+    Summaries of the ``user``'s measures of ``measure_type`` dated from
+    ``start`` (inclusive) to ``end`` (exclusive), one unsaved or stored
+    :py:class:`nokiaapp.models.MeasureRollup` per ``resolution`` bucket
+    (``'day'``, ``'week'`` or ``'month'``) with measures, oldest first.
+
+    When ``start`` and ``end`` fall on bucket boundaries, the summaries are
+    read from the rollup table, with months combined from days. Otherwise
+    they are computed from the measures.
+    """
+    stored = resolution if resolution in STORED else DAY
+    if _is_aligned(start, stored) and _is_aligned(end, stored):
+        rollups = MeasureRollup.objects.filter(
+            user=user, measure_type=measure_type, resolution=stored)
+        if start is not None:
+            rollups = rollups.filter(start__gte=start)
+        if end is not None:
+            rollups = rollups.filter(start__lt=end)
+        rollups = rollups.order_by('start')
+        if stored == resolution:
+            return list(rollups)
+        return list(merge(rollups.iterator(), resolution))
+    return list(summarize_rows(
+        user, _rows(user, start, end, measure_type), [resolution]))
@@ -0,0 +1,254 @@
+"""
+Incremental parsing of ``getmeas`` responses, so measure groups can be
+stored while the response is read, without holding all of it in memory.
+
+The response body is read :py:data:`CHUNK_SIZE` bytes at a time, and each
+measure group is decoded on its own as soon as it has been read, with the
+standard library's JSON decoder.
+"""
+import codecs
+import collections
+import json
+import time
+
+import arrow
+from arrow.parser import ParserError
+from nokia import NokiaMeasureGroup, is_date, is_date_class
+
+from . import utils
+from .records import GroupRecord
+from .transport import get_adapter
+
+
+# How many bytes of a response to read at a time
+CHUNK_SIZE = 64 * 1024
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+
+class StatusError(Exception):
+    """ A response reported the error ``status`` """
+
+    def __init__(self, status):
+        super(StatusError, self).__init__('Error code {0}'.format(status))
+        self.status = status
+
+
+class _Reader(object):
+    """
+    The text of a JSON document, decoded from ``chunks`` of UTF-8 bytes as
+    it is needed, keeping only what hasn't been parsed yet
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.text = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        """ Read another chunk, or return False at the end of the document """
+        if self.eof:
+            return False
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self.eof = True
+            chunk = b''
+        self.text = self.text[self.pos:] + self.decoder.decode(
+            chunk, final=self.eof)
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """ The next character that isn't whitespace, or '' at the end """
+        while True:
+            while self.pos < len(self.text):
+                if self.text[self.pos] not in _WHITESPACE:
+                    return self.text[self.pos]
+                self.pos += 1
+            if not self.fill():
+                return ''
+
+    def expect(self, chars):
+        """ Consume and return the next character, one of ``chars`` """
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError('Expected one of {0!r} at {1!r}'.format(
+                chars, self.text[self.pos:self.pos + 20]))
+        self.pos += 1
+        return char
+
+    def value(self):
+        """ Decode the next JSON value """
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.text, self.pos)
+            except ValueError:
+                if not self.fill():
+                    raise
+                continue
+            # A number at the end of the text may continue in the next chunk
+            if end < len(self.text) or not self.fill():
+                self.pos = end
+                return value
+
+
+def _members(reader):
+    """
+    Yield the keys of an object, after its '{', the caller reading values
+    """
+    reader.expect('{')
+    if reader.peek() == '}':
+        reader.expect('}')
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        yield key
+        if reader.expect(',}') == '}':
+            return
+
+
+def _events(reader):
+    """
+    Yield ``(kind, key, value)`` tuples for the fields of a response, where
+    ``kind`` is 'response' for the top level fields, 'body' for the fields of
+    the body, and 'group' for each measure group
+    """
+    for key in _members(reader):
+        if key != 'body' or reader.peek() != '{':
+            yield 'response', key, reader.value()
+            continue
+        for body_key in _members(reader):
+            if body_key != 'measuregrps' or reader.peek() != '[':
+                yield 'body', body_key, reader.value()
+                continue
+            reader.expect('[')
+            if reader.peek() == ']':
+                reader.expect(']')
+                continue
+            while True:
+                yield 'group', None, reader.value()
+                if reader.expect(',]') == ']':
+                    break
+    if reader.peek():
+        raise ValueError('Unexpected data after the response')
+
+
+class StreamedMeasures(object):
+    """
+    The measure groups of a ``getmeas`` response, parsed from ``chunks`` of
+    its body as they are iterated over, like ``NokiaMeasures`` but only
+    once. Each group is a ``NokiaMeasureGroup``, or a lighter
+    :py:class:`nokiaapp.records.GroupRecord` when iterating over
+    ``records()``.
+
+    The other fields of the body, like ``updatetime``, ``more`` and
+    ``offset``, are attributes, as on ``NokiaMeasures``: those sent before
+    the groups as soon as the object is created, the others once the groups
+    have been iterated over. Nokia sends ``updatetime`` first, but if it
+    comes after the groups, the groups are kept in memory until it is read.
+
+    Like ``NokiaApi``, raises an exception with the status of responses
+    reporting an error, a :py:class:`StatusError`. ``close`` is called once
+    the response has been read.
+    """
+
+    def __init__(self, chunks, close=None):
+        self._events = _events(_Reader(chunks))
+        self._close = close
+        self._waiting = collections.deque()
+        self._status = None
+        self._count = 0
+        for kind, key, value in self._events:
+            if kind != 'group':
+                self._set(kind, key, value)
+                continue
+            self._waiting.append(value)
+            if hasattr(self, 'updatetime'):
+                break
+
+    def _set(self, kind, key, value):
+        if kind == 'response':
+            if key == 'status':
+                if value != 0:
+                    self.close()
+                    raise StatusError(value)
+                self._status = value
+            return
+        try:
+            setattr(self, key, arrow.get(value) if is_date(key) else value)
+        except ParserError:
+            setattr(self, key, value)
+
+    def _groups(self):
+        """ The decoded groups, read as they are needed """
+        try:
+            while self._waiting:
+                self._count += 1
+                yield self._waiting.popleft()
+            for kind, key, value in self._events:
+                if kind == 'group':
+                    self._count += 1
+                    yield value
+                else:
+                    self._set(kind, key, value)
+        finally:
+            self.close()
+        if self._status is None:
+            raise ValueError('The response has no status')
+
+    def __iter__(self):
+        for data in self._groups():
+            yield NokiaMeasureGroup(data)
+
+    def records(self):
+        """
+        Iterate over the groups as :py:class:`nokiaapp.records.GroupRecord`
+        objects instead, without parsing their dates with arrow
+        """
+        for data in self._groups():
+            yield GroupRecord.from_data(data)
+
+    def __len__(self):
+        """ The number of groups iterated over so far """
+        return self._count
+
+    def close(self):
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+
+def get_measures(api, **kwargs):
+    """
+    Like ``NokiaApi.get_measures``, but returns :py:class:`StreamedMeasures`
+    read from the response as they are iterated over.
+
+    Responses reporting one of the :ref:`NOKIA_RETRY_STATUSES` before their
+    body, as Nokia does, are retried like the other requests to Nokia (see
+    :py:class:`nokiaapp.transport.NokiaAdapter`), since the adapter doesn't
+    read streamed bodies.
+    """
+    params = dict(kwargs, userid=api.credentials.user_id, action='getmeas')
+    for key, val in params.items():
+        if is_date(key) and is_date_class(val):
+            params[key] = arrow.get(val).timestamp
+    max_retries = utils.get_setting('NOKIA_MAX_RETRIES')
+    attempt = 0
+    while True:
+        response = api.client.request(
+            'GET', '{0}/measure'.format(api.URL), params=params, stream=True)
+        try:
+            return StreamedMeasures(response.iter_content(CHUNK_SIZE),
+                                    close=response.close)
+        except StatusError as e:
+            if attempt >= max_retries or e.status not in utils.get_setting(
+                    'NOKIA_RETRY_STATUSES'):
+                raise
+        time.sleep(get_adapter().backoff(attempt))
+        attempt += 1
@@ -0,0 +1,249 @@
+"""
+Managing the notification subscriptions of Nokia users.
+
+The calls to Nokia are made concurrently, each with its own ``NokiaApi``
+instance, and an operation gives up on the calls still running after
+:ref:`NOKIA_SUBSCRIPTION_TIMEOUT` seconds. The views run these through the
+job backend (see :py:func:`nokiaapp.tasks.subscribe` and
+:py:func:`nokiaapp.tasks.unsubscribe`), so they don't wait on Nokia.
+
+The subscriptions made are recorded as
+:py:class:`nokiaapp.models.NokiaSubscription` objects, and
+:py:func:`reconcile` (run by the ``nokia_reconcile_subscriptions`` command)
+finds and repairs the differences between those records and Nokia.
+"""
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor, wait
+from django.db import connections
+
+from . import utils
+
+
+logger = logging.getLogger(__name__)
+
+# The Nokia notification categories we subscribe to: weight and blood
+# pressure measurements
+APPLIS = (1, 4)
+COMMENT = 'django-nokia'
+
+
+class SubscriptionError(Exception):
+    """ Some calls to Nokia failed or didn't finish in time """
+
+
+def _call(func, *args, **kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        # Refreshing a token may have used a database connection
+        connections.close_all()
+
+
+def concurrently(calls, deadline):
+    """
+    Make ``calls``, ``(function, args, kwargs)`` tuples, in a pool of
+    threads, and return their results in order. Raises
+    :py:class:`SubscriptionError` once they have all finished if any of
+    them failed, or when the ``deadline`` (a ``time.time()`` value) passes.
+    """
+    if not calls:
+        return []
+    executor = ThreadPoolExecutor(max_workers=len(calls))
+    try:
+        futures = [executor.submit(_call, func, *args, **kwargs)
+                   for func, args, kwargs in calls]
+        done, not_done = wait(futures, max(0, deadline - time.time()))
+    finally:
+        # Don't wait for calls that timed out
+        executor.shutdown(wait=False)
+    errors = [future.exception() for future in done if future.exception()]
+    if not_done or errors:
+        raise SubscriptionError(
+            '{0} of {1} call(s) failed and {2} timed out: {3}'.format(
+                len(errors), len(calls), len(not_done),
+                ', '.join(repr(error) for error in errors)))
+    return [future.result() for future in futures]
+
+
+def fresh_user_data(user_data):
+    """
+    A copy of the ``user_data`` of a :py:class:`nokiaapp.models.NokiaUser`
+    (as returned by ``get_user_data``) with its access token refreshed if it
+    has expired. Done before making concurrent calls, so that they don't all
+    refresh the token.
+    """
+    user_data = dict(user_data)
+    if int(user_data['token_expiry']) > time.time():
+        return user_data
+    client = utils.create_nokia(**user_data).client
+    token = client.refresh_token(
+        client.auto_refresh_url, **client.auto_refresh_kwargs)
+    refresh_cb = user_data.get('refresh_cb')
+    if refresh_cb:
+        refresh_cb(token)
+    user_data.update(
+        access_token=token['access_token'],
+        refresh_token=token['refresh_token'],
+        token_type=token['token_type'],
+        token_expiry=int(time.time()) + int(token['expires_in']))
+    return user_data
+
+
+def subscribe(user_data, callback_urls):
+    """
+    Subscribe the Nokia user with ``user_data`` to notifications, given as
+    a list of ``(appli, callback URL)`` pairs
+    """
+    deadline = time.time() + utils.get_setting('NOKIA_SUBSCRIPTION_TIMEOUT')
+    user_data = fresh_user_data(user_data)
+    concurrently([
+        (utils.create_nokia(**user_data).subscribe, (url, COMMENT),
+         {'appli': appli})
+        for appli, url in callback_urls
+    ], deadline)
+
+
+def list_subscriptions(user_data, deadline=None):
+    """
+    The ``(appli, callback URL)`` pairs the Nokia user with ``user_data`` is
+    subscribed to, for each of the :py:data:`APPLIS`
+    """
+    if deadline is None:
+        deadline = time.time() + utils.get_setting(
+            'NOKIA_SUBSCRIPTION_TIMEOUT')
+    listed = concurrently([
+        (utils.create_nokia(**user_data).list_subscriptions, (),
+         {'appli': appli})
+        for appli in APPLIS
+    ], deadline)
+    return [(appli, sub['callbackurl'])
+            for appli, subs in zip(APPLIS, listed) for sub in subs]
+
+
+def revoke(user_data, subscribed, deadline=None):
+    """
+    Revoke the subscriptions of the Nokia user with ``user_data`` given as
+    a list of ``(appli, callback URL)`` pairs, without listing them first
+    """
+    if deadline is None:
+        deadline = time.time() + utils.get_setting(
+            'NOKIA_SUBSCRIPTION_TIMEOUT')
+    concurrently([
+        (utils.create_nokia(**user_data).unsubscribe, (url,),
+         {'appli': appli})
+        for appli, url in subscribed
+    ], deadline)
+
+
+def unsubscribe(user_data, callback_urls):
+    """
+    Revoke the subscriptions of the Nokia user with ``user_data`` to any of
+    the ``callback_urls``. Returns the number of subscriptions revoked.
+    """
+    deadline = time.time() + utils.get_setting('NOKIA_SUBSCRIPTION_TIMEOUT')
+    user_data = fresh_user_data(user_data)
+    subscribed = [(appli, url) for appli, url in list_subscriptions(
+        user_data, deadline) if url in callback_urls]
+    revoke(user_data, subscribed, deadline)
+    return len(subscribed)
+
+
+def _known_urls():
+    from .models import NokiaSubscription
+
+    return set(NokiaSubscription.objects.order_by().values_list(
+        'callback_url', flat=True).distinct())
+
+
+def reconcile_user(nokia_user, callback_urls=None, known_urls=None):
+    """
+    Compare the :py:class:`nokiaapp.models.NokiaSubscription` records of
+    ``nokia_user`` with their subscriptions at Nokia, and repair the
+    differences. Returns a dict of the number of subscriptions
+    ``subscribed``, ``unsubscribed`` and ``recorded``.
+
+    If ``callback_urls``, a list of ``(appli, callback URL)`` pairs, is
+    given, the user ends up subscribed to exactly those. Otherwise they end
+    up subscribed to those recorded or found at Nokia, so subscriptions that
+    lapsed are made again, and ones made without a record are recorded.
+    Only the subscriptions that differ are changed.
+
+    Subscriptions at Nokia are only considered if their callback URL is
+    recorded for any user (``known_urls``, computed if not given) or in
+    ``callback_urls``, so other sites' subscriptions are left alone.
+    """
+    from .models import NokiaSubscription
+
+    deadline = time.time() + utils.get_setting('NOKIA_SUBSCRIPTION_TIMEOUT')
+    if nokia_user.token_expires_within():
+        nokia_user.refresh_access_token()
+    user_data = nokia_user.get_user_data()
+    records = NokiaSubscription.objects.filter(user=nokia_user.user_id)
+    local = set(records.values_list('appli', 'callback_url'))
+    if callback_urls is None:
+        wanted = set()
+    else:
+        wanted = set((appli, url) for appli, url in callback_urls)
+    if known_urls is None:
+        known_urls = _known_urls()
+    known_urls = set(known_urls) | set(url for appli, url in wanted)
+    remote = set((appli, url) for appli, url in list_subscriptions(
+        user_data, deadline) if url in known_urls)
+    if callback_urls is None:
+        wanted = local | remote
+    missing = wanted - remote
+    extra = remote - wanted
+    concurrently([
+        (utils.create_nokia(**user_data).subscribe, (url, COMMENT),
+         {'appli': appli})
+        for appli, url in missing
+    ] + [
+        (utils.create_nokia(**user_data).unsubscribe, (url,),
+         {'appli': appli})
+        for appli, url in extra
+    ], deadline)
+    for appli, url in local - wanted:
+        records.filter(appli=appli, callback_url=url).delete()
+    for appli, url in wanted - local:
+        NokiaSubscription.objects.get_or_create(
+            user_id=nokia_user.user_id, appli=appli, callback_url=url)
+    return {'subscribed': len(missing), 'unsubscribed': len(extra),
+            'recorded': len(wanted - local)}
+
+
+def reconcile(users=None, callback_urls=None, workers=1):
+    """
+    Run :py:func:`reconcile_user` for every Nokia user, or those of the
+    ``users`` (users or user IDs), ``workers`` users at a time. Errors for
+    one user are logged and don't stop the others. Returns a dict of the
+    totals of :py:func:`reconcile_user`, with the number of users
+    ``checked`` and ``failed``.
+    """
+    from .models import NokiaUser
+
+    nokia_users = NokiaUser.objects.order_by('pk')
+    if users is not None:
+        nokia_users = nokia_users.filter(
+            user__in=[getattr(user, 'pk', user) for user in users])
+
+    known_urls = _known_urls()
+
+    def check(pk):
+        try:
+            return reconcile_user(
+                NokiaUser.objects.get(pk=pk), callback_urls=callback_urls,
+                known_urls=known_urls)
+        except Exception:
+            logger.exception(
+                "Error reconciling the subscriptions of nokia user %s", pk)
+
+    results = utils.parallel_map(
+        check, list(nokia_users.values_list('pk', flat=True)), workers)
+    totals = {'checked': len(results), 'failed': results.count(None),
+              'subscribed': 0, 'unsubscribed': 0, 'recorded': 0}
+    for result in results:
+        for name, count in (result or {}).items():
+            totals[name] += count
+    return totals
@@ -0,0 +1,317 @@
+import arrow
+import datetime
+import logging
+import time
+
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import jobs, subscriptions, utils
+from .models import (
+    IngestError, MeasureGroup, NokiaImport, NokiaSubscription, NokiaUser)
+
+
+logger = logging.getLogger(__name__)
+
+
+def process_notification(nokia_user_id, startdate=None, enddate=None):
+    """
+    Retrieve and store new measures for every user with the given Nokia user
+    ID. Errors for one user are logged and don't prevent updating the others.
+
+    If the notifications carried a date range, we retrieve the measures in
+    that range. Otherwise we retrieve everything updated since the user's
+    sync cursor, or their last update before the first sync.
+    """
+    for user in NokiaUser.objects.filter(nokia_user_id=nokia_user_id):
+        kwargs = {}
+        if startdate is not None and enddate is not None:
+            kwargs['startdate'] = startdate
+            kwargs['enddate'] = enddate
+        elif user.sync_cursor or user.last_update:
+            kwargs['lastupdate'] = user.sync_cursor or user.last_update
+        try:
+            update_measures(user, **kwargs)
+        except Exception:
+            logger.exception("Error getting nokia user measures")
+
+
+def refresh_profile(nokia_user_id):
+    """
+    Retrieve the profile of the Nokia user ``nokia_user_id`` and store it in
+    the cache read by :py:func:`nokiaapp.utils.get_profile`
+    """
+    nokia_user = NokiaUser.objects.filter(nokia_user_id=nokia_user_id).first()
+    if nokia_user is None:
+        return
+    if nokia_user.token_expires_within():
+        nokia_user.refresh_access_token()
+    api = utils.create_nokia(**nokia_user.get_user_data())
+    utils.set_profile(nokia_user_id, api.get_user())
+
+
+def start_import(user):
+    """
+    Create a :py:class:`nokiaapp.models.NokiaImport` of the ``user``'s
+    history up to now, and queue its first window with the job backend
+    """
+    history = NokiaImport.objects.create(
+        user=user, end=timezone.now(),
+        start=arrow.get(utils.get_setting('NOKIA_IMPORT_START')).datetime)
+    jobs.enqueue('nokiaapp.tasks.import_history', {'import_id': history.pk},
+                 key='import:{0}'.format(history.pk))
+    return history
+
+
+def import_history(import_id):
+    """
+    Import the next window of a :py:class:`nokiaapp.models.NokiaImport`,
+    record the progress and queue the following window, until the start of
+    the import is reached. Each window is sized from how dense the previous
+    one was (see :ref:`NOKIA_FETCH_GROUPS`).
+    """
+    history = NokiaImport.objects.filter(
+        pk=import_id, status__in=[NokiaImport.PENDING, NokiaImport.RUNNING]
+    ).select_related('user').first()
+    if history is None:
+        return
+    imports = NokiaImport.objects.filter(pk=import_id)
+    nokia_user = NokiaUser.objects.filter(user=history.user_id).first()
+    if nokia_user is None:
+        imports.update(status=NokiaImport.FAILED,
+                       error='The user disconnected from Nokia')
+        return
+    window = history.window or utils.get_setting(
+        'NOKIA_IMPORT_WINDOW') * 86400
+    enddate = history.cursor
+    startdate = max(history.start,
+                    enddate - datetime.timedelta(seconds=window))
+    try:
+        groups, written, updatetime = _store_window(
+            nokia_user, startdate, enddate)
+    except Exception as e:
+        logger.exception("Error importing nokia user history")
+        # The batches stored before an ingest error are kept
+        written = e.written if isinstance(e, IngestError) else 0
+        imports.update(status=NokiaImport.FAILED, error=repr(e),
+                       groups=F('groups') + written)
+        return
+    if enddate == history.end:
+        history.updatetime = updatetime
+    done = startdate <= history.start
+    if (done and history.updatetime is not None and
+            nokia_user.sync_cursor is None):
+        # Updates made after the first window are synced as usual
+        nokia_user.advance_sync_cursor(history.updatetime)
+    imports.update(
+        cursor=startdate, groups=F('groups') + written,
+        window=utils.next_window(window, groups),
+        updatetime=history.updatetime,
+        status=NokiaImport.DONE if done else NokiaImport.RUNNING,
+        updated=timezone.now())
+    if not done:
+        jobs.enqueue('nokiaapp.tasks.import_history',
+                     {'import_id': import_id},
+                     key='import:{0}'.format(import_id))
+
+
+def resume_import(import_id):
+    """
+    Queue the next window of a :py:class:`nokiaapp.models.NokiaImport` again,
+    if it failed, or if it stalled, making no progress for
+    :ref:`NOKIA_JOB_LEASE` seconds, because the job running it was lost.
+    The groups of the window stored before it stopped are skipped, so the
+    import carries on from the batch that failed. Returns False if the
+    import hadn't failed or stalled.
+    """
+    stalled = timezone.now() - datetime.timedelta(
+        seconds=utils.get_setting('NOKIA_JOB_LEASE'))
+    if not NokiaImport.objects.filter(
+            Q(status=NokiaImport.FAILED) |
+            Q(status__in=[NokiaImport.PENDING, NokiaImport.RUNNING],
+              updated__lt=stalled),
+            pk=import_id
+    ).update(status=NokiaImport.RUNNING, error='', updated=timezone.now()):
+        return False
+    jobs.enqueue('nokiaapp.tasks.import_history', {'import_id': import_id},
+                 key='import:{0}'.format(import_id))
+    return True
+
+
+def resume_imports(failed=False):
+    """
+    Run :py:func:`resume_import` for every stalled import, and failed ones
+    too if ``failed`` is True. Returns the number of imports resumed.
+    """
+    stalled = timezone.now() - datetime.timedelta(
+        seconds=utils.get_setting('NOKIA_JOB_LEASE'))
+    statuses = Q(status__in=[NokiaImport.PENDING, NokiaImport.RUNNING],
+                 updated__lt=stalled)
+    if failed:
+        statuses |= Q(status=NokiaImport.FAILED)
+    return sum(1 for pk in NokiaImport.objects.filter(statuses).values_list(
+        'pk', flat=True) if resume_import(pk))
+
+
+def _store_window(nokia_user, startdate, enddate):
+    """
+    Retrieve and store the measures of ``nokia_user`` dated from
+    ``startdate`` to ``enddate``, a response at a time. Returns the number
+    of measure groups retrieved and written, and the first response's
+    ``updatetime``.
+    """
+    groups = written = 0
+    updatetime = None
+    for measures in utils.fetch_window(
+            nokia_user, arrow.get(startdate).timestamp,
+            arrow.get(enddate).timestamp):
+        written += MeasureGroup.create_from_measures(
+            nokia_user.user, measures, update=True)
+        groups += len(measures)
+        if updatetime is None:
+            updatetime = measures.updatetime.datetime
+    return groups, written, updatetime
+
+
+def update_history(nokia_user, startdate=None, enddate=None):
+    """
+    Retrieve and store the measures of ``nokia_user`` dated from
+    ``startdate`` (:ref:`NOKIA_IMPORT_START` by default) to ``enddate``
+    (now by default), in windows from the newest to the oldest, storing
+    each window before requesting the next. Returns the number of measure
+    groups written.
+
+    When retrieving up to now, the user's sync cursor is moved to the first
+    window's ``updatetime`` once every window is stored, so that updates
+    made after it are synced as usual.
+    """
+    if startdate is None:
+        startdate = arrow.get(utils.get_setting('NOKIA_IMPORT_START')).datetime
+    advance_cursor = enddate is None
+    if enddate is None:
+        enddate = timezone.now()
+    window = utils.get_setting('NOKIA_IMPORT_WINDOW') * 86400
+    written = 0
+    updatetime = None
+    while enddate > startdate:
+        start = max(startdate, enddate - datetime.timedelta(seconds=window))
+        groups, window_written, window_updatetime = _store_window(
+            nokia_user, start, enddate)
+        written += window_written
+        updatetime = updatetime or window_updatetime
+        window = utils.next_window(window, groups)
+        enddate = start
+    if advance_cursor and updatetime is not None:
+        nokia_user.advance_sync_cursor(updatetime)
+    nokia_user.last_update = timezone.now()
+    nokia_user.save(update_fields=['last_update'])
+    return written
+
+
+def subscribe(user_id, callback_urls):
+    """
+    Subscribe the Nokia user of the user with ID ``user_id`` to
+    notifications, given as a list of ``(appli, callback URL)`` pairs, and
+    record the subscriptions
+    """
+    nokia_user = NokiaUser.objects.filter(user=user_id).first()
+    if nokia_user is None:
+        return
+    if nokia_user.token_expires_within():
+        nokia_user.refresh_access_token()
+    subscriptions.subscribe(nokia_user.get_user_data(), callback_urls)
+    for appli, url in callback_urls:
+        NokiaSubscription.objects.get_or_create(
+            user_id=user_id, appli=appli, callback_url=url)
+
+
+def unsubscribe(user_id, callback_urls):
+    """
+    Revoke the subscriptions of the Nokia user of the user with ID
+    ``user_id``, then forget their credentials and subscription records.
+    The recorded subscriptions are revoked without listing the user's
+    subscriptions first, or if none were recorded, those to any of the
+    ``callback_urls``. If revoking fails, the credentials and records are
+    kept, so that disconnecting again tries again.
+    """
+    nokia_user = NokiaUser.objects.filter(user=user_id).first()
+    if nokia_user is None:
+        return
+    if nokia_user.token_expires_within():
+        nokia_user.refresh_access_token()
+    recorded = NokiaSubscription.objects.filter(user=user_id)
+    subscribed = list(recorded.values_list('appli', 'callback_url'))
+    if subscribed:
+        subscriptions.revoke(nokia_user.get_user_data(), subscribed)
+    else:
+        subscriptions.unsubscribe(nokia_user.get_user_data(), callback_urls)
+    recorded.delete()
+    nokia_user.delete()
+
+
+def update_measures(nokia_user, **kwargs):
+    """
+    Retrieve measures for ``nokia_user`` from Nokia, passing ``kwargs`` to
+    ``get_measures``, and store them. Returns the number of measure groups
+    written.
+
+    Nokia may return the measures in several responses, which are
+    requested and stored one at a time (see
+    :py:func:`nokiaapp.utils.fetch_pages`).
+
+    Unless the measures were retrieved for a date range, so that all the
+    measures updated since ``lastupdate`` were retrieved, the user's
+    ``sync_cursor`` is moved to the ``updatetime`` of the first response
+    once every response is stored. The next sync then starts from Nokia's
+    clock rather than ours, and if storing failed part way through, it
+    retrieves the same measures again and stores the rest.
+    """
+    written = 0
+    updatetime = None
+    for measures in utils.fetch_pages(nokia_user, **kwargs):
+        written += MeasureGroup.create_from_measures(
+            nokia_user.user, measures, update=True)
+        if updatetime is None:
+            updatetime = measures.updatetime.datetime
+    with transaction.atomic():
+        if 'startdate' not in kwargs and 'enddate' not in kwargs:
+            nokia_user.advance_sync_cursor(updatetime)
+        nokia_user.last_update = timezone.now()
+        nokia_user.save(update_fields=['last_update'])
+    return written
+
+
+def refresh_expiring_tokens(window=None, workers=None, batch_size=None):
+    """
+    Refresh the access tokens expiring within ``window`` seconds
+    (:ref:`NOKIA_TOKEN_REFRESH_WINDOW` by default), soonest first, so that
+    requests for data don't have to refresh them. Tokens are refreshed
+    ``batch_size`` users at a time, by ``workers`` threads.
+
+    Run this periodically, more often than the window, for example with the
+    ``nokia_refresh_tokens`` management command. Returns the number of tokens
+    refreshed and the number of users that failed.
+    """
+    if window is None:
+        window = utils.get_setting('NOKIA_TOKEN_REFRESH_WINDOW')
+    workers = workers or utils.get_setting('NOKIA_JOB_WORKERS')
+    batch_size = batch_size or utils.get_setting('NOKIA_BATCH_SIZE')
+
+    def refresh(pk):
+        try:
+            return NokiaUser.objects.get(pk=pk).refresh_access_token(window)
+        except NokiaUser.DoesNotExist:
+            return False
+        except Exception:
+            logger.exception("Error refreshing nokia user token")
+            return None
+
+    pks = list(NokiaUser.objects.filter(
+        token_expiry__lte=int(time.time()) + window
+    ).order_by('token_expiry').values_list('pk', flat=True))
+    results = []
+    for start in range(0, len(pks), batch_size):
+        results += utils.parallel_map(
+            refresh, pks[start:start + batch_size], workers)
+    return results.count(True), results.count(None)
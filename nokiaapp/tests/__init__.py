@@ -2,3 +2,9 @@ from nokiaapp.tests.test_retrieval import *
 from nokiaapp.tests.test_integration import *
 from nokiaapp.tests.test_models import *
 from nokiaapp.tests.test_utils import *
+from nokiaapp.tests.test_jobs import *
+from nokiaapp.tests.test_commands import *
+from nokiaapp.tests.test_rollups import *
+from nokiaapp.tests.test_export import *
+from nokiaapp.tests.test_subscriptions import *
+from nokiaapp.tests.test_streaming import *
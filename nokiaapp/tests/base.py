@@ -75,7 +75,10 @@ class NokiaTestBase(TestCase):
             }]
         })
 
-        self.client.login(username=self.username, password=self.password)
+        # Logging in retrieves the user's profile
+        with patch.object(NokiaApi, 'get_user',
+                          return_value=self.get_user):
+            self.client.login(username=self.username, password=self.password)
 
     def random_string(self, length=255, extra_chars=''):
         chars = ascii_letters + extra_chars
@@ -0,0 +1,253 @@
+import arrow
+import os
+import tempfile
+import time
+
+from django.core.management import call_command
+from django.test import override_settings
+from django.utils import timezone
+from django.utils.six import StringIO
+from nokia import NokiaApi, NokiaMeasures
+
+from nokiaapp.models import MeasureGroup, NokiaSubscription, NokiaUser
+
+from .base import NokiaTestBase
+
+try:
+    from unittest import mock
+except ImportError:  # Python 2.x fallback
+    import mock
+
+
+@override_settings(NOKIA_IMPORT_START=int(time.time()) - 100 * 86400)
+class TestSyncCommand(NokiaTestBase):
+    def setUp(self):
+        super(TestSyncCommand, self).setUp()
+        self.last_update = timezone.now()
+        self.nokia_user2 = self.create_nokia_user(
+            last_update=self.last_update)
+        fd, self.checkpoint = tempfile.mkstemp()
+        os.close(fd)
+        os.remove(self.checkpoint)
+
+    def tearDown(self):
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+    def _sync(self, **kwargs):
+        out = StringIO()
+        err = StringIO()
+        call_command('nokia_sync', workers=1, checkpoint=self.checkpoint,
+                     stdout=out, stderr=err, verbosity=2, **kwargs)
+        return out.getvalue(), err.getvalue()
+
+    @mock.patch('nokiaapp.utils.get_nokia_data')
+    def test_sync(self, get_nokia_data):
+        """ All users should be synced, incrementally when possible """
+        get_nokia_data.return_value = self.get_measures
+        out, err = self._sync()
+        # The first user's history is retrieved in a 90 and a 10 day window
+        calls = get_nokia_data.call_args_list
+        self.assertEqual([c[0] for c in calls], [
+            (self.nokia_user,), (self.nokia_user,), (self.nokia_user2,)])
+        self.assertEqual(calls[0][1]['enddate'] - calls[0][1]['startdate'],
+                         90 * 86400)
+        self.assertEqual(calls[1][1]['enddate'], calls[0][1]['startdate'])
+        self.assertEqual(calls[2][1], {'lastupdate': self.last_update})
+        self.assertEqual(MeasureGroup.objects.count(), 6)
+        self.assertTrue(all(NokiaUser.objects.values_list(
+            'last_update', flat=True)))
+        self.assertIn('Synced 2 user(s) (0 failed), 6 measure group(s)', out)
+        self.assertIn('User {}: 3 measure group(s)'.format(
+            self.nokia_user.pk), out)
+        self.assertEqual(err, '')
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+        get_nokia_data.reset_mock()
+        self._sync(full=True)
+        calls = get_nokia_data.call_args_list
+        self.assertEqual([c[0] for c in calls], [
+            (self.nokia_user,), (self.nokia_user,),
+            (self.nokia_user2,), (self.nokia_user2,)])
+        self.assertTrue(all('startdate' in c[1] for c in calls))
+
+    @mock.patch('nokiaapp.utils.get_nokia_data')
+    def test_full_cursor(self, get_nokia_data):
+        """
+        A full sync should only move the sync cursor once every window is
+        stored
+        """
+        cursor = arrow.get(1249409000).datetime
+        NokiaUser.objects.update(sync_cursor=cursor)
+        newer = NokiaMeasures(dict(self.get_measures.data,
+                                   updatetime=1249409779))
+        get_nokia_data.side_effect = [
+            newer, Exception('Error code 601'), newer, newer]
+        out, err = self._sync(full=True)
+        self.assertIn('Synced 1 user(s) (1 failed)', out)
+        self.assertEqual(
+            NokiaUser.objects.get(pk=self.nokia_user.pk).sync_cursor, cursor)
+        self.assertEqual(
+            NokiaUser.objects.get(pk=self.nokia_user2.pk).sync_cursor,
+            newer.updatetime.datetime)
+
+    @mock.patch('nokiaapp.utils.get_nokia_data')
+    def test_resume(self, get_nokia_data):
+        """ An interrupted sync should resume where it left off """
+        get_nokia_data.side_effect = [Exception('Error code 601'),
+                                      self.get_measures]
+        out, err = self._sync()
+        self.assertIn('Synced 1 user(s) (1 failed)', out)
+        self.assertIn('Error code 601', err)
+        with open(self.checkpoint) as f:
+            self.assertEqual(f.read(), '{}\n'.format(self.nokia_user2.pk))
+
+        get_nokia_data.side_effect = None
+        get_nokia_data.return_value = self.get_measures
+        get_nokia_data.reset_mock()
+        out, err = self._sync()
+        self.assertEqual(
+            [c[0] for c in get_nokia_data.call_args_list],
+            [(self.nokia_user,), (self.nokia_user,)])
+        self.assertIn('skipping 1 synced user(s)', out)
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+
+class TestRefreshTokensCommand(NokiaTestBase):
+    @mock.patch('requests_oauthlib.OAuth2Session.refresh_token')
+    def test_refresh(self, refresh_token):
+        """ Only tokens expiring within the window should be refreshed """
+        refresh_token.side_effect = lambda *args, **kwargs: {
+            'access_token': 'new', 'token_type': 'Bearer',
+            'expires_in': 3600, 'refresh_token': 'new'}
+        # Expires in 10 seconds
+        expiring = self.nokia_user
+        expired = self.create_nokia_user(token_expiry=0)
+        later = self.create_nokia_user(token_expiry=int(time.time()) + 1200)
+        out = StringIO()
+        call_command('nokia_refresh_tokens', workers=1, batch_size=1,
+                     stdout=out)
+        self.assertEqual(out.getvalue().strip(),
+                         'Refreshed 2 token(s), 0 failed')
+        self.assertEqual(
+            sorted(NokiaUser.objects.filter(access_token='new').values_list(
+                'pk', flat=True)),
+            [expiring.pk, expired.pk])
+
+        refresh_token.side_effect = Exception('Error code 601')
+        out = StringIO()
+        call_command('nokia_refresh_tokens', window=1800, workers=1,
+                     stdout=out)
+        self.assertEqual(out.getvalue().strip(),
+                         'Refreshed 0 token(s), 1 failed')
+        self.assertEqual(NokiaUser.objects.get(pk=later.pk).access_token,
+                         later.access_token)
+
+
+class TestReconcileSubscriptionsCommand(NokiaTestBase):
+    url1 = 'http://testserver/notification/1/'
+    url4 = 'http://testserver/notification/4/'
+    error_user_id = None
+
+    def setUp(self):
+        super(TestReconcileSubscriptionsCommand, self).setUp()
+        self.nokia_user2 = self.create_nokia_user()
+        # The first user's blood pressure subscription lapsed, and the second
+        # user was subscribed without a record
+        for appli, url in [(1, self.url1), (4, self.url4)]:
+            NokiaSubscription.objects.create(
+                user=self.user, appli=appli, callback_url=url)
+        self.remote = {
+            self.nokia_user.nokia_user_id: [(1, self.url1)],
+            self.nokia_user2.nokia_user_id: [
+                (1, self.url1), (1, 'http://example.com/other/')],
+        }
+        self.calls = []
+        for name in ['list_subscriptions', 'subscribe', 'unsubscribe']:
+            # Patched with functions, to get the API instance as self
+            patch = mock.patch.object(NokiaApi, name, self._method(name))
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _method(self, name):
+        def method(api, *args, **kwargs):
+            self.calls.append(name)
+            return getattr(self, '_' + name)(api, *args, **kwargs)
+        return method
+
+    def _list_subscriptions(self, api, appli=1):
+        if api.credentials.user_id == self.error_user_id:
+            raise Exception('Unavailable')
+        return [{'appli': a, 'callbackurl': url, 'comment': 'django-nokia',
+                 'expires': 2147483647}
+                for a, url in self.remote[api.credentials.user_id]
+                if a == appli]
+
+    def _subscribe(self, api, url, comment, appli=1):
+        self.remote[api.credentials.user_id].append((appli, url))
+
+    def _unsubscribe(self, api, url, appli=1):
+        self.remote[api.credentials.user_id].remove((appli, url))
+
+    def _reconcile(self, **kwargs):
+        out = StringIO()
+        call_command('nokia_reconcile_subscriptions', workers=1, stdout=out,
+                     **kwargs)
+        return out.getvalue().strip()
+
+    def _recorded(self, user):
+        return sorted(NokiaSubscription.objects.filter(
+            user=user).values_list('appli', 'callback_url'))
+
+    def test_reconcile(self):
+        """
+        Lapsed subscriptions should be made again and unrecorded ones
+        recorded, leaving other sites' subscriptions alone
+        """
+        self.assertEqual(
+            self._reconcile(),
+            'Checked 2 user(s) (0 failed): 1 subscribed, 0 unsubscribed, '
+            '1 recorded')
+        self.assertEqual(self.calls.count('list_subscriptions'), 4)
+        self.assertEqual(self.calls.count('subscribe'), 1)
+        self.assertEqual(sorted(self.remote[self.nokia_user.nokia_user_id]),
+                         [(1, self.url1), (4, self.url4)])
+        self.assertEqual(self._recorded(self.user),
+                         [(1, self.url1), (4, self.url4)])
+        self.assertEqual(self._recorded(self.nokia_user2.user),
+                         [(1, self.url1)])
+        self.assertEqual(len(self.remote[self.nokia_user2.nokia_user_id]), 2)
+
+        # Once in line, nothing is changed
+        self.assertEqual(
+            self._reconcile(),
+            'Checked 2 user(s) (0 failed): 0 subscribed, 0 unsubscribed, '
+            '0 recorded')
+
+    def test_base_url(self):
+        """
+        With a base URL, users should be subscribed to exactly its
+        notification URLs
+        """
+        self.assertEqual(
+            self._reconcile(base_url='https://example.org/',
+                            users=[self.nokia_user2.user.pk]),
+            'Checked 1 user(s) (0 failed): 2 subscribed, 1 unsubscribed, '
+            '2 recorded')
+        urls = [(appli, 'https://example.org/notification/%s/' % appli)
+                for appli in [1, 4]]
+        self.assertEqual(
+            sorted(self.remote[self.nokia_user2.nokia_user_id]),
+            [(1, 'http://example.com/other/')] + urls)
+        self.assertEqual(self._recorded(self.nokia_user2.user), urls)
+        # Other users are left alone
+        self.assertEqual(self._recorded(self.user),
+                         [(1, self.url1), (4, self.url4)])
+
+    def test_error(self):
+        """ Errors for one user shouldn't stop the others """
+        self.error_user_id = self.nokia_user2.nokia_user_id
+        self.assertEqual(
+            self._reconcile(),
+            'Checked 2 user(s) (1 failed): 1 subscribed, 0 unsubscribed, '
+            '0 recorded')
@@ -0,0 +1,70 @@
+import arrow
+import unittest
+
+from django.contrib.auth.models import User
+from nokia import NokiaMeasures
+
+from nokiaapp import export
+from nokiaapp.models import Measure, MeasureGroup
+
+from .base import NokiaTestBase
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+
+class TestExport(NokiaTestBase):
+    def setUp(self):
+        super(TestExport, self).setUp()
+        self.user2 = User.objects.create_user('user2', 'u2@example.com', 'pw')
+        MeasureGroup.create_from_measures(self.user, self.get_measures)
+        MeasureGroup.create_from_measures(self.user2, NokiaMeasures({
+            "updatetime": 1249409679,
+            "measuregrps": [{
+                "grpid": 1,
+                "attrib": 0,
+                "date": 1222930968 + 3600,
+                "category": 1,
+                "measures": [{"value": 70, "type": 1, "unit": 0}]
+            }, {
+                "grpid": 2,
+                "attrib": 0,
+                "date": 1222930968,
+                "category": 2,
+                "measures": [{"value": 65, "type": 1, "unit": 0}]
+            }]
+        }))
+
+    def test_columns(self):
+        """ columns should read each user batch with a single query """
+        with self.assertNumQueries(2):
+            data = export.columns([self.user, self.user2.pk], batch_size=1)
+        self.assertEqual(sorted(data), sorted(export.COLUMNS))
+        self.assertEqual(data['user_id'], [self.user.pk] * 5 + [self.user2.pk])
+        self.assertEqual(sorted(data['measure_type'][:5]), [1, 4, 5, 6, 8])
+        self.assertEqual(data['real_value'][5], 70)
+        self.assertEqual(data['date'][5],
+                         arrow.get(1222930968 + 3600).datetime)
+
+        data = export.columns([self.user, self.user2],
+                              measure_types=[Measure.weight], category=None)
+        self.assertEqual(data['value'], [79300, 65, 70])
+        self.assertEqual(data['unit'], [-3, 0, 0])
+        self.assertEqual(export.columns([])['date'], [])
+
+    @unittest.skipIf(pandas is None, 'pandas is not installed')
+    def test_arrays(self):
+        """ columns can be NumPy arrays, and pivoted into a DataFrame """
+        data = export.columns([self.user, self.user2], arrays=True)
+        self.assertEqual(str(data['date'].dtype), 'datetime64[us]')
+        self.assertAlmostEqual(data['real_value'].sum(), 79.3 + 65.2 + 17.8 +
+                               14.125 + 1.73 + 70)
+
+        frame = export.dataframe([self.user, self.user2])
+        self.assertEqual(list(frame.columns), [1, 4, 5, 6, 8])
+        self.assertEqual(len(frame), 2)
+        self.assertEqual(frame.loc[(self.user2.pk, slice(None)), 1].tolist(),
+                         [70])
+        self.assertEqual(len(export.dataframe([self.user], pivot=False)), 5)
@@ -1,16 +1,26 @@
 import datetime
+import json
+import time
 
 from django.contrib import messages
-from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
+from django.db import transaction
 from django.http import HttpRequest
+from django.test import override_settings
 from django.utils import timezone
+from django.utils.six import StringIO
 from freezegun import freeze_time
-from nokia import NokiaApi, NokiaAuth, NokiaCredentials
+from nokia import NokiaApi, NokiaAuth, NokiaCredentials, NokiaMeasures
+from requests import Response
 
-from nokiaapp import utils
+from nokiaapp import jobs, tasks, utils
 from nokiaapp.decorators import nokia_integration_warning
-from nokiaapp.models import NokiaUser, MeasureGroup, Measure
+from nokiaapp.models import (
+    NokiaImport, NokiaJob, NokiaSubscription, NokiaUser, MeasureGroup,
+    Measure)
 
 from .base import NokiaTestBase
 
@@ -36,6 +46,67 @@ class TestIntegrationUtility(NokiaTestBase):
         user = AnonymousUser()
         self.assertFalse(utils.is_integrated(user))
 
+    def test_memoized(self):
+        """The status is only queried once per user object."""
+        with self.assertNumQueries(1):
+            self.assertTrue(utils.is_integrated(self.user))
+            self.assertTrue(utils.is_integrated(self.user))
+        # Another object for the same user queries again
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(1):
+            self.assertTrue(utils.is_integrated(user))
+        # Deleting the NokiaUser through the user clears the memo
+        self.user.nokiauser.delete()
+        self.assertFalse(utils.is_integrated(self.user))
+        NokiaUser.objects.create(
+            user=self.user, nokia_user_id=1, access_token='a',
+            token_expiry=0, token_type='Bearer', refresh_token='b')
+        self.assertTrue(utils.is_integrated(self.user))
+
+    def test_cached(self):
+        """The status is cached between requests when configured."""
+        cache.clear()
+        with self.settings(NOKIA_INTEGRATION_CACHE_TIMEOUT=60):
+            self.assertTrue(utils.is_integrated(self.user))
+            with self.assertNumQueries(0):
+                self.assertTrue(utils.is_integrated(
+                    User(pk=self.user.pk, is_active=True)))
+            # Saving or deleting the NokiaUser clears the cache
+            NokiaUser.objects.all().delete()
+            self.assertFalse(utils.is_integrated(
+                User(pk=self.user.pk, is_active=True)))
+            with self.assertNumQueries(0):
+                self.assertFalse(utils.is_integrated(
+                    User(pk=self.user.pk, is_active=True)))
+            self.create_nokia_user(user=self.user)
+            self.assertTrue(utils.is_integrated(
+                User(pk=self.user.pk, is_active=True)))
+
+
+    def test_cached_saves(self):
+        """
+        Only saves that can change whose credentials they are should clear
+        the cache
+        """
+        cache.clear()
+        other = self.create_user(username='other', password='other')
+        with self.settings(NOKIA_INTEGRATION_CACHE_TIMEOUT=60):
+            self.assertTrue(utils.is_integrated(self.user))
+            self.assertFalse(utils.is_integrated(other))
+            nokia_user = NokiaUser.objects.get(user=self.user)
+            with mock.patch.object(utils, 'get_cache') as get_cache:
+                nokia_user.save(update_fields=['last_update'])
+                nokia_user.save()
+            self.assertFalse(get_cache.called)
+
+            # Moving the credentials clears both users' status
+            nokia_user.user = other
+            nokia_user.save()
+            self.assertFalse(utils.is_integrated(
+                User(pk=self.user.pk, is_active=True)))
+            self.assertTrue(utils.is_integrated(
+                User(pk=other.pk, is_active=True)))
+
 
 class TestIntegrationDecorator(NokiaTestBase):
 
@@ -104,6 +175,68 @@ class TestIntegrationDecorator(NokiaTestBase):
         self.assertEqual(self.messages[0], msg(self.fake_request))
 
 
+class TestProfileCache(NokiaTestBase):
+    def setUp(self):
+        super(TestProfileCache, self).setUp()
+        self.client.logout()
+        cache.clear()
+
+    def _login(self):
+        self.client.login(username=self.username, password=self.password)
+        return self.client.session.get('nokia_profile')
+
+    @mock.patch.object(NokiaApi, 'get_user')
+    def test_login(self, get_user):
+        """ Logging in should use the cached profile """
+        utils.set_profile(self.nokia_user.nokia_user_id, {'id': 1})
+        self.assertEqual(self._login(), {'id': 1})
+        self.assertEqual(get_user.call_count, 0)
+
+        # Without a cached profile, it is retrieved by a job
+        cache.clear()
+        get_user.return_value = self.get_user
+        self.client.logout()
+        self.assertEqual(self._login(), self.get_user)
+        self.assertEqual(get_user.call_count, 1)
+        self.assertEqual(utils.get_profile(self.nokia_user), self.get_user)
+
+    @mock.patch.object(NokiaApi, 'get_user')
+    def test_login_error(self, get_user):
+        """ Errors retrieving the profile shouldn't prevent logging in """
+        get_user.side_effect = ValueError
+        self.assertIsNone(self._login())
+        self.assertTrue(self.client.session['_auth_user_id'])
+
+    @override_settings(NOKIA_JOB_BACKEND='nokiaapp.jobs.DatabaseBackend')
+    @mock.patch.object(NokiaApi, 'get_user')
+    def test_background_refresh(self, get_user):
+        """
+        Missing and stale profiles should be refreshed in the background
+        """
+        get_user.return_value = self.get_user
+        self.assertIsNone(self._login())
+        job = NokiaJob.objects.get()
+        self.assertEqual(job.task, 'nokiaapp.tasks.refresh_profile')
+        call_command('nokia_worker')
+        self.assertEqual(get_user.call_count, 1)
+        self.assertEqual(utils.get_profile(self.nokia_user), self.get_user)
+        self.assertEqual(NokiaJob.objects.count(), 0)
+
+        utils.set_profile(self.nokia_user.nokia_user_id, {'id': 1})
+        with self.settings(NOKIA_PROFILE_CACHE_TIMEOUT=0):
+            self.assertEqual(utils.get_profile(self.nokia_user), {'id': 1})
+        self.assertEqual(NokiaJob.objects.count(), 1)
+        call_command('nokia_worker')
+        self.assertEqual(utils.get_profile(self.nokia_user), self.get_user)
+
+    def test_forget(self):
+        """ The cached profile is removed when the user disconnects """
+        utils.set_profile(self.nokia_user.nokia_user_id, {'id': 1})
+        self.nokia_user.delete()
+        self.assertIsNone(cache.get('nokiaapp:profile:{}'.format(
+            self.nokia_user.nokia_user_id)))
+
+
 class TestLoginView(NokiaTestBase):
     url_name = 'nokia-login'
 
@@ -157,8 +290,16 @@ class TestCompleteView(NokiaTestBase):
 
     def _get(self, use_code=True, **kwargs):
         NokiaApi.get_user = mock.MagicMock(return_value=self.get_user)
-        NokiaApi.get_measures = mock.MagicMock(
-            return_value=self.get_measures)
+        # Measures are parsed from the response as it is read
+        response = Response()
+        response.status_code = 200
+        response._content = json.dumps(
+            {'status': 0, 'body': self.get_measures.data}).encode('utf8')
+        response._content_consumed = True
+        patch = mock.patch('requests_oauthlib.OAuth2Session.request',
+                           return_value=response)
+        self.request = patch.start()
+        self.addCleanup(patch.stop)
         NokiaApi.subscribe = mock.MagicMock(return_value=None)
         NokiaAuth.get_credentials = mock.MagicMock(
             return_value=NokiaCredentials(
@@ -177,11 +318,13 @@ class TestCompleteView(NokiaTestBase):
     def test_get(self):
         """
         Complete view should fetch & store user's access credentials, add the
-        user's profile to the session, and retrieve all past body measures.
+        user's profile to the session, and import all past body measures.
         """
         self.assertEqual(MeasureGroup.objects.count(), 0)
         self.assertEqual(Measure.objects.count(), 0)
-        response = self._get()
+        start = int(time.time()) - 200 * 86400
+        with self.settings(NOKIA_IMPORT_START=start):
+            response = self._get()
         self.assertRedirectsNoFollow(
             response, utils.get_setting('NOKIA_LOGIN_REDIRECT'))
         nokia_user = NokiaUser.objects.get()
@@ -191,17 +334,55 @@ class TestCompleteView(NokiaTestBase):
         NokiaApi.subscribe.assert_has_calls([
             mock.call('http://testserver/notification/%s/' % appli,
                       'django-nokia', appli=appli) for appli in [1, 4]
-        ])
+        ], any_order=True)
+        self.assertEqual(
+            sorted(NokiaSubscription.objects.filter(
+                user=self.user).values_list('appli', 'callback_url')),
+            [(appli, 'http://testserver/notification/%s/' % appli)
+             for appli in [1, 4]])
         self.assertEqual(nokia_user.user, self.user)
         self.assertEqual(nokia_user.access_token, self.access_token)
         self.assertEqual(nokia_user.token_expiry, self.token_expiry)
         self.assertEqual(nokia_user.token_type, self.token_type)
         self.assertEqual(nokia_user.refresh_token, self.refresh_token)
         self.assertEqual(nokia_user.nokia_user_id, self.nokia_user_id)
-        NokiaApi.get_measures.assert_called_once_with()
+        # Syncs start from the update time of the newest window
+        self.assertEqual(nokia_user.sync_cursor,
+                         self.get_measures.updatetime.datetime)
+        # The history is imported in windows, newest first, starting with 90
+        # days, then larger ones since there are few measures
+        self.assertEqual(self.request.call_count, 2)
+        windows = [c[1]['params'] for c in self.request.call_args_list]
+        self.assertEqual(windows[0]['enddate'] - windows[0]['startdate'],
+                         90 * 86400)
+        self.assertEqual(windows[1]['enddate'], windows[0]['startdate'])
+        self.assertEqual(windows[1]['startdate'], start)
+        history = NokiaImport.objects.get()
+        self.assertEqual(history.status, NokiaImport.DONE)
+        self.assertEqual(history.groups, 3)
         self.assertEqual(MeasureGroup.objects.count(), 3)
         self.assertEqual(Measure.objects.count(), 5)
 
+    @override_settings(NOKIA_JOB_BACKEND='nokiaapp.jobs.DatabaseBackend')
+    def test_rolled_back(self):
+        """
+        The jobs queued by the complete view should be dropped with its
+        transaction if it is rolled back
+        """
+        try:
+            with transaction.atomic():
+                self._get()
+                self.assertEqual(sorted(NokiaJob.objects.values_list(
+                    'task', flat=True)), [
+                    'nokiaapp.tasks.import_history',
+                    'nokiaapp.tasks.refresh_profile',
+                    'nokiaapp.tasks.subscribe'])
+                raise ValueError('Rolled back')
+        except ValueError:
+            pass
+        self.assertFalse(NokiaUser.objects.exists())
+        self.assertFalse(NokiaJob.objects.exists())
+
     def test_unauthenticated(self):
         """User must be logged in to access Complete view."""
         self.client.logout()
@@ -258,6 +439,145 @@ class TestCompleteView(NokiaTestBase):
             response, utils.get_setting('NOKIA_LOGIN_REDIRECT'))
 
 
+class TestImportStatusView(NokiaTestBase):
+    url_name = 'nokia-import-status'
+
+    def _status(self):
+        response = self._get()
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode('utf8'))
+
+    @override_settings(NOKIA_JOB_BACKEND='nokiaapp.jobs.DatabaseBackend',
+                       NOKIA_IMPORT_START=1222000000, NOKIA_IMPORT_WINDOW=30)
+    @mock.patch('nokiaapp.utils.get_nokia_data')
+    def test_progress(self, get_nokia_data):
+        """ The status view should report the progress of the import """
+        self.assertEqual(self._get().status_code, 404)
+        NokiaJob.objects.all().delete()
+        get_nokia_data.return_value = self.get_measures
+        with freeze_time('2008-12-01T00:00:00Z'):
+            tasks.start_import(self.user)
+            self.assertEqual(self._status(), {
+                'status': 'pending', 'progress': 0.0, 'groups': 0,
+                'imported_from': '2008-12-01T00:00:00+00:00', 'error': ''})
+            jobs.get_backend().run_pending(limit=1)
+            # The sync cursor waits for the whole history
+            self.assertIsNone(
+                NokiaUser.objects.get(pk=self.nokia_user.pk).sync_cursor)
+            status = self._status()
+            self.assertEqual(status['status'], 'running')
+            self.assertEqual(status['imported_from'],
+                             '2008-11-01T00:00:00+00:00')
+            self.assertAlmostEqual(status['progress'], 30 / 70.5, places=2)
+
+            get_nokia_data.side_effect = ValueError('Nope')
+            jobs.get_backend().run_pending()
+            status = self._status()
+            self.assertEqual(status['status'], 'failed')
+            self.assertEqual(status['error'], "ValueError('Nope',)")
+
+            get_nokia_data.side_effect = None
+            tasks.start_import(self.user)
+            call_command('nokia_worker')
+            self.assertEqual(self._status(), {
+                'status': 'done', 'progress': 1.0, 'groups': 0,
+                'imported_from': '2008-09-21T12:26:40+00:00', 'error': ''})
+        self.assertEqual(
+            NokiaUser.objects.get(pk=self.nokia_user.pk).sync_cursor,
+            self.get_measures.updatetime.datetime)
+        # After 30 days, the rest of the history fits in one window
+        self.assertEqual(get_nokia_data.call_count, 4)
+        self.assertEqual(NokiaImport.objects.last().window, 480 * 86400)
+        self.assertEqual(MeasureGroup.objects.count(), 3)
+
+    @override_settings(NOKIA_IMPORT_START=1222000000, NOKIA_IMPORT_WINDOW=100,
+                       NOKIA_BATCH_SIZE=2)
+    @mock.patch('nokiaapp.utils.get_nokia_data')
+    def test_resume(self, get_nokia_data):
+        """
+        A failed import should keep the batches it stored, and carry on
+        from the failed batch when resumed
+        """
+        get_nokia_data.return_value = self.get_measures
+        bulk_create = Measure.objects.bulk_create
+
+        def fail_second(objs):
+            if Measure.objects.exists():
+                raise ValueError('Nope')
+            return bulk_create(objs)
+
+        with freeze_time('2008-12-01T00:00:00Z'):
+            with mock.patch.object(Measure.objects, 'bulk_create',
+                                   fail_second):
+                history = tasks.start_import(self.user)
+            status = self._status()
+            self.assertEqual(status['status'], 'failed')
+            self.assertEqual(status['groups'], 2)
+            self.assertIn("2 group(s) stored in 1 batch(es) before "
+                          "ValueError('Nope',)", status['error'])
+            pks = sorted(MeasureGroup.objects.values_list('pk', flat=True))
+            self.assertEqual(len(pks), 2)
+
+            # The retry gets a newer response, whose groups already stored
+            # are skipped
+            get_nokia_data.return_value = NokiaMeasures(dict(
+                self.get_measures.data, updatetime=1249409779))
+            self.assertTrue(tasks.resume_import(history.pk))
+            status = self._status()
+            self.assertEqual((status['status'], status['groups']),
+                             ('done', 3))
+            self.assertEqual(Measure.objects.count(), 5)
+            self.assertEqual(sorted(MeasureGroup.objects.filter(
+                grpid__in=[2909, 2910]).values_list('pk', flat=True)), pks)
+            # Only failed imports are resumed
+            self.assertFalse(tasks.resume_import(history.pk))
+
+    @override_settings(NOKIA_IMPORT_START=1222000000, NOKIA_IMPORT_WINDOW=100,
+                       NOKIA_BATCH_SIZE=2)
+    @mock.patch('nokiaapp.utils.get_nokia_data')
+    def test_stalled(self, get_nokia_data):
+        """
+        An import whose job was lost in the middle of a window should be
+        carried on once it made no progress for NOKIA_JOB_LEASE seconds
+        """
+        get_nokia_data.return_value = self.get_measures
+        bulk_create = Measure.objects.bulk_create
+
+        def kill_second(objs):
+            if Measure.objects.exists():
+                raise KeyboardInterrupt
+            return bulk_create(objs)
+
+        with freeze_time('2008-12-01T00:00:00Z'):
+            with mock.patch.object(Measure.objects, 'bulk_create',
+                                   kill_second):
+                self.assertRaises(KeyboardInterrupt, tasks.start_import,
+                                  self.user)
+            self.assertEqual(self._status()['status'], 'pending')
+            self.assertEqual(MeasureGroup.objects.count(), 2)
+            self.assertEqual(tasks.resume_imports(failed=True), 0)
+        with freeze_time('2008-12-01T01:00:01Z'):
+            out = StringIO()
+            call_command('nokia_resume_imports', stdout=out)
+            self.assertEqual(out.getvalue().strip(), 'Resumed 1 import(s)')
+            self.assertEqual(self._status()['status'], 'done')
+            self.assertEqual(MeasureGroup.objects.count(), 3)
+            self.assertEqual(tasks.resume_imports(failed=True), 0)
+
+    def test_disconnected(self):
+        """ An import stops when the user disconnects """
+        NokiaUser.objects.all().delete()
+        history = tasks.start_import(self.user)
+        self.assertEqual(NokiaImport.objects.get(pk=history.pk).status,
+                         NokiaImport.FAILED)
+        self.assertEqual(self._status()['status'], 'failed')
+
+    def test_unauthenticated(self):
+        """ User must be logged in to see the import status """
+        self.client.logout()
+        self.assertEqual(self._get().status_code, 302)
+
+
 class TestErrorView(NokiaTestBase):
     url_name = 'nokia-error'
 
@@ -284,7 +604,7 @@ class TestLogoutView(NokiaTestBase):
 
     def setUp(self):
         super(TestLogoutView, self).setUp()
-        NokiaApi.list_subscriptions = mock.MagicMock(return_value=[{
+        subs = [{
             'comment': 'django-nokia',
             'expires': 2147483647,
             'appli': 1,
@@ -294,22 +614,109 @@ class TestLogoutView(NokiaTestBase):
             'expires': 2147483647,
             'appli': 4,
             'callbackurl': 'http://testserver/notification/4/',
-        }])
+        }, {
+            'comment': 'another app',
+            'expires': 2147483647,
+            'appli': 4,
+            'callbackurl': 'http://example.com/notification/',
+        }]
+        NokiaApi.list_subscriptions = mock.MagicMock(
+            side_effect=lambda appli=1: [
+                sub for sub in subs if sub['appli'] == appli])
         NokiaApi.unsubscribe = mock.MagicMock(return_value=None)
 
     def test_get(self):
         """Logout view should remove associated NokiaUser and redirect."""
         response = self._get()
-        NokiaApi.list_subscriptions.assert_called_once_with()
+        NokiaApi.list_subscriptions.assert_has_calls(
+            [mock.call(appli=1), mock.call(appli=4)], any_order=True)
         self.assertEqual(NokiaApi.unsubscribe.call_count, 2)
         NokiaApi.unsubscribe.assert_has_calls([
             mock.call('http://testserver/notification/%s/' % appli,
                       appli=appli) for appli in [1, 4]
-        ])
+        ], any_order=True)
         self.assertRedirectsNoFollow(response,
                                      utils.get_setting('NOKIA_LOGIN_REDIRECT'))
         self.assertEqual(NokiaUser.objects.count(), 0)
 
+    def test_recorded(self):
+        """
+        Recorded subscriptions should be revoked without listing them, and
+        their records removed
+        """
+        NokiaSubscription.objects.create(
+            user=self.user, appli=4,
+            callback_url='http://testserver/notification/4/')
+        response = self._get()
+        self.assertRedirectsNoFollow(response,
+                                     utils.get_setting('NOKIA_LOGIN_REDIRECT'))
+        self.assertEqual(NokiaApi.list_subscriptions.call_count, 0)
+        NokiaApi.unsubscribe.assert_called_once_with(
+            'http://testserver/notification/4/', appli=4)
+        self.assertFalse(NokiaSubscription.objects.exists())
+
+    def test_unsubscribe_error(self):
+        """
+        If unsubscribing fails right away, the credentials are kept and the
+        user is redirected to the error view.
+        """
+        NokiaApi.unsubscribe.side_effect = Exception('Unavailable')
+        NokiaSubscription.objects.create(
+            user=self.user, appli=4,
+            callback_url='http://testserver/notification/4/')
+        response = self._get()
+        self.assertRedirectsNoFollow(response, reverse('nokia-error'))
+        self.assertEqual(NokiaUser.objects.count(), 1)
+        self.assertEqual(NokiaSubscription.objects.count(), 1)
+
+    @override_settings(NOKIA_JOB_BACKEND='nokiaapp.jobs.DatabaseBackend')
+    def test_deferred(self):
+        """
+        With a queueing job backend, logout doesn't wait on Nokia, and the
+        credentials are deleted once the subscriptions are revoked
+        """
+        NokiaJob.objects.all().delete()
+        response = self._get()
+        self.assertRedirectsNoFollow(response,
+                                     utils.get_setting('NOKIA_LOGIN_REDIRECT'))
+        self.assertEqual(NokiaUser.objects.count(), 1)
+        self.assertEqual(NokiaApi.unsubscribe.call_count, 0)
+        job = NokiaJob.objects.get()
+        self.assertEqual(job.task, 'nokiaapp.tasks.unsubscribe')
+        self.assertNotIn(self.nokia_user.access_token, job.kwargs)
+        call_command('nokia_worker')
+        self.assertEqual(NokiaApi.unsubscribe.call_count, 2)
+        self.assertFalse(NokiaJob.objects.exists())
+        self.assertEqual(NokiaUser.objects.count(), 0)
+
+    @override_settings(NOKIA_JOB_BACKEND='nokiaapp.jobs.DatabaseBackend')
+    def test_deferred_error(self):
+        """
+        A failed unsubscribe job should keep the credentials and the
+        subscription records, so that logging out again retries
+        """
+        NokiaJob.objects.all().delete()
+        NokiaSubscription.objects.create(
+            user=self.user, appli=4,
+            callback_url='http://testserver/notification/4/')
+        NokiaApi.unsubscribe.side_effect = Exception('Unavailable')
+        self._get()
+        call_command('nokia_worker')
+        job = NokiaJob.objects.get()
+        self.assertIn('Unavailable', job.error)
+        self.assertNotIn(self.nokia_user.access_token, job.kwargs)
+        self.assertEqual(NokiaUser.objects.count(), 1)
+        self.assertEqual(NokiaSubscription.objects.count(), 1)
+
+        NokiaApi.unsubscribe.side_effect = None
+        NokiaApi.unsubscribe.reset_mock()
+        self._get()
+        call_command('nokia_worker')
+        NokiaApi.unsubscribe.assert_called_once_with(
+            'http://testserver/notification/4/', appli=4)
+        self.assertEqual(NokiaUser.objects.count(), 0)
+        self.assertFalse(NokiaSubscription.objects.exists())
+
     def test_unauthenticated(self):
         """User must be logged in to access Logout view."""
         self.client.logout()
@@ -330,3 +737,82 @@ class TestLogoutView(NokiaTestBase):
         response = self._get(get_kwargs={'next': '/test'})
         self.assertRedirectsNoFollow(response, '/test')
         self.assertEqual(NokiaUser.objects.count(), 0)
+
+
+class TestExportView(NokiaTestBase):
+    url_name = 'nokia-export'
+
+    def setUp(self):
+        super(TestExportView, self).setUp()
+        MeasureGroup.create_from_measures(self.user, self.get_measures)
+        self.other = self.create_user()
+        MeasureGroup.create_from_measures(self.other, self.get_measures)
+
+    def _content(self, response):
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return b''.join(response.streaming_content).decode('utf8')
+
+    def test_csv(self):
+        """ The user's measures should be streamed as CSV """
+        # Read in batches of two
+        with mock.patch('nokiaapp.export.get_setting', return_value=2):
+            response = self._get()
+            content = self._content(response)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(
+            response['Content-Disposition'],
+            'attachment; filename="nokia-measures.csv"')
+        lines = content.splitlines()
+        self.assertEqual(lines[0], 'grpid,date,attrib,category,measure_type,'
+                                   'value,unit,real_value')
+        self.assertEqual(len(lines), 6)
+        self.assertIn('2909,2008-10-02T07:02:48+00:00,0,1,1,79300,-3,79.3',
+                      lines)
+
+    def test_ndjson(self):
+        """ Measures can be exported as JSON lines, filtered by type """
+        response = self._get(get_kwargs=[
+            ('format', 'ndjson'), ('type', 1), ('type', 4)])
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line)
+                for line in self._content(response).splitlines()]
+        self.assertEqual(sorted(row['measure_type'] for row in rows), [1, 4])
+        self.assertEqual(rows[0]['date'], '2008-10-02T07:02:48+00:00')
+
+    def test_filters(self):
+        """ Measures can be filtered by date and category """
+        for get_kwargs, count in (
+                ({'start': '2008-10-02T07:02:49Z'}, 0),
+                ({'end': '1222930968'}, 5),
+                ({'start': '2008-10-02', 'end': '2008-10-03'}, 5),
+                # The whole end day is included
+                ({'start': '2008-10-02', 'end': '2008-10-02'}, 5),
+                ({'end': '2008-10-01'}, 0),
+                ({'category': 2}, 0)):
+            response = self._get(get_kwargs=dict(get_kwargs, format='ndjson'))
+            self.assertEqual(
+                len(self._content(response).splitlines()), count)
+        for get_kwargs in ({'start': 'soon'}, {'type': 'weight'},
+                           {'format': 'xml'},
+                           {'start': '99999999999999999999'},
+                           {'end': '9999-12-31'}):
+            self.assertEqual(self._get(get_kwargs=get_kwargs).status_code,
+                             400)
+
+    def test_other_user(self):
+        """ Only staff can export other users' measures """
+        response = self._get(get_kwargs={'user': self.other.pk})
+        self.assertEqual(len(self._content(response).splitlines()), 6)
+        Measure.objects.filter(user=self.user).delete()
+        response = self._get(get_kwargs={'user': self.other.pk})
+        self.assertEqual(len(self._content(response).splitlines()), 1)
+        self.user.is_staff = True
+        self.user.save()
+        response = self._get(get_kwargs={'user': self.other.pk})
+        self.assertEqual(len(self._content(response).splitlines()), 6)
+
+    def test_unauthenticated(self):
+        """ User must be logged in to export measures """
+        self.client.logout()
+        self.assertEqual(self._get().status_code, 302)
@@ -0,0 +1,248 @@
+import datetime
+import json
+import time
+
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from nokia import NokiaMeasures
+
+from nokiaapp import jobs, utils
+from nokiaapp.models import MeasureGroup, NokiaJob
+
+from .base import NokiaTestBase
+
+try:
+    from unittest import mock
+except ImportError:  # Python 2.x fallback
+    import mock
+
+
+CALLS = []
+
+
+def record_call(**kwargs):
+    CALLS.append(kwargs)
+    return kwargs
+
+
+def fail(**kwargs):
+    raise ValueError('Failed')
+
+
+class TestJobBackends(TestCase):
+    def setUp(self):
+        del CALLS[:]
+
+    def test_get_backend(self):
+        """ get_backend should return one instance of the configured class """
+        backend = jobs.get_backend()
+        self.assertEqual(type(backend), jobs.ImmediateBackend)
+        self.assertIs(jobs.get_backend(), backend)
+        with self.settings(
+                NOKIA_JOB_BACKEND='nokiaapp.jobs.DatabaseBackend'):
+            self.assertEqual(type(jobs.get_backend()), jobs.DatabaseBackend)
+
+    def test_merge_kwargs(self):
+        """ Merging jobs should widen their date ranges """
+        self.assertEqual(
+            jobs.merge_kwargs({'a': 1, 'startdate': 5, 'enddate': 8},
+                              {'a': 2, 'startdate': 3, 'enddate': 7}),
+            {'a': 2, 'startdate': 3, 'enddate': 8})
+        self.assertEqual(
+            jobs.merge_kwargs({'a': 1, 'startdate': 5, 'enddate': 8},
+                              {'a': 1}),
+            {'a': 1})
+
+    def test_immediate(self):
+        jobs.enqueue('nokiaapp.tests.test_jobs.record_call', {'a': 1})
+        self.assertEqual(CALLS, [{'a': 1}])
+
+    def test_database(self):
+        backend = jobs.DatabaseBackend()
+        backend.enqueue('nokiaapp.tests.test_jobs.record_call', {'a': 1})
+        backend.enqueue('nokiaapp.tests.test_jobs.fail', {})
+        backend.enqueue('nokiaapp.tests.test_jobs.record_call', {'a': 2})
+        self.assertEqual(NokiaJob.objects.count(), 3)
+        self.assertEqual(CALLS, [])
+
+        self.assertEqual(backend.run_pending(limit=1), 1)
+        self.assertEqual(CALLS, [{'a': 1}])
+        call_command('nokia_worker')
+        self.assertEqual(CALLS, [{'a': 1}, {'a': 2}])
+        # Only the failed job is kept
+        job = NokiaJob.objects.get()
+        self.assertEqual(job.task, 'nokiaapp.tests.test_jobs.fail')
+        self.assertEqual(json.loads(job.kwargs), {})
+        self.assertTrue(job.started)
+        self.assertIn('Failed', job.error)
+        self.assertEqual(backend.run_pending(), 0)
+
+    @override_settings(NOKIA_JOB_LEASE=60)
+    def test_database_lease(self):
+        """
+        Jobs whose worker died should be run again once their lease expires
+        """
+        backend = jobs.DatabaseBackend()
+        task = 'nokiaapp.tests.test_jobs.record_call'
+        expired = timezone.now() - datetime.timedelta(seconds=61)
+        NokiaJob.objects.create(task=task, kwargs='{"a": 1}',
+                                started=timezone.now())
+        NokiaJob.objects.create(task=task, kwargs='{"a": 2}',
+                                started=expired)
+        NokiaJob.objects.create(task=task, kwargs='{"a": 3}',
+                                started=expired, error="ValueError('Failed')")
+        self.assertEqual(backend.run_pending(), 1)
+        self.assertEqual(CALLS, [{'a': 2}])
+        # Running jobs and failed ones are left alone
+        self.assertEqual(
+            sorted(json.loads(job.kwargs)['a']
+                   for job in NokiaJob.objects.all()), [1, 3])
+        self.assertEqual(backend.run_pending(), 0)
+
+    def test_database_coalesce(self):
+        """
+        Jobs with the same key should be merged until a worker claims them
+        """
+        backend = jobs.DatabaseBackend()
+        task = 'nokiaapp.tests.test_jobs.record_call'
+        job = backend.enqueue(task, {'startdate': 5, 'enddate': 8},
+                              key='a', delay=60)
+        self.assertTrue(job.run_after > timezone.now())
+        backend.enqueue(task, {'startdate': 3, 'enddate': 6}, key='a')
+        backend.enqueue(task, {'c': 1}, key='b')
+        self.assertEqual(NokiaJob.objects.count(), 2)
+        self.assertEqual(json.loads(NokiaJob.objects.get(key='a').kwargs),
+                         {'startdate': 3, 'enddate': 8})
+        # Jobs aren't run before they are due
+        self.assertEqual(backend.run_pending(), 1)
+        self.assertEqual(CALLS, [{'c': 1}])
+        NokiaJob.objects.filter(key='a').update(
+            run_after=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertEqual(backend.run_pending(), 1)
+        self.assertEqual(CALLS, [{'c': 1}, {'startdate': 3, 'enddate': 8}])
+        # A claimed job isn't merged into
+        NokiaJob.objects.create(task=task, kwargs='{}', key='a',
+                                started=timezone.now())
+        backend.enqueue(task, {'d': 1}, key='a')
+        self.assertEqual(NokiaJob.objects.filter(key='a').count(), 2)
+
+
+class TestThreadPoolBackend(TransactionTestCase):
+    """
+    Jobs are only submitted once the transaction queueing them commits, so
+    these tests don't run in one
+    """
+
+    def setUp(self):
+        del CALLS[:]
+
+    def test_thread_pool(self):
+        backend = jobs.ThreadPoolBackend()
+        future = backend.enqueue('nokiaapp.tests.test_jobs.record_call',
+                                 {'a': 1})
+        self.assertEqual(future.result(), {'a': 1})
+        # Errors are logged rather than raised
+        future = backend.enqueue('nokiaapp.tests.test_jobs.fail', {})
+        self.assertEqual(future.result(), None)
+
+    def test_thread_pool_coalesce(self):
+        """ Jobs with the same key should be merged while waiting """
+        backend = jobs.ThreadPoolBackend()
+        for startdate, enddate in ((5, 8), (3, 6), (4, 9)):
+            backend.enqueue('nokiaapp.tests.test_jobs.record_call',
+                            {'startdate': startdate, 'enddate': enddate},
+                            key='a', delay=0.2)
+        backend.enqueue('nokiaapp.tests.test_jobs.record_call', {'b': 1},
+                        key='b', delay=0.2)
+        for i in range(50):
+            if len(CALLS) == 2 and not backend.waiting:
+                break
+            time.sleep(0.1)
+        self.assertEqual(
+            sorted(CALLS, key=lambda c: sorted(c.keys())),
+            [{'b': 1}, {'startdate': 3, 'enddate': 9}])
+
+    def test_on_commit(self):
+        """
+        Jobs queued in a transaction should be submitted once it commits,
+        and dropped if it is rolled back
+        """
+        backend = jobs.ThreadPoolBackend()
+        backend.executor = mock.Mock()
+        with transaction.atomic():
+            self.assertIsNone(backend.enqueue(
+                'nokiaapp.tests.test_jobs.record_call', {'a': 1}))
+            self.assertFalse(backend.executor.submit.called)
+        backend.executor.submit.assert_called_once_with(
+            backend.run, 'nokiaapp.tests.test_jobs.record_call', {'a': 1})
+
+        backend.executor.reset_mock()
+        try:
+            with transaction.atomic():
+                backend.enqueue('nokiaapp.tests.test_jobs.record_call',
+                                {'a': 2})
+                raise ValueError('Rolled back')
+        except ValueError:
+            pass
+        self.assertFalse(backend.executor.submit.called)
+
+
+@override_settings(NOKIA_JOB_BACKEND='nokiaapp.jobs.DatabaseBackend',
+                   NOKIA_NOTIFICATION_WINDOW=0)
+class TestQueuedNotification(NokiaTestBase):
+    def setUp(self):
+        super(TestQueuedNotification, self).setUp()
+        # Logging in queued a refresh of the user's profile
+        NokiaJob.objects.filter(task='nokiaapp.tasks.refresh_profile').delete()
+
+    @mock.patch('nokiaapp.utils.get_nokia_data')
+    def test_notification(self, get_nokia_data):
+        """
+        The notification view should only queue a job, which the worker
+        command processes later
+        """
+        get_nokia_data.return_value = self.get_measures
+        res = self.client.post(
+            reverse('nokia-notification', kwargs={'appli': 1}),
+            data={'userid': self.nokia_user.nokia_user_id})
+        self.assertEqual(res.status_code, 204)
+        self.assertEqual(get_nokia_data.call_count, 0)
+        job = NokiaJob.objects.get()
+        self.assertEqual(job.task, 'nokiaapp.tasks.process_notification')
+
+        call_command('nokia_worker')
+        self.assertEqual(get_nokia_data.call_count, 1)
+        self.assertEqual(MeasureGroup.objects.count(), 3)
+        self.assertEqual(NokiaJob.objects.count(), 0)
+
+    @mock.patch('nokiaapp.utils.get_nokia_data')
+    def test_coalesce(self, get_nokia_data):
+        """
+        Notifications for the same user should be handled by a single fetch
+        covering all of their date ranges
+        """
+        get_nokia_data.return_value = self.get_measures
+        counters = utils.get_counters()
+        url = reverse('nokia-notification', kwargs={'appli': 1})
+        for appli, startdate, enddate in ((1, 20, 30), (4, 10, 25),
+                                          (1, 15, 40)):
+            res = self.client.post(
+                reverse('nokia-notification', kwargs={'appli': appli}),
+                data={'userid': self.nokia_user.nokia_user_id,
+                      'startdate': startdate, 'enddate': enddate})
+            self.assertEqual(res.status_code, 204)
+        res = self.client.post(url, data={'userid': 'abc'})
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(NokiaJob.objects.count(), 1)
+
+        call_command('nokia_worker')
+        get_nokia_data.assert_called_once_with(
+            self.nokia_user, startdate=10, enddate=40)
+        new_counters = utils.get_counters()
+        self.assertEqual(new_counters['notifications_received'],
+                         counters['notifications_received'] + 3)
+        self.assertEqual(new_counters['fetches_performed'],
+                         counters['fetches_performed'] + 1)
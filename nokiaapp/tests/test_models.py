@@ -2,11 +2,17 @@ import arrow
 import datetime
 
 from django.db import IntegrityError
+from django.utils import timezone
 from nokia import NokiaCredentials, NokiaMeasures
-from nokiaapp.models import NokiaUser, Measure, MeasureGroup
+from nokiaapp.models import IngestError, NokiaUser, Measure, MeasureGroup
 
 from .base import NokiaTestBase
 
+try:
+    from unittest import mock
+except ImportError:  # Python 2.x fallback
+    import mock
+
 
 class TestNokiaModels(NokiaTestBase):
     def test_nokia_user(self):
@@ -47,6 +53,55 @@ class TestNokiaModels(NokiaTestBase):
         )
         self.assertEqual(self.nokia_user.refresh_token, token['refresh_token'])
 
+    def test_concurrent_refresh_cb(self):
+        """
+        refresh_cb should only write the token, and only if no other worker
+        stored a refreshed token first
+        """
+        other = NokiaUser.objects.get(pk=self.nokia_user.pk)
+        last_update = timezone.now()
+        NokiaUser.objects.filter(pk=self.nokia_user.pk).update(
+            last_update=last_update)
+        token = {'access_token': 'at1', 'token_type': 'Bearer',
+                 'expires_in': 100, 'refresh_token': 'rt1'}
+        self.nokia_user.refresh_cb(token)
+        self.assertEqual(self.nokia_user.access_token, 'at1')
+
+        other.refresh_cb({'access_token': 'at2', 'token_type': 'Bearer',
+                          'expires_in': 200, 'refresh_token': 'rt2'})
+        # The first token won
+        self.assertEqual(other.access_token, 'at1')
+        self.assertEqual(other.refresh_token, 'rt1')
+        self.assertEqual(other.token_expiry, self.nokia_user.token_expiry)
+        nokia_user = NokiaUser.objects.get(pk=self.nokia_user.pk)
+        self.assertEqual(nokia_user.access_token, 'at1')
+        self.assertEqual(nokia_user.last_update, last_update)
+
+    @mock.patch('requests_oauthlib.OAuth2Session.refresh_token')
+    def test_refresh_access_token(self, refresh_token):
+        """
+        Only the first of several workers refreshing the same expired token
+        should refresh it
+        """
+        refresh_token.return_value = {
+            'access_token': 'at1', 'token_type': 'Bearer',
+            'expires_in': 100, 'refresh_token': 'rt1'}
+        stale = NokiaUser.objects.get(pk=self.nokia_user.pk)
+        self.assertFalse(self.nokia_user.refresh_access_token())
+        self.assertEqual(refresh_token.call_count, 0)
+        # The token expires in 10 seconds
+        self.assertTrue(self.nokia_user.token_expires_within(60))
+        self.assertTrue(self.nokia_user.refresh_access_token(60))
+        self.assertEqual(refresh_token.call_count, 1)
+        self.assertEqual(refresh_token.call_args[1]['client_secret'],
+                         'fakesecret')
+        self.assertEqual(self.nokia_user.access_token, 'at1')
+
+        self.assertFalse(stale.refresh_access_token(60))
+        self.assertEqual(refresh_token.call_count, 1)
+        self.assertEqual(stale.access_token, 'at1')
+        self.assertEqual(stale.refresh_token, 'rt1')
+
     def test_measure_group(self):
         """ Create a MeasureGroup model, check attributes and methods """
         measures = NokiaMeasures({
@@ -94,6 +149,9 @@ class TestNokiaModels(NokiaTestBase):
             MeasureGroup.objects.get(grpid=2909).measures.count(), 1)
         self.assertEqual(
             MeasureGroup.objects.get(grpid=2910).measures.count(), 3)
+        for measure in Measure.objects.select_related('group'):
+            self.assertEqual(measure.user, self.user)
+            self.assertEqual(measure.date, measure.group.date)
         # create_from_measures should silently ignore duplicates
         try:
             MeasureGroup.create_from_measures(self.user, measures)
@@ -107,6 +165,132 @@ class TestNokiaModels(NokiaTestBase):
             date=measures[0].date.datetime,
             updatetime=measures.updatetime.datetime)
 
+    def test_create_from_measures_batches(self):
+        """ create_from_measures should store groups in bulk batches """
+        MeasureGroup.create_from_measures(self.user, NokiaMeasures({
+            "updatetime": 1249409679,
+            "measuregrps": [self.get_measures[0].data]
+        }))
+        self.assertEqual(MeasureGroup.objects.count(), 1)
+        # The existing group is skipped and the rest is stored in two
+        # batches, each in a savepoint with the week's rollups
+        with self.assertNumQueries(19):
+            created = MeasureGroup.create_from_measures(
+                self.user, self.get_measures, batch_size=1)
+        self.assertEqual(created, 2)
+        self.assertEqual(MeasureGroup.objects.count(), 3)
+        self.assertEqual(Measure.objects.count(), 5)
+        self.assertEqual(
+            MeasureGroup.objects.get(grpid=2910).measures.count(), 3)
+        self.assertEqual(
+            MeasureGroup.create_from_measures(self.user, self.get_measures),
+            0)
+
+    def test_create_from_measures_failure(self):
+        """
+        A batch that fails should be rolled back and reported, and storing
+        the measures again should carry on from it
+        """
+        bulk_create = Measure.objects.bulk_create
+
+        def fail_second(objs):
+            if fail_second.calls:
+                raise IntegrityError('Database error')
+            fail_second.calls += 1
+            return bulk_create(objs)
+        fail_second.calls = 0
+
+        with mock.patch.object(Measure.objects, 'bulk_create', fail_second):
+            with self.assertRaises(IngestError) as cm:
+                MeasureGroup.create_from_measures(
+                    self.user, self.get_measures, batch_size=2)
+        self.assertEqual((cm.exception.written, cm.exception.batches),
+                         (2, 1))
+        self.assertEqual(cm.exception.grpids, [2908])
+        self.assertIsInstance(cm.exception.error, IntegrityError)
+        # No group is left without its measures
+        self.assertEqual(
+            sorted(MeasureGroup.objects.values_list('grpid', flat=True)),
+            [2909, 2910])
+        self.assertEqual(Measure.objects.count(), 4)
+
+        self.assertEqual(MeasureGroup.create_from_measures(
+            self.user, self.get_measures, update=True), 1)
+        self.assertEqual(MeasureGroup.objects.count(), 3)
+        self.assertEqual(Measure.objects.count(), 5)
+
+    def test_create_from_measures_unchanged(self):
+        """
+        A newer response carrying the same groups shouldn't rewrite them
+        """
+        MeasureGroup.create_from_measures(self.user, self.get_measures)
+        pks = sorted(MeasureGroup.objects.values_list('pk', flat=True))
+        measure_pks = sorted(Measure.objects.values_list('pk', flat=True))
+        data = dict(self.get_measures.data, updatetime=1249409779)
+        # The measures of a group may come in any order
+        data['measuregrps'][1] = dict(
+            data['measuregrps'][1],
+            measures=data['measuregrps'][1]['measures'][::-1])
+        with mock.patch('nokiaapp.rollups.update') as update:
+            self.assertEqual(MeasureGroup.create_from_measures(
+                self.user, NokiaMeasures(data), update=True), 0)
+        update.assert_called_once_with(self.user, [])
+        self.assertEqual(
+            sorted(MeasureGroup.objects.values_list('pk', flat=True)), pks)
+        self.assertEqual(
+            sorted(Measure.objects.values_list('pk', flat=True)), measure_pks)
+
+    def test_create_from_measures_update(self):
+        """
+        create_from_measures should rewrite changed groups and remove deleted
+        ones when updating
+        """
+        MeasureGroup.create_from_measures(self.user, self.get_measures)
+        updated = NokiaMeasures({
+            "updatetime": 1249409680,
+            "measuregrps": [{
+                "grpid": 2909,
+                "attrib": 2,
+                "date": 1222930968,
+                "category": 1,
+                "measures": [{"value": 80100, "type": 1, "unit": -3}]
+            }, {
+                "grpid": 2910,
+                "attrib": 1,
+                "date": 1222930968,
+                "category": 1,
+                "measures": []
+            }, {
+                "grpid": 2911,
+                "attrib": 0,
+                "date": 1222930970,
+                "category": 1,
+                "measures": [{"value": 172, "type": 4, "unit": -2}]
+            }]
+        })
+        # Without update, only the new group is stored
+        self.assertEqual(
+            MeasureGroup.create_from_measures(self.user, updated), 1)
+        self.assertEqual(
+            MeasureGroup.objects.get(grpid=2909).measures.get().value, 79300)
+        self.assertEqual(
+            MeasureGroup.objects.get(grpid=2910).measures.count(), 3)
+
+        self.assertEqual(MeasureGroup.create_from_measures(
+            self.user, updated, update=True), 1)
+        self.assertEqual(
+            sorted(MeasureGroup.objects.values_list('grpid', flat=True)),
+            [2908, 2909, 2911])
+        self.assertEqual(Measure.objects.count(), 3)
+        group = MeasureGroup.objects.get(grpid=2909)
+        self.assertEqual(group.attrib, 2)
+        self.assertEqual(arrow.get(group.updatetime).timestamp, 1249409680)
+        self.assertEqual(group.measures.get().value, 80100)
+        # Groups that haven't changed since are left alone
+        self.assertEqual(MeasureGroup.create_from_measures(
+            self.user, updated, update=True), 0)
+        self.assertEqual(MeasureGroup.objects.get(grpid=2909).pk, group.pk)
+
     def test_measure(self):
         """ Create a Measure model, check attributes and methods """
         nokia_measures = NokiaMeasures({
@@ -127,10 +311,78 @@ class TestNokiaModels(NokiaTestBase):
             updatetime=nokia_measures.updatetime.datetime)
         measure = Measure.objects.create(
             group=measure_grp, value=79300, measure_type=1, unit=-3)
+        # The user and date are copied from the group
+        self.assertEqual(measure.user_id, self.user.pk)
+        self.assertEqual(measure.date, measure_grp.date)
         self.assertEqual(measure.__str__(), 'Weight (kg): 79.3')
         self.assertEqual(measure.value, 79300)
         self.assertEqual(measure.measure_type, 1)
         self.assertEqual(measure.unit, -3)
         self.assertEqual(measure.get_value(), 79.3)
+        self.assertEqual(measure.real_value, 79.3)
+        measure.unit = -2
+        measure.save()
+        self.assertEqual(Measure.objects.get(pk=measure.pk).real_value, 793)
         self.assertEqual(measure.get_measure_type_display(), 'Weight (kg)')
         self.assertEqual(measure.weight, 1)
+
+    def test_series(self):
+        """
+        Measure.objects.series should return (date, real value) pairs
+        computed by the database
+        """
+        MeasureGroup.create_from_measures(self.user, self.get_measures)
+        MeasureGroup.create_from_measures(self.user, NokiaMeasures({
+            "updatetime": 1249409679,
+            "measuregrps": [{
+                "grpid": 2911,
+                "attrib": 0,
+                "date": 1222930968 + 86400,
+                "category": 1,
+                "measures": [{"value": 80, "type": 1, "unit": 0}]
+            }, {
+                "grpid": 2912,
+                "attrib": 0,
+                "date": 1222930968 + 86400,
+                "category": 2,
+                "measures": [{"value": 75, "type": 1, "unit": 0}]
+            }]
+        }))
+        date = arrow.get(1222930968).datetime
+        with self.assertNumQueries(1):
+            series = list(Measure.objects.series(
+                self.user, Measure.weight).iterator())
+        self.assertEqual(
+            [(d, round(v, 6)) for d, v in series],
+            [(date, 79.3), (date + datetime.timedelta(days=1), 80)])
+        self.assertEqual(
+            sorted(v for d, v in Measure.objects.series(
+                self.user, Measure.weight,
+                start=date + datetime.timedelta(hours=1), category=None)),
+            [75, 80])
+        self.assertEqual(
+            [round(v, 6) for d, v in Measure.objects.series(
+                self.user, Measure.height, end=date)],
+            [1.73])
+        self.assertEqual(
+            list(Measure.objects.series(self.user, Measure.weight,
+                                        end=date - datetime.timedelta(1))),
+            [])
+        for measure in Measure.objects.all():
+            self.assertEqual(measure.real_value, measure.get_value())
+        self.assertEqual(
+            list(Measure.objects.filter(
+                measure_type=Measure.weight, real_value__gt=79
+            ).values_list('group__grpid', flat=True).order_by('group__grpid')),
+            [2909, 2911])
+
+        self.assertEqual(
+            list(MeasureGroup.objects.between(self.user).values_list(
+                'grpid', flat=True)),
+            [2909, 2910, 2908, 2911])
+        self.assertEqual(
+            list(MeasureGroup.objects.between(
+                self.user, start=date + datetime.timedelta(hours=1),
+                category=MeasureGroup.objective).values_list(
+                    'grpid', flat=True)),
+            [2912])
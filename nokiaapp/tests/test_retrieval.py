@@ -5,6 +5,7 @@ from freezegun import freeze_time
 
 from nokia import NokiaMeasures
 
+from nokiaapp import tasks
 from nokiaapp.models import NokiaUser, MeasureGroup, Measure
 
 from .base import NokiaTestBase
@@ -133,6 +134,104 @@ class TestRetrievalTask(NokiaTestBase):
         self.assertEqual(Measure.objects.count(), 5)
         self.assertEqual(MeasureGroup.objects.count(), 3)
 
+    @mock.patch('nokiaapp.utils.get_nokia_data')
+    def test_sync_cursor(self, get_nokia_data):
+        """
+        Syncs should start from the updatetime of the last sync's response,
+        which moves forward only once all the measures are stored
+        """
+        last_update = arrow.get(1249409000).datetime
+        NokiaUser.objects.filter(pk=self.nokia_user.pk).update(
+            last_update=last_update)
+        get_nokia_data.return_value = NokiaMeasures(self.nokia_measures)
+        tasks.process_notification(self.nokia_user.nokia_user_id)
+        get_nokia_data.assert_called_once_with(
+            mock.ANY, lastupdate=last_update)
+        cursor = arrow.get(1249409679).datetime
+        self.assertEqual(
+            NokiaUser.objects.get(pk=self.nokia_user.pk).sync_cursor, cursor)
+
+        # The next sync only gets the group updated since
+        self.nokia_measures['updatetime'] = 1249409779
+        self.nokia_measures['measuregrps'] = \
+            self.nokia_measures['measuregrps'][:1]
+        self.nokia_measures['measuregrps'][0]['measures'][0]['value'] = 79400
+        get_nokia_data.reset_mock()
+        get_nokia_data.return_value = NokiaMeasures(self.nokia_measures)
+        tasks.process_notification(self.nokia_user.nokia_user_id)
+        get_nokia_data.assert_called_once_with(mock.ANY, lastupdate=cursor)
+        cursor = arrow.get(1249409779).datetime
+        self.assertEqual(
+            NokiaUser.objects.get(pk=self.nokia_user.pk).sync_cursor, cursor)
+        self.assertEqual(MeasureGroup.objects.count(), 3)
+        self.assertEqual(Measure.objects.get(measure_type=1).value, 79400)
+
+        # Failed syncs don't move the cursor. A batch that fails is rolled
+        # back with its rollups.
+        self.nokia_measures['updatetime'] = 1249409879
+        self.nokia_measures['measuregrps'][0]['measures'][0]['value'] = 79500
+        get_nokia_data.return_value = NokiaMeasures(self.nokia_measures)
+        with mock.patch('nokiaapp.rollups.update',
+                        side_effect=Exception('Database error')):
+            tasks.process_notification(self.nokia_user.nokia_user_id)
+        self.assertEqual(Measure.objects.get(measure_type=1).value, 79400)
+        self.assertEqual(
+            NokiaUser.objects.get(pk=self.nokia_user.pk).sync_cursor, cursor)
+        # Batches stored before a failure are kept
+        with mock.patch.object(NokiaUser, 'save',
+                               side_effect=Exception('Database error')):
+            tasks.process_notification(self.nokia_user.nokia_user_id)
+        self.assertEqual(Measure.objects.get(measure_type=1).value, 79500)
+        self.assertEqual(
+            NokiaUser.objects.get(pk=self.nokia_user.pk).sync_cursor, cursor)
+
+        # Date ranges don't cover every update
+        self.nokia_measures['updatetime'] = 1249409979
+        self.nokia_measures['measuregrps'][0]['measures'][0]['value'] = 79600
+        get_nokia_data.return_value = NokiaMeasures(self.nokia_measures)
+        tasks.process_notification(
+            self.nokia_user.nokia_user_id, self.startdate, self.enddate)
+        self.assertEqual(Measure.objects.get(measure_type=1).value, 79600)
+        self.assertEqual(
+            NokiaUser.objects.get(pk=self.nokia_user.pk).sync_cursor, cursor)
+
+    @mock.patch('nokiaapp.utils.get_nokia_data')
+    def test_sync_pages(self, get_nokia_data):
+        """
+        A sync returned in several responses should store them all, and
+        only then move the cursor to the first one's updatetime
+        """
+        last_update = arrow.get(1249409000).datetime
+        NokiaUser.objects.filter(pk=self.nokia_user.pk).update(
+            sync_cursor=last_update)
+        groups = self.nokia_measures['measuregrps']
+        get_nokia_data.side_effect = [
+            NokiaMeasures(dict(self.nokia_measures, measuregrps=groups[:2],
+                               more=1, offset=2)),
+            Exception('Error code 601'),
+        ]
+        tasks.process_notification(self.nokia_user.nokia_user_id)
+        self.assertEqual(MeasureGroup.objects.count(), 2)
+        self.assertEqual(
+            NokiaUser.objects.get(pk=self.nokia_user.pk).sync_cursor,
+            last_update)
+
+        get_nokia_data.reset_mock()
+        get_nokia_data.side_effect = [
+            NokiaMeasures(dict(self.nokia_measures, measuregrps=groups[:2],
+                               more=1, offset=2)),
+            NokiaMeasures(dict(self.nokia_measures, measuregrps=groups[2:],
+                               updatetime=1249409779)),
+        ]
+        tasks.process_notification(self.nokia_user.nokia_user_id)
+        self.assertEqual(get_nokia_data.call_args_list, [
+            mock.call(mock.ANY, lastupdate=last_update),
+            mock.call(mock.ANY, lastupdate=last_update, offset=2)])
+        self.assertEqual(MeasureGroup.objects.count(), 3)
+        self.assertEqual(
+            NokiaUser.objects.get(pk=self.nokia_user.pk).sync_cursor,
+            arrow.get(1249409679).datetime)
+
     def test_notification_error(self):
         res = self.client.post(
             reverse('nokia-notification', kwargs={'appli': 4}))
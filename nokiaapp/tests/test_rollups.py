@@ -0,0 +1,182 @@
+import arrow
+import datetime
+
+from django.core.management import call_command
+from django.test import override_settings
+from django.utils import timezone
+from django.utils.six import StringIO
+from nokia import NokiaMeasures
+
+from nokiaapp import rollups
+from nokiaapp.models import Measure, MeasureGroup, MeasureRollup
+
+from .base import NokiaTestBase
+
+try:
+    from unittest import mock
+except ImportError:  # Python 2.x fallback
+    import mock
+
+
+# Thursday 2008-10-02 02:02:48 in America/Chicago
+DATE = 1222930968
+
+
+def local(*args):
+    return timezone.make_aware(datetime.datetime(*args),
+                               timezone.get_default_timezone())
+
+
+class TestRollups(NokiaTestBase):
+    def weights(self, *values, **kwargs):
+        """ Weight groups, one per (grpid, date offset in days, kg) """
+        return NokiaMeasures({
+            "updatetime": kwargs.get('updatetime', 1249409679),
+            "measuregrps": [{
+                "grpid": grpid,
+                "attrib": 0,
+                "date": DATE + days * 86400,
+                "category": kwargs.get('category', 1),
+                "measures": [{"value": kg * 10, "type": 1, "unit": -1}]
+            } for grpid, days, kg in values]
+        })
+
+    def get_rollups(self, resolution):
+        return [(r.start, r.count, round(r.total, 6), r.minimum, r.maximum,
+                 r.first, r.last)
+                for r in MeasureRollup.objects.filter(
+                    user=self.user, measure_type=Measure.weight,
+                    resolution=resolution).order_by('start')]
+
+    def test_buckets(self):
+        """ Buckets should start at local midnight, Monday and the 1st """
+        date = arrow.get(DATE).datetime
+        self.assertEqual(rollups.bucket_start(date, rollups.DAY),
+                         local(2008, 10, 2))
+        self.assertEqual(rollups.bucket_start(date, rollups.WEEK),
+                         local(2008, 9, 29))
+        self.assertEqual(rollups.bucket_start(date, rollups.MONTH),
+                         local(2008, 10, 1))
+        # Across the end of daylight saving time
+        self.assertEqual(rollups.bucket_end(local(2008, 11, 2), rollups.DAY),
+                         local(2008, 11, 3))
+        self.assertEqual(
+            rollups.bucket_end(local(2008, 12, 1), rollups.MONTH),
+            local(2009, 1, 1))
+
+    @override_settings(TIME_ZONE='America/Santiago')
+    def test_missing_midnight(self):
+        """ Buckets should start when DST starts at midnight """
+        # Clocks went from midnight to 1am on August 12th 2018
+        date = arrow.get('2018-08-12T12:00:00-03:00').datetime
+        start = rollups.bucket_start(date, rollups.DAY)
+        self.assertEqual(start,
+                         arrow.get('2018-08-12T01:00:00-03:00').datetime)
+        self.assertEqual(rollups.bucket_start(start, rollups.DAY), start)
+        self.assertEqual(rollups.bucket_end(start, rollups.DAY),
+                         arrow.get('2018-08-13T00:00:00-03:00').datetime)
+        self.assertEqual(rollups.bucket_start(date, rollups.WEEK),
+                         arrow.get('2018-08-06T00:00:00-04:00').datetime)
+        # Measures of that day can be stored
+        MeasureGroup.create_from_measures(self.user, self.weights(
+            (1, (arrow.get(date).timestamp - DATE) / 86400.0, 80)))
+        self.assertEqual(self.get_rollups(MeasureRollup.DAY),
+                         [(start, 1, 80, 80, 80, 80, 80)])
+
+    def test_create_from_measures(self):
+        """ Ingesting measures should keep the rollups up to date """
+        MeasureGroup.create_from_measures(self.user, self.weights(
+            (1, 0, 80), (2, 0, 82), (3, 1, 81), (4, 5, 79)))
+        # Objectives aren't summarized
+        MeasureGroup.create_from_measures(self.user, self.weights(
+            (5, 0, 70), category=MeasureGroup.objective))
+        self.assertEqual(self.get_rollups(MeasureRollup.DAY), [
+            (local(2008, 10, 2), 2, 162, 80, 82, 80, 82),
+            (local(2008, 10, 3), 1, 81, 81, 81, 81, 81),
+            (local(2008, 10, 7), 1, 79, 79, 79, 79, 79),
+        ])
+        self.assertEqual(self.get_rollups(MeasureRollup.WEEK), [
+            (local(2008, 9, 29), 3, 243, 80, 82, 80, 81),
+            (local(2008, 10, 6), 1, 79, 79, 79, 79, 79),
+        ])
+        self.assertEqual(MeasureRollup.objects.filter(
+            user=self.user).exclude(measure_type=Measure.weight).count(), 0)
+
+        # Changed and deleted groups are reflected too
+        updated = self.weights((3, 1, 85), (4, 5, 79), updatetime=1249409680)
+        updated[1].measures = []
+        MeasureGroup.create_from_measures(self.user, updated, update=True)
+        self.assertEqual(self.get_rollups(MeasureRollup.DAY), [
+            (local(2008, 10, 2), 2, 162, 80, 82, 80, 82),
+            (local(2008, 10, 3), 1, 85, 85, 85, 85, 85),
+        ])
+        self.assertEqual(self.get_rollups(MeasureRollup.WEEK), [
+            (local(2008, 9, 29), 3, 247, 80, 85, 80, 85),
+        ])
+
+    def test_update_weeks(self):
+        """
+        Only the weeks with changed measures should be recomputed, with one
+        query per run of consecutive weeks
+        """
+        MeasureGroup.create_from_measures(self.user, self.weights(
+            (1, 0, 80), (2, 7, 81), (3, 70, 82)))
+        with mock.patch('nokiaapp.rollups._store') as store:
+            rollups.update(self.user, [
+                arrow.get(DATE + days * 86400).datetime
+                for days in (70, 0, 1, 7)])
+        self.assertEqual(store.call_args_list, [
+            mock.call(self.user, local(2008, 9, 29), local(2008, 10, 13)),
+            mock.call(self.user, local(2008, 12, 8), local(2008, 12, 15)),
+        ])
+        # A week between the two runs isn't touched
+        MeasureRollup.objects.filter(
+            user=self.user, start=local(2008, 10, 6)).delete()
+        rollups.update(self.user, [arrow.get(DATE).datetime,
+                                   arrow.get(DATE + 70 * 86400).datetime])
+        self.assertEqual([r[0] for r in self.get_rollups(
+            MeasureRollup.WEEK)], [local(2008, 9, 29), local(2008, 12, 8)])
+
+    def test_summarize(self):
+        """
+        summarize should read the rollups when the range is aligned to the
+        buckets, and compute them from the measures otherwise
+        """
+        MeasureGroup.create_from_measures(self.user, self.weights(
+            (1, 0, 80), (2, 1, 82), (3, 40, 78)))
+        with self.assertNumQueries(1):
+            days = rollups.summarize(self.user, Measure.weight, rollups.DAY,
+                                     local(2008, 10, 3), local(2008, 11, 12))
+        self.assertEqual([(r.pk is not None, r.start, r.average)
+                          for r in days],
+                         [(True, local(2008, 10, 3), 82),
+                          (True, local(2008, 11, 11), 78)])
+
+        months = rollups.summarize(
+            self.user, Measure.weight, rollups.MONTH)
+        self.assertEqual(
+            [(r.start, r.count, r.minimum, r.maximum, r.first, r.last)
+             for r in months],
+            [(local(2008, 10, 1), 2, 80, 82, 80, 82),
+             (local(2008, 11, 1), 1, 78, 78, 78, 78)])
+
+        # Starting mid-day, the first measure is left out
+        weeks = rollups.summarize(
+            self.user, Measure.weight, rollups.WEEK, local(2008, 10, 2, 12))
+        self.assertEqual([(r.pk, r.start, r.count) for r in weeks],
+                         [(None, local(2008, 9, 29), 1),
+                          (None, local(2008, 11, 10), 1)])
+
+    def test_rebuild_command(self):
+        """ nokia_rebuild_rollups should recompute the stored rollups """
+        MeasureGroup.create_from_measures(self.user, self.weights(
+            (1, 0, 80), (2, 1, 82)))
+        expected = self.get_rollups(MeasureRollup.DAY)
+        MeasureRollup.objects.filter(start=local(2008, 10, 3)).delete()
+        MeasureRollup.objects.update(count=10)
+        out = StringIO()
+        call_command('nokia_rebuild_rollups', stdout=out)
+        self.assertEqual(out.getvalue(),
+                         'Rebuilt rollups for 1 user(s), 0 failed\n')
+        self.assertEqual(self.get_rollups(MeasureRollup.DAY), expected)
+        self.assertEqual(len(self.get_rollups(MeasureRollup.WEEK)), 1)
@@ -0,0 +1,125 @@
+import json
+
+from nokiaapp.models import Measure, MeasureGroup
+from nokiaapp.records import GroupRecord, records, to_datetimes
+from nokiaapp.streaming import StatusError, StreamedMeasures, get_measures
+
+from .base import NokiaTestBase
+
+try:
+    from unittest import mock
+except ImportError:  # Python 2.x fallback
+    import mock
+
+
+class TestStreamedMeasures(NokiaTestBase):
+    def _chunks(self, data, size=1):
+        body = json.dumps(data, ensure_ascii=False).encode('utf8')
+        return [body[i:i + size] for i in range(0, len(body), size)]
+
+    def _response(self, **body):
+        data = dict(self.get_measures.data, **body)
+        return {'status': 0, 'body': data}
+
+    def test_parse(self):
+        """
+        Groups should be parsed one at a time, however the body is split,
+        with the other fields as attributes
+        """
+        close = mock.Mock()
+        measures = StreamedMeasures(self._chunks(self._response(
+            timezone=u'Europe/Z\xfcrich', more=1, offset=12345678)),
+            close=close)
+        self.assertEqual(measures.updatetime,
+                         self.get_measures.updatetime)
+        self.assertEqual(len(measures), 0)
+        groups = list(measures)
+        self.assertEqual([g.data for g in groups],
+                         [g.data for g in self.get_measures])
+        self.assertEqual(groups[1].fat_ratio, self.get_measures[1].fat_ratio)
+        self.assertEqual(len(measures), 3)
+        self.assertEqual(measures.timezone, u'Europe/Z\xfcrich')
+        self.assertEqual((measures.more, measures.offset), (1, 12345678))
+        close.assert_called_once_with()
+
+    def test_updatetime_last(self):
+        """ Groups should be kept until a late updatetime is read """
+        data = self._response()
+        body = data.pop('body')
+        text = '{"body": {"measuregrps": %s, "updatetime": %d}, ' \
+            '"status": 0}' % (json.dumps(body['measuregrps']),
+                              body['updatetime'])
+        measures = StreamedMeasures([text[:40].encode(), text[40:].encode()])
+        self.assertEqual(measures.updatetime, self.get_measures.updatetime)
+        self.assertEqual(len(list(measures)), 3)
+
+    def test_error(self):
+        """ A response reporting an error should raise its status """
+        close = mock.Mock()
+        with self.assertRaises(Exception) as cm:
+            StreamedMeasures(self._chunks({'status': 601}), close=close)
+        self.assertEqual(str(cm.exception), 'Error code 601')
+        close.assert_called_once_with()
+        # Truncated responses
+        with self.assertRaises(ValueError):
+            list(StreamedMeasures(
+                [b'{"status": 0, "body": {"measuregrps": [{']))
+
+    @mock.patch('time.sleep')
+    def test_retry(self, sleep):
+        """
+        Responses reporting a status worth retrying should be requested
+        again, without the adapter reading the streamed bodies
+        """
+        def response(data):
+            return mock.Mock(**{'iter_content.return_value': iter(
+                self._chunks(data, 1000))})
+
+        api = mock.Mock(URL='https://example.com')
+        responses = [response({'status': 601}), response(self._response())]
+        api.client.request.side_effect = responses
+        measures = get_measures(api, lastupdate=1249409000)
+        self.assertEqual(len(list(measures)), 3)
+        self.assertEqual(api.client.request.call_count, 2)
+        self.assertEqual(sleep.call_count, 1)
+        responses[0].close.assert_called_once_with()
+
+        # Other errors aren't retried, nor errors after NOKIA_MAX_RETRIES
+        api.client.request.reset_mock()
+        api.client.request.side_effect = [response({'status': 342})]
+        with self.assertRaises(StatusError) as cm:
+            get_measures(api)
+        self.assertEqual(cm.exception.status, 342)
+        api.client.request.side_effect = [
+            response({'status': 2555}), response({'status': 2555})]
+        with self.settings(NOKIA_MAX_RETRIES=1):
+            self.assertRaises(StatusError, get_measures, api)
+        self.assertEqual(api.client.request.call_count, 3)
+
+    def test_store(self):
+        """ Streamed measures should be stored like NokiaMeasures """
+        written = MeasureGroup.create_from_measures(
+            self.user, StreamedMeasures(self._chunks(self._response(), 7)),
+            batch_size=2)
+        self.assertEqual(written, 3)
+        self.assertEqual(Measure.objects.count(), 5)
+        # Empty responses are fine too
+        self.assertEqual(MeasureGroup.create_from_measures(
+            self.user, StreamedMeasures(self._chunks(
+                self._response(measuregrps=[])))), 0)
+
+    def test_records(self):
+        """
+        Records should hold the same groups, read from the response or
+        from NokiaMeasures, with dates converted once per batch
+        """
+        streamed = list(StreamedMeasures(
+            self._chunks(self._response())).records())
+        self.assertEqual(streamed, list(records(self.get_measures)))
+        group = self.get_measures[1]
+        self.assertEqual(streamed[1], GroupRecord(
+            group.grpid, group.attrib, group.category, 1222930968,
+            ((652, 5, -1), (178, 6, -1), (14125, 8, -3))))
+        dates = to_datetimes(record.date for record in streamed)
+        self.assertEqual(list(dates), [1222930968])
+        self.assertEqual(dates[1222930968], group.date.datetime)
@@ -0,0 +1,96 @@
+import threading
+import time
+
+from django.test import TestCase
+from nokia import NokiaApi
+
+from nokiaapp import subscriptions
+
+try:
+    from unittest import mock
+except ImportError:  # Python 2.x fallback
+    import mock
+
+
+class TestSubscriptions(TestCase):
+    def setUp(self):
+        self.user_data = {
+            'access_token': 'abc',
+            'token_expiry': int(time.time()) + 3600,
+            'token_type': 'Bearer',
+            'refresh_token': '123',
+            'user_id': 1111111,
+        }
+
+    def test_concurrently(self):
+        """ Calls should be made at the same time, results kept in order """
+        barrier = threading.Barrier(3) if hasattr(threading, 'Barrier') \
+            else None
+
+        def call(value, offset=0):
+            if barrier:
+                # Blocks unless all three calls are running at once
+                barrier.wait(5)
+            return value + offset
+
+        self.assertEqual(subscriptions.concurrently([
+            (call, (1,), {}), (call, (2,), {'offset': 10}), (call, (3,), {}),
+        ], time.time() + 10), [1, 12, 3])
+        self.assertEqual(subscriptions.concurrently([], time.time()), [])
+
+    def test_concurrently_errors(self):
+        """
+        Failed calls and calls running past the deadline should raise a
+        SubscriptionError, without waiting for the late calls
+        """
+        event = threading.Event()
+
+        def fail():
+            raise ValueError('Bad')
+
+        with self.assertRaises(subscriptions.SubscriptionError) as cm:
+            subscriptions.concurrently([
+                (fail, (), {}), (lambda: 1, (), {}),
+            ], time.time() + 10)
+        self.assertIn("ValueError('Bad'", str(cm.exception))
+
+        start = time.time()
+        with self.assertRaises(subscriptions.SubscriptionError) as cm:
+            subscriptions.concurrently([
+                (event.wait, (10,), {}), (lambda: 1, (), {}),
+            ], time.time() + 0.1)
+        self.assertLess(time.time() - start, 5)
+        self.assertIn('1 timed out', str(cm.exception))
+        event.set()
+
+    @mock.patch.object(NokiaApi, 'subscribe')
+    def test_subscribe(self, subscribe):
+        """ Each notification should be subscribed to """
+        subscriptions.subscribe(self.user_data, [
+            [1, 'http://testserver/notification/1/'],
+            [4, 'http://testserver/notification/4/'],
+        ])
+        subscribe.assert_has_calls([
+            mock.call('http://testserver/notification/%s/' % appli,
+                      'django-nokia', appli=appli) for appli in [1, 4]
+        ], any_order=True)
+
+    @mock.patch.object(NokiaApi, 'subscribe')
+    def test_expired_token(self, subscribe):
+        """ An expired token should be refreshed once, before the calls """
+        self.user_data['token_expiry'] = int(time.time()) - 1
+        token = {'access_token': 'def', 'refresh_token': '456',
+                 'token_type': 'Bearer', 'expires_in': 3600}
+        refresh_cb = mock.Mock()
+        self.user_data['refresh_cb'] = refresh_cb
+        with mock.patch('requests_oauthlib.OAuth2Session.refresh_token',
+                        return_value=token) as refresh_token:
+            subscriptions.subscribe(self.user_data, [
+                [1, 'http://testserver/notification/1/'],
+                [4, 'http://testserver/notification/4/'],
+            ])
+        refresh_token.assert_called_once_with(
+            'https://account.withings.com/oauth2/token', client_id=mock.ANY,
+            client_secret=mock.ANY)
+        refresh_cb.assert_called_once_with(token)
+        self.assertEqual(subscribe.call_count, 2)
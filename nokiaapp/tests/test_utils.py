@@ -1,8 +1,23 @@
+import time
+
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
-from nokia import NokiaApi
+from nokia import NokiaApi, NokiaMeasures
+from requests import Response
+from requests.adapters import HTTPAdapter
+
+from nokiaapp.ratelimit import CacheTokenBucket, TokenBucket, get_limiter
+from nokiaapp.transport import NokiaAdapter, get_adapter
+from nokiaapp.utils import (
+    create_nokia, fetch_window, get_setting, next_window)
+
+from .base import NokiaTestBase
 
-from nokiaapp.utils import create_nokia, get_setting
+try:
+    from unittest import mock
+except ImportError:  # Python 2.x fallback
+    import mock
 
 
 class TestNokiaUtilities(TestCase):
@@ -25,9 +40,183 @@ class TestNokiaUtilities(TestCase):
                          get_setting('NOKIA_CONSUMER_SECRET'))
         self.assertEqual(api.credentials.token_expiry, 1534796425)
         self.assertTrue(int(api.token['expires_in']) < 0)
+        adapter = api.client.get_adapter(NokiaApi.URL)
+        self.assertEqual(type(adapter), NokiaAdapter)
+        # The connection pool is shared with other instances
+        other = create_nokia(token_expiry=0)
+        self.assertIs(other.client.get_adapter(NokiaApi.URL), adapter)
+        self.assertIs(adapter, get_adapter())
+        self.assertEqual(adapter.max_retries.total,
+                         get_setting('NOKIA_HTTP_RETRIES'))
+        with self.settings(NOKIA_HTTP_POOL_SIZE=3):
+            api = create_nokia(token_expiry=0)
+            adapter = api.client.get_adapter(NokiaApi.URL)
+            self.assertEqual(adapter._pool_maxsize, 3)
 
     def test_get_setting_error(self):
         """
         Check that an error is raised when trying to get a nonexistent setting.
         """
         self.assertRaises(ImproperlyConfigured, get_setting, 'DOES_NOT_EXIST')
+
+
+class TestRateLimit(TestCase):
+    def test_token_bucket(self):
+        """ The bucket should allow bursts up to its capacity, then wait """
+        bucket = TokenBucket(10, capacity=2)
+        self.assertEqual(bucket.take(), 0)
+        self.assertEqual(bucket.take(), 0)
+        wait = bucket.take()
+        self.assertTrue(0 < wait <= 0.1)
+        start = time.time()
+        bucket.acquire()
+        self.assertTrue(time.time() - start >= wait * 0.9)
+
+    def test_get_limiter(self):
+        """ The limiter should be configured by settings """
+        self.assertEqual(get_limiter(), None)
+        with self.settings(NOKIA_RATE_LIMIT=5):
+            limiter = get_limiter()
+            self.assertEqual(type(limiter), TokenBucket)
+            self.assertEqual(limiter.capacity, 5)
+            self.assertIs(get_limiter(), limiter)
+            with self.settings(NOKIA_RATE_LIMIT_BURST=2,
+                               NOKIA_RATE_LIMIT_SHARED=True):
+                limiter = get_limiter()
+                self.assertEqual(type(limiter), CacheTokenBucket)
+                self.assertEqual(limiter.capacity, 2)
+
+    @mock.patch('time.time')
+    def test_cache_token_bucket(self, time):
+        """ The cache bucket should limit requests in each window """
+        cache.clear()
+        bucket = CacheTokenBucket(100, capacity=2)
+        other = CacheTokenBucket(100, capacity=2)
+        time.return_value = 1000.005
+        waits = [bucket.take(), other.take(), bucket.take()]
+        self.assertEqual(waits[:2], [0, 0])
+        self.assertAlmostEqual(waits[2], 0.015)
+        # The next window allows more requests
+        time.return_value = 1000.025
+        self.assertEqual(other.take(), 0)
+
+
+class TestNokiaAdapter(TestCase):
+    def _response(self, status_code=200, content=b'{"status": 0}'):
+        response = Response()
+        response.status_code = status_code
+        response._content = content
+        response.raw = mock.Mock()
+        return response
+
+    @mock.patch('time.sleep')
+    @mock.patch.object(HTTPAdapter, 'send')
+    def test_retry(self, send, sleep):
+        """ Failed requests should be retried with backoff """
+        responses = [
+            self._response(503),
+            self._response(429),
+            self._response(content=b'{"status": 601}'),
+            self._response(),
+        ]
+        send.side_effect = responses
+        adapter = NokiaAdapter()
+        self.assertIs(adapter.send(mock.Mock()), responses[3])
+        self.assertEqual(send.call_count, 4)
+        self.assertEqual(sleep.call_count, 3)
+        for attempt, call in enumerate(sleep.call_args_list):
+            self.assertTrue(0 <= call[0][0] <= 0.5 * 2 ** attempt)
+
+        # Give up after NOKIA_MAX_RETRIES
+        send.reset_mock()
+        send.side_effect = [self._response(500)] * 3
+        with self.settings(NOKIA_MAX_RETRIES=2):
+            self.assertEqual(adapter.send(mock.Mock()).status_code, 500)
+        self.assertEqual(send.call_count, 3)
+
+        # Other errors aren't retried
+        send.reset_mock()
+        send.side_effect = [self._response(content=b'{"status": 342}')]
+        adapter.send(mock.Mock())
+        send.side_effect = [self._response(404, content=b'Not found')]
+        adapter.send(mock.Mock())
+        self.assertEqual(send.call_count, 2)
+
+    @mock.patch('time.sleep')
+    @mock.patch.object(HTTPAdapter, 'send')
+    def test_stream(self, send, sleep):
+        """
+        The bodies of streamed responses should be left for the caller to
+        check
+        """
+        response = self._response(content=b'{"status": 601}')
+        response.headers['Content-Length'] = '15'
+        send.side_effect = [response]
+        self.assertIs(NokiaAdapter().send(mock.Mock(), stream=True),
+                      response)
+        self.assertEqual(send.call_count, 1)
+
+    @mock.patch.object(HTTPAdapter, 'send')
+    def test_rate_limit(self, send):
+        """ Requests should wait on the rate limiter """
+        send.return_value = self._response()
+        with self.settings(NOKIA_RATE_LIMIT=1000):
+            limiter = get_limiter()
+            with mock.patch.object(limiter, 'acquire') as acquire:
+                NokiaAdapter().send(mock.Mock())
+                acquire.assert_called_once_with()
+
+    @mock.patch.object(HTTPAdapter, 'send')
+    def test_timeout(self, send):
+        """ Requests without a timeout should use NOKIA_HTTP_TIMEOUT """
+        send.return_value = self._response()
+        request = mock.Mock()
+        NokiaAdapter().send(request)
+        send.assert_called_once_with(request, timeout=30)
+        send.reset_mock()
+        NokiaAdapter().send(request, timeout=5)
+        send.assert_called_once_with(request, timeout=5)
+
+
+class TestFetchWindow(NokiaTestBase):
+    def _measures(self, grpids, **kwargs):
+        data = {'updatetime': 1249409679, 'measuregrps': [{
+            'grpid': grpid, 'attrib': 0, 'date': 1222930968, 'category': 1,
+            'measures': [{'value': 79300, 'type': 1, 'unit': -3}],
+        } for grpid in grpids]}
+        data.update(kwargs)
+        return NokiaMeasures(data)
+
+    @mock.patch('nokiaapp.utils.get_nokia_data')
+    def test_more(self, get_nokia_data):
+        """ Responses should be requested from the offset Nokia reports """
+        get_nokia_data.side_effect = [
+            self._measures([1, 2], more=1, offset=2),
+            self._measures([3, 4], more=1, offset=4),
+            self._measures([5]),
+        ]
+        pages = fetch_window(self.nokia_user, 1222000000, 1223000000)
+        self.assertEqual([g.grpid for g in next(pages)], [1, 2])
+        # The next response is only requested once this one is consumed
+        self.assertEqual(get_nokia_data.call_count, 1)
+        self.assertEqual(len(list(pages)), 2)
+        self.assertEqual(get_nokia_data.call_args_list, [
+            mock.call(self.nokia_user, startdate=1222000000,
+                      enddate=1223000000),
+            mock.call(self.nokia_user, startdate=1222000000,
+                      enddate=1223000000, offset=2),
+            mock.call(self.nokia_user, startdate=1222000000,
+                      enddate=1223000000, offset=4),
+        ])
+
+    def test_next_window(self):
+        """ Windows should be sized to return about NOKIA_FETCH_GROUPS """
+        day = 86400
+        with self.settings(NOKIA_FETCH_GROUPS=100):
+            self.assertEqual(next_window(10 * day, 200), 5 * day)
+            self.assertEqual(next_window(10 * day, 50), 20 * day)
+            # By a factor of 4 at most, between a day and ten years
+            self.assertEqual(next_window(10 * day, 0), 40 * day)
+            self.assertEqual(next_window(10 * day, 10000), 2.5 * day)
+            self.assertEqual(next_window(2 * day, 10000), day)
+            self.assertEqual(next_window(3000 * day, 0), 3650 * day)
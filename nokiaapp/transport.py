@@ -0,0 +1,82 @@
+"""
+The ``requests`` transport used for calls to the Nokia API.
+
+Every ``NokiaApi`` instance created by :py:func:`nokiaapp.utils.create_nokia`
+has its own OAuth2 session, holding the user's token, but they all share the
+adapter returned by :py:func:`get_adapter`, so connections to Nokia are kept
+alive and reused across users.
+"""
+import json
+import random
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+
+from . import utils
+from .ratelimit import get_limiter
+
+
+def get_adapter():
+    """
+    Returns the :py:class:`NokiaAdapter` shared by all API instances, sized
+    by :ref:`NOKIA_HTTP_POOL_SIZE` and retrying connection errors
+    :ref:`NOKIA_HTTP_RETRIES` times.
+    """
+    config = (utils.get_setting('NOKIA_HTTP_POOL_SIZE'),
+              utils.get_setting('NOKIA_HTTP_RETRIES'))
+    with _adapters_lock:
+        if config not in _adapters:
+            _adapters[config] = NokiaAdapter(
+                pool_maxsize=config[0], max_retries=config[1])
+        return _adapters[config]
+
+
+_adapters = {}
+_adapters_lock = threading.Lock()
+
+
+class NokiaAdapter(HTTPAdapter):
+    """
+    An HTTP adapter that waits on the :ref:`NOKIA_RATE_LIMIT` limiter before
+    each request, and retries requests that failed with HTTP 429, a 5xx
+    status or one of the :ref:`NOKIA_RETRY_STATUSES` up to
+    :ref:`NOKIA_MAX_RETRIES` times, with exponential backoff and jitter.
+    The bodies of streamed responses aren't read, so their status is checked
+    by the caller (see :py:func:`nokiaapp.streaming.get_measures`). Requests
+    without a timeout time out after :ref:`NOKIA_HTTP_TIMEOUT` seconds.
+    """
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = utils.get_setting('NOKIA_HTTP_TIMEOUT')
+        max_retries = utils.get_setting('NOKIA_MAX_RETRIES')
+        attempt = 0
+        while True:
+            limiter = get_limiter()
+            if limiter:
+                limiter.acquire()
+            response = super(NokiaAdapter, self).send(request, **kwargs)
+            if attempt >= max_retries or not self.should_retry(
+                    response, kwargs.get('stream')):
+                return response
+            response.close()
+            time.sleep(self.backoff(attempt))
+            attempt += 1
+
+    def should_retry(self, response, stream=False):
+        if response.status_code == 429 or response.status_code >= 500:
+            return True
+        if stream:
+            return False
+        try:
+            status = json.loads(response.content.decode())['status']
+        except (ValueError, KeyError, TypeError):
+            return False
+        return status in utils.get_setting('NOKIA_RETRY_STATUSES')
+
+    def backoff(self, attempt):
+        """ The number of seconds to wait before retry number ``attempt`` """
+        return random.uniform(0, min(
+            utils.get_setting('NOKIA_RETRY_BACKOFF_MAX'),
+            utils.get_setting('NOKIA_RETRY_BACKOFF') * 2 ** attempt))
@@ -10,6 +10,10 @@ urlpatterns = [
     url(r'^error/$', views.error, name='nokia-error'),
     url(r'^logout/$', views.logout, name='nokia-logout'),
 
+    # Measurement history
+    url(r'^export/$', views.export, name='nokia-export'),
+    url(r'^import/$', views.import_status, name='nokia-import-status'),
+
     # Subscriber callback for notifications
     url(r'^notification/(?P<appli>[14])/$', views.notification,
         name='nokia-notification')
@@ -1,5 +1,10 @@
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
+from django.core.cache import caches
 from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
 
 from nokia import NokiaApi, NokiaAuth, NokiaCredentials
 
@@ -8,14 +13,24 @@ from .models import NokiaUser
 
 
 def create_nokia(client_id=None, consumer_secret=None, **kwargs):
-    """ Shortcut to create a NokiaApi instance. """
+    """
+    Shortcut to create a NokiaApi instance. Its requests are rate limited and
+    retried as configured by :ref:`NOKIA_RATE_LIMIT` and
+    :ref:`NOKIA_MAX_RETRIES`, and use a pool of connections shared with the
+    other instances.
+    """
+    from .transport import get_adapter
 
     refresh_cb = kwargs.pop('refresh_cb', None)
-    return NokiaApi(get_creds(
+    api = NokiaApi(get_creds(
         client_id=client_id,
         consumer_secret=consumer_secret,
         **kwargs
     ), refresh_cb=refresh_cb)
+    adapter = get_adapter()
+    api.client.mount('https://', adapter)
+    api.client.mount('http://', adapter)
+    return api
 
 
 def create_nokia_auth(callback_uri):
@@ -48,19 +63,205 @@ def is_integrated(user):
 
     This does not require that the token and secret are valid.
 
+    The result is remembered on the user object, so it costs one query per
+    request at most. If :ref:`NOKIA_INTEGRATION_CACHE_TIMEOUT` is set, it is
+    also cached between requests.
+
     :param user: A Django User.
     """
     if user.is_authenticated() and user.is_active:
-        return NokiaUser.objects.filter(user=user).exists()
+        if not hasattr(user, INTEGRATED_ATTR):
+            setattr(user, INTEGRATED_ATTR, _is_integrated(user.pk))
+        return getattr(user, INTEGRATED_ATTR)
     return False
 
 
+INTEGRATED_ATTR = '_nokia_is_integrated'
+
+
+def _is_integrated(user_id):
+    timeout = get_setting('NOKIA_INTEGRATION_CACHE_TIMEOUT')
+    if timeout is None:
+        return NokiaUser.objects.filter(user_id=user_id).exists()
+    cache = get_cache()
+    key = _integrated_key(user_id)
+    integrated = cache.get(key)
+    if integrated is None:
+        integrated = NokiaUser.objects.filter(user_id=user_id).exists()
+        cache.set(key, integrated, timeout)
+    return integrated
+
+
+def _integrated_key(user_id):
+    return 'nokiaapp:integrated:{0}'.format(user_id)
+
+
+def forget_integration(nokia_user, user_id=None):
+    """
+    Clear the cached :py:func:`is_integrated` result for the user of
+    ``nokia_user``, or the user with ID ``user_id`` if given, when it is
+    created, moved to another user or deleted.
+    """
+    if user_id is None:
+        user_id = nokia_user.user_id
+    if get_setting('NOKIA_INTEGRATION_CACHE_TIMEOUT') is not None:
+        get_cache().delete(_integrated_key(user_id))
+    user = getattr(nokia_user, USER_CACHE_NAME, None)
+    if (user is not None and user.pk == user_id and
+            hasattr(user, INTEGRATED_ATTR)):
+        delattr(user, INTEGRATED_ATTR)
+
+
+# Where a NokiaUser keeps its user, once it's been loaded
+USER_CACHE_NAME = NokiaUser._meta.get_field('user').get_cache_name()
+
+
 def get_nokia_data(nokia_user, **kwargs):
     """
-    Retrieves nokia data for the date range
+    Retrieves nokia data for the date range, as
+    :py:class:`nokiaapp.streaming.StreamedMeasures` parsed from the response
+    while they are stored
     """
+    from .streaming import get_measures
+
+    if nokia_user.token_expires_within():
+        nokia_user.refresh_access_token()
     api = create_nokia(**nokia_user.get_user_data())
-    return api.get_measures(**kwargs)
+    return get_measures(api, **kwargs)
+
+
+# The bounds of the windows of history fetched by fetch_window, in seconds
+MIN_WINDOW = 86400
+MAX_WINDOW = 3650 * 86400
+
+
+def fetch_pages(nokia_user, **kwargs):
+    """
+    Yield the ``NokiaMeasures`` of ``nokia_user`` retrieved with ``kwargs``
+    (passed to ``get_measures``), one response at a time. When Nokia
+    reports that there are ``more`` measures than it returned, the next
+    response is requested from the ``offset`` it gives, once the previous
+    one has been consumed, so only one response is held at a time.
+    """
+    while True:
+        incr_counter('fetches_performed')
+        measures = get_nokia_data(nokia_user, **kwargs)
+        yield measures
+        if not getattr(measures, 'more', False):
+            return
+        kwargs['offset'] = measures.offset
+
+
+def fetch_window(nokia_user, startdate, enddate):
+    """
+    Yield the ``NokiaMeasures`` of ``nokia_user`` dated from ``startdate``
+    to ``enddate`` (Unix timestamps), one response at a time, as
+    :py:func:`fetch_pages` does
+    """
+    return fetch_pages(nokia_user, startdate=startdate, enddate=enddate)
+
+
+def next_window(window, groups):
+    """
+    The number of seconds of the window to fetch after a window of
+    ``window`` seconds returned ``groups`` measure groups, aiming for
+    :ref:`NOKIA_FETCH_GROUPS` groups. The window changes by a factor of 4
+    at most each time, between a day and ten years.
+    """
+    target = get_setting('NOKIA_FETCH_GROUPS')
+    factor = min(4.0, max(0.25, float(target) / groups if groups else 4.0))
+    return int(min(MAX_WINDOW, max(MIN_WINDOW, window * factor)))
+
+
+def _profile_key(nokia_user_id):
+    return 'nokiaapp:profile:{0}'.format(nokia_user_id)
+
+
+def get_profile(nokia_user):
+    """
+    Returns the Nokia profile of ``nokia_user``, as returned by
+    ``NokiaApi.get_user``, from the :ref:`NOKIA_CACHE` cache, without waiting
+    on Nokia. If the profile isn't cached, or was cached more than
+    :ref:`NOKIA_PROFILE_CACHE_TIMEOUT` seconds ago, a refresh is queued with
+    the :ref:`NOKIA_JOB_BACKEND`. Until the first refresh has run, None is
+    returned.
+    """
+    from . import jobs
+    cache = get_cache()
+    key = _profile_key(nokia_user.nokia_user_id)
+    cached = cache.get(key)
+    if cached is None or cached['fetched'] + get_setting(
+            'NOKIA_PROFILE_CACHE_TIMEOUT') <= time.time():
+        jobs.enqueue('nokiaapp.tasks.refresh_profile',
+                     {'nokia_user_id': nokia_user.nokia_user_id},
+                     key='profile:{0}'.format(nokia_user.nokia_user_id))
+        # Jobs may have run already, with the ImmediateBackend
+        cached = cache.get(key) or cached
+    return cached and cached['profile']
+
+
+def set_profile(nokia_user_id, profile):
+    """ Cache the Nokia profile of the Nokia user ``nokia_user_id`` """
+    get_cache().set(_profile_key(nokia_user_id),
+                    {'profile': profile, 'fetched': time.time()}, None)
+
+
+def forget_profile(nokia_user_id):
+    """ Remove the cached profile of the Nokia user ``nokia_user_id`` """
+    get_cache().delete(_profile_key(nokia_user_id))
+
+
+def parallel_map(func, items, workers):
+    """
+    Returns ``[func(item) for item in items]``, computed by a pool of
+    ``workers`` threads. With a single worker, items are processed in the
+    calling thread.
+    """
+    if workers <= 1:
+        return [func(item) for item in items]
+
+    def call(item):
+        try:
+            return func(item)
+        finally:
+            # Each thread has its own database connections
+            connections.close_all()
+
+    with ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(call, items))
+
+
+COUNTERS = ('notifications_received', 'fetches_performed')
+
+
+def get_cache():
+    """ Returns the cache specified by :ref:`NOKIA_CACHE` """
+    return caches[get_setting('NOKIA_CACHE')]
+
+
+def incr_counter(name):
+    """ Increments one of the :py:data:`COUNTERS` in the cache """
+    cache = get_cache()
+    key = 'nokiaapp:counter:{0}'.format(name)
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The key was evicted in the meantime
+        cache.set(key, 1, None)
+
+
+def get_counters():
+    """
+    Returns a dict of the :py:data:`COUNTERS`, such as the number of
+    notifications received from Nokia and the number of times we fetched
+    measures from Nokia.
+    """
+    cache = get_cache()
+    return dict(
+        (name, cache.get('nokiaapp:counter:{0}'.format(name), 0))
+        for name in COUNTERS
+    )
 
 
 def get_setting(name, use_defaults=True):
@@ -1,16 +1,24 @@
+import arrow
+import csv
+import datetime
+import itertools
+import json
 import logging
 
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.signals import user_logged_in
 from django.core.urlresolvers import reverse
 from django.dispatch import receiver
-from django.http import HttpResponse, Http404
+from django.http import (
+    HttpResponse, HttpResponseBadRequest, Http404, JsonResponse,
+    StreamingHttpResponse)
 from django.shortcuts import redirect, render
 from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
 
-from . import utils
-from .models import NokiaUser, MeasureGroup
+from . import jobs, subscriptions, tasks, utils
+from .export import EXPORT_FIELDS, stream
+from .models import NokiaImport, NokiaSubscription, NokiaUser
 
 try:
     from django.urls import NoReverseMatch
@@ -58,13 +66,14 @@ def complete(request):
     If there was an error, the user is redirected again to the `error` view.
 
     If the authorization was successful, the credentials are stored for us to
-    use later, and the user is redirected. If 'next_url' is in the request
-    session, the user is redirected to that URL. Otherwise, they are
-    redirected to the URL specified by the setting
-    :ref:`NOKIA_LOGIN_REDIRECT`.
+    use later, an import of the user's measurement history is started in the
+    background (see :py:func:`nokiaapp.views.import_status`), and the user is
+    redirected. If 'next_url' is in the request session, the user is
+    redirected to that URL. Otherwise, they are redirected to the URL
+    specified by the setting :ref:`NOKIA_LOGIN_REDIRECT`.
 
-    If :ref:`NOKIA_SUBSCRIBE` is set to True, add a subscription to user
-    data at this time.
+    If :ref:`NOKIA_SUBSCRIBE` is set to True, the user is subscribed to
+    notifications of their new measures by the :ref:`NOKIA_JOB_BACKEND`.
 
     URL name:
         `nokia-complete`
@@ -97,15 +106,22 @@ def complete(request):
     else:
         user_updates['user'] = request.user
         nokia_user = NokiaUser.objects.create(**user_updates)
-    # Add the Nokia user info to the session
-    api = utils.create_nokia(**nokia_user.get_user_data())
-    request.session['nokia_profile'] = api.get_user()
-    MeasureGroup.create_from_measures(request.user, api.get_measures())
+    # Add the Nokia user info to the session, once it has been retrieved
+    utils.forget_profile(nokia_user.nokia_user_id)
+    profile = utils.get_profile(nokia_user)
+    if profile is not None:
+        request.session['nokia_profile'] = profile
+    # Import the user's history in the background
+    tasks.start_import(request.user)
     if utils.get_setting('NOKIA_SUBSCRIBE'):
-        for appli in [1, 4]:
-            notification_url = request.build_absolute_uri(
-                reverse('nokia-notification', kwargs={'appli': appli}))
-            api.subscribe(notification_url, 'django-nokia', appli=appli)
+        jobs.enqueue('nokiaapp.tasks.subscribe', {
+            'user_id': request.user.pk,
+            'callback_urls': [
+                [appli, request.build_absolute_uri(reverse(
+                    'nokia-notification', kwargs={'appli': appli}))]
+                for appli in subscriptions.APPLIS
+            ],
+        })
 
     next_url = request.session.pop('nokia_next', None) or utils.get_setting(
         'NOKIA_LOGIN_REDIRECT')
@@ -114,17 +130,22 @@ def complete(request):
 
 @receiver(user_logged_in)
 def create_nokia_session(sender, request, user, **kwargs):
-    """ If the user is a Nokia user, update the profile in the session. """
+    """
+    If the user is a Nokia user, update the profile in the session from the
+    cache (see :ref:`get_profile`), without waiting on Nokia.
+    """
 
     if (user.is_authenticated() and utils.is_integrated(user) and
             user.is_active):
-        nokia_user = NokiaUser.objects.filter(user=user)
-        if nokia_user.exists():
-            api = utils.create_nokia(**nokia_user[0].get_user_data())
+        nokia_user = NokiaUser.objects.filter(user=user).first()
+        if nokia_user is not None:
             try:
-                request.session['nokia_profile'] = api.get_user()
-            except:
-                pass
+                profile = utils.get_profile(nokia_user)
+            except Exception:
+                logger.exception("Error getting nokia user profile")
+                return
+            if profile is not None:
+                request.session['nokia_profile'] = profile
 
 
 @login_required
@@ -161,12 +182,22 @@ def logout(request):
     Otherwise, they're redirected to the URL defined in the setting
     :ref:`NOKIA_LOGOUT_REDIRECT`.
 
+    If :ref:`NOKIA_SUBSCRIBE` is set to True, the user's subscriptions to
+    notifications are revoked by the :ref:`NOKIA_JOB_BACKEND`: the recorded
+    ones (see :ref:`subscriptions`), or if none were recorded, those to this
+    site's notification URLs listed by Nokia. The credentials are only
+    forgotten once the subscriptions are revoked, so if that fails, the user
+    is still connected and can log out again to retry. The default backend
+    logs the failure, while ``'nokiaapp.jobs.DatabaseBackend'`` keeps the
+    failed job and ``'nokiaapp.jobs.ImmediateBackend'`` redirects the user
+    to the `error` view.
+
     URL name:
         `nokia-logout`
     """
-    nokia_user = NokiaUser.objects.filter(user=request.user)
+    nokia_user = NokiaUser.objects.filter(user=request.user).first()
     urls = []
-    for appli in [1, 4]:
+    for appli in subscriptions.APPLIS:
         for app in ['nokia', 'withings']:
             try:
                 urls.append(request.build_absolute_uri(reverse(
@@ -176,25 +207,157 @@ def logout(request):
             except NoReverseMatch:
                 # The library user does not have the legacy withings URLs
                 pass
-    if nokia_user.exists() and utils.get_setting('NOKIA_SUBSCRIBE'):
-        try:
-            api = utils.create_nokia(**nokia_user[0].get_user_data())
-            subs = api.list_subscriptions()
-            for sub in subs:
-                if sub['callbackurl'] in urls:
-                    api.unsubscribe(sub['callbackurl'], appli=sub['appli'])
-        except:
-            return redirect(reverse('nokia-error'))
-    nokia_user.delete()
+    if nokia_user is not None:
+        if utils.get_setting('NOKIA_SUBSCRIBE'):
+            try:
+                # The credentials are deleted once the subscriptions are
+                # revoked
+                jobs.enqueue('nokiaapp.tasks.unsubscribe', {
+                    'user_id': request.user.pk, 'callback_urls': urls})
+            except:
+                return redirect(reverse('nokia-error'))
+        else:
+            NokiaSubscription.objects.filter(user=request.user).delete()
+            nokia_user.delete()
     next_url = request.GET.get('next', None) or utils.get_setting(
         'NOKIA_LOGOUT_REDIRECT')
     return redirect(next_url)
 
 
+@login_required
+def import_status(request):
+    """
+    Returns the progress of the latest import of the user's measurement
+    history, started when they connected their Nokia account, as JSON::
+
+        {"status": "running", "progress": 0.25, "groups": 120,
+         "imported_from": "2016-04-01T12:00:00+00:00", "error": ""}
+
+    ``status`` is one of ``pending``, ``running``, ``done`` or ``failed``,
+    ``progress`` is the fraction of the history imported so far, and
+    ``imported_from`` is the date from which measures have been imported.
+    Returns a 404 if the user's history was never imported.
+
+    URL name:
+        `nokia-import-status`
+    """
+    history = NokiaImport.objects.filter(
+        user=request.user).order_by('-created', '-pk').first()
+    if history is None:
+        raise Http404
+    return JsonResponse({
+        'status': history.status,
+        'progress': history.progress,
+        'groups': history.groups,
+        'imported_from': history.cursor.isoformat(),
+        'error': history.error,
+    })
+
+
+class _Echo(object):
+    """ A file-like object for ``csv.writer`` that returns what's written """
+    def write(self, value):
+        return value
+
+
+def _export_rows(rows):
+    """ Format the dates in exported rows as ISO 8601 strings """
+    date_index = [name for name, lookup in EXPORT_FIELDS].index('date')
+    for row in rows:
+        row = list(row)
+        row[date_index] = row[date_index].isoformat()
+        yield row
+
+
+def _parse_date(value):
+    if value.isdigit():
+        return arrow.get(int(value)).datetime
+    return arrow.get(value).datetime
+
+
+def _is_day(value):
+    """ Whether ``value`` is an ISO 8601 date without a time """
+    return len(value) == 10 and not value.isdigit()
+
+
+@login_required
+def export(request):
+    """
+    Download the user's measurements, one row per measure with its group's
+    fields, oldest first. The response is streamed, and measures are read
+    from the database in batches, so memory use doesn't depend on the size
+    of the history.
+
+    The GET parameters are:
+
+    ``format``
+        ``csv`` (the default) or ``ndjson``, for one JSON object per line.
+    ``start``, ``end``
+        Only include measures dated from ``start`` to ``end`` inclusive,
+        given as ISO 8601 dates or datetimes, or Unix timestamps. An ``end``
+        date includes the whole day, in UTC.
+    ``type``
+        Only include measures of this type. May be given more than once.
+    ``category``
+        Only include groups in this category.
+    ``user``
+        Staff users may export another user's measurements.
+
+    URL name:
+        `nokia-export`
+    """
+    fmt = request.GET.get('format', 'csv')
+    if fmt not in ('csv', 'ndjson'):
+        return HttpResponseBadRequest('Unknown format')
+    user = request.user.pk
+    filters = {}
+    try:
+        if request.GET.get('user') and request.user.is_staff:
+            user = int(request.GET['user'])
+        if request.GET.get('start'):
+            filters['start'] = _parse_date(request.GET['start'])
+        end = request.GET.get('end')
+        if end and _is_day(end):
+            # The whole end day is included
+            filters['before'] = _parse_date(end) + datetime.timedelta(days=1)
+        elif end:
+            filters['end'] = _parse_date(end)
+        if request.GET.getlist('type'):
+            filters['measure_types'] = [
+                int(measure_type) for measure_type in request.GET.getlist(
+                    'type')]
+        if request.GET.get('category'):
+            filters['category'] = int(request.GET['category'])
+    except (ValueError, RuntimeError, OverflowError, OSError):
+        # Timestamps and dates out of range raise OverflowError or OSError
+        return HttpResponseBadRequest('Invalid filter')
+
+    names = [name for name, lookup in EXPORT_FIELDS]
+    rows = _export_rows(stream(
+        user, [lookup for name, lookup in EXPORT_FIELDS], **filters))
+    if fmt == 'csv':
+        writer = csv.writer(_Echo())
+        lines = itertools.chain([writer.writerow(names)],
+                                (writer.writerow(row) for row in rows))
+        content_type = 'text/csv'
+    else:
+        lines = (json.dumps(dict(zip(names, row))) + '\n' for row in rows)
+        content_type = 'application/x-ndjson'
+    response = StreamingHttpResponse(lines, content_type=content_type)
+    response['Content-Disposition'] = (
+        'attachment; filename="nokia-measures.{}"'.format(fmt))
+    return response
+
+
 @csrf_exempt
 def notification(request, appli):
     """ Receive notification from Nokia.
 
+    Retrieving the new data is left to the :ref:`NOKIA_JOB_BACKEND`, so we
+    can respond right away. Notifications for the same Nokia user received
+    within :ref:`NOKIA_NOTIFICATION_WINDOW` seconds of each other are handled
+    by a single fetch, covering all of their date ranges.
+
     More information here:
     https://developer.health.nokia.com/api/doc#api-Notification-Notification_callback
 
@@ -208,18 +371,19 @@ def notification(request, appli):
     uid = request.POST.get('userid')
 
     if uid and request.method == 'POST':
-        for user in NokiaUser.objects.filter(nokia_user_id=uid):
-            kwargs = {}
-            if user.last_update:
-                kwargs['lastupdate'] = user.last_update
-            try:
-                measures = utils.get_nokia_data(user, **kwargs)
-            except Exception:
-                logger.exception("Error getting nokia user measures")
-            else:
-                MeasureGroup.create_from_measures(user.user, measures)
-                user.last_update = timezone.now()
-                user.save()
+        try:
+            kwargs = {'nokia_user_id': int(uid)}
+        except ValueError:
+            raise Http404
+        try:
+            kwargs['startdate'] = int(request.POST['startdate'])
+            kwargs['enddate'] = int(request.POST['enddate'])
+        except (KeyError, ValueError):
+            kwargs.pop('startdate', None)
+        utils.incr_counter('notifications_received')
+        jobs.enqueue('nokiaapp.tasks.process_notification', kwargs,
+                     key=str(kwargs['nokia_user_id']),
+                     delay=utils.get_setting('NOKIA_NOTIFICATION_WINDOW'))
         return HttpResponse(status=204)
 
     # If GET request or POST with bad data, raise a 404
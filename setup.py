@@ -9,6 +9,7 @@ setup(
     author_email="bpitcher@orcasinc.com",
     packages=find_packages(),
     install_requires=["setuptools"] + required,
+    extras_require={"export": ["numpy", "pandas"]},
     include_package_data=True,
     url="https://github.com/orcasgit/django-nokia/",
     license="License :: OSI Approved :: Apache Software License",
@@ -32,6 +32,7 @@ TEMPLATES = [
 NOKIA_CLIENT_ID = 'fakeid'
 NOKIA_CONSUMER_SECRET = 'fakesecret'
 NOKIA_SUBSCRIBE = True
+NOKIA_JOB_BACKEND = 'nokiaapp.jobs.ImmediateBackend'
 USE_TZ = True
 TIME_ZONE = 'America/Chicago'
 
@@ -45,6 +46,8 @@ LOGGING = {
     },
     'loggers': {
         'nokiaapp.tasks': {'handlers': ['null'], 'level': 'DEBUG'},
+        'nokiaapp.jobs': {'handlers': ['null'], 'level': 'DEBUG'},
+        'nokiaapp.subscriptions': {'handlers': ['null'], 'level': 'DEBUG'},
     },
 }
 